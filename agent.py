@@ -1,21 +1,24 @@
 import os
 import getpass
 import sys
-import re
+import time
 
-import bluetooth
+from startup import StartupProfile, Warmup
 
-# --- Audio Imports ---
-import ggwave
-import pyaudio
+# Startup is profiled by phase. Audio listening starts first; LangChain
+# and the LLM client warm up in the background while the Bluetooth
+# connection is made (and remade whenever it drops)
+profile = StartupProfile()
 
-# --- LangChain and Robot Imports ---
-from langchain.agents import AgentType, initialize_agent
-from langchain_openai import ChatOpenAI
-from langchain.tools import tool
+with profile.phase("imports"):
+    # --- Audio Imports ---
+    from audio_pipeline import AudioPipeline
 
-# Append custom module path if needed
-sys.path.append('/home/pi/TurboPi/')
+    # Append custom module path if needed
+    sys.path.append('/home/pi/TurboPi/')
+    import protocol
+    from command_parser import compile_plan, describe_plan
+    from robot_link import RobotConnection, wait_for
 
 # --- Set OpenAI API Key ---
 if not os.environ.get("OPENAI_API_KEY"):
@@ -26,150 +29,142 @@ if not os.environ.get("OPENAI_API_KEY"):
 server_address = "D8:3A:DD:7D:67:75"
 port = 1  # This is the channel to which the server is bound
 
-# Create an RFCOMM Bluetooth socket
-sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-sock.connect((server_address, port))
+# Commands go out as binary frames (see protocol.py). The robot acks each
+# one and reports when it is done; the link keeps up to LINK_WINDOW
+# commands in flight and records the round-trip latencies
+LINK_WINDOW = 8
+ACK_TIMEOUT = 2.0  # Seconds to wait for the robot to acknowledge a command
+WINDOW_TIMEOUT = 60.0  # Seconds to wait for room in the window during a long plan
+# While the link is down, commands wait for it up to OFFLINE_MAX_AGE
+# seconds, at most OFFLINE_QUEUE frames of them
+OFFLINE_QUEUE = 16
+OFFLINE_MAX_AGE = 30.0
+KEEPALIVE = 5.0  # Seconds between pings
+LIVENESS = 15.0  # Seconds without a word from the robot before reconnecting
+
+def connect_robot():
+    import bluetooth
+    # Create an RFCOMM Bluetooth socket
+    sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    try:
+        sock.connect((server_address, port))
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+# Connects in the background and reconnects with backoff when the link
+# drops. The robot lets a manual override app (PRIORITY_OPERATOR)
+# preempt us
+robot = RobotConnection(connect_robot, window=LINK_WINDOW,
+                        hello=(protocol.PRIORITY_VOICE, "voice agent"),
+                        keepalive=KEEPALIVE, liveness=LIVENESS,
+                        queue_size=OFFLINE_QUEUE, max_age=OFFLINE_MAX_AGE)
+
+def send_commands(commands):
+    """Send commands to the robot. Returns False if the link is down and
+    they were queued to go out when it is back."""
+    sent = True
+    # A long plan goes out in window-sized frames, each acked before the next
+    for i in range(0, len(commands), LINK_WINDOW):
+        pending = robot.send(commands[i:i + LINK_WINDOW], timeout=WINDOW_TIMEOUT)
+        if pending is None:
+            sent = False
+            continue
+        if not wait_for(pending, 'acked', ACK_TIMEOUT):
+            raise TimeoutError("the robot did not acknowledge the command")
+        for p in pending:
+            if p.status is None:
+                raise ConnectionError("the link to the robot dropped")
+            if p.status == protocol.STATUS_REJECTED:
+                raise RuntimeError("the robot rejected the command, its queue is full or an operator has control")
+    return sent
 
-@tool
 def robot_movement(command_string):
     """
-    Move the robot based on a command string.
-    Commands supported:
-    - 'forward X cm' where X is a number
-    - 'forward X cm and turn Y' where X is a number and Y is 'left' or 'right'
-    - 'backward X cm' where X is a number
-    - 'turn Y' where Y is 'left' or 'right'
-    Examples: 'forward 40 cm', 'forward 40 cm and turn right', 'backward 30 cm', 'turn left'
+    Move the robot based on a command string. One string can hold a whole
+    sequence of moves and turns, which the robot runs in order.
+    Supported parts:
+    - 'forward X cm' / 'backward X cm' where X is a number, 'm' for meters also works
+    - 'turn Y' where Y is 'left' or 'right', optionally with an angle: 'turn left 45 degrees'
+    - 'turn around'
+    Join parts with 'then' or 'and'.
+    Examples: 'forward 40 cm', 'forward 40 cm and turn right', 'backward 30 cm', 'turn left',
+    'forward 30 cm then turn left then backward 10 cm'
     """
-    # Extract parameters from the command
-    distance, direction, movement_type = extract_robot_command_params(command_string)
-    
-    if movement_type == "turn_only":
-        # Turn-only command
-        if direction is None or direction.lower() not in ["left", "right"]:
-            return "Error: Direction must be 'left' or 'right'."
-        
-        try:
-            sock.send("turn@" + direction)
-        except Exception as e:
-            return f"Error executing command: {str(e)}"
-        
-        return f"Robot turned {direction}."
-        
-    elif movement_type == "backward":
-        # Backward movement command
-        if distance is None:
-            return "Error: Could not determine distance from command."
-        
-        try:
-            sock.send("-" + str(distance) + "@none")
-        except Exception as e:
-            return f"Error executing command: {str(e)}"
-        
-        return f"Robot moved backward {distance} cm."
-        
-    elif movement_type == "forward_only":
-        # Forward-only movement command
-        if distance is None:
-            return "Error: Could not determine distance from command."
-        
-        try:
-            sock.send(str(distance) + "@none")
-        except Exception as e:
-            return f"Error executing command: {str(e)}"
-        
-        return f"Robot moved forward {distance} cm."
-        
-    else:
-        # Forward and turn command
-        if distance is None:
-            return "Error: Could not determine distance from command."
-        
-        if direction is None or direction.lower() not in ["left", "right"]:
-            return "Error: Direction must be 'left' or 'right'."
-        
-        try:
-            sock.send(str(distance) + "@" + direction)
-        except Exception as e:
-            return f"Error executing command: {str(e)}"
-        
-        return f"Robot moved forward {distance} cm and turned {direction}."
-
-# Function to extract parameters from natural language
-def extract_robot_command_params(user_input):
-    distance_pattern = r'(\d+(?:\.\d+)?)\s*(?:cm|centimeters?|meters?|m)'
-    direction_pattern = r'(left|right)'
-    
-    # Identify command type
-    if re.search(r'\bturn\b', user_input.lower()) and not re.search(r'\b(forward|backward|go|move)\b', user_input.lower()):
-        # Turn-only command
-        movement_type = "turn_only"
-    elif re.search(r'\bbackward\b', user_input.lower()):
-        # Backward movement command
-        movement_type = "backward"
-    elif re.search(r'\b(forward|go|move)\b', user_input.lower()) and not re.search(r'\bturn\b', user_input.lower()):
-        # Forward-only command
-        movement_type = "forward_only"
-    else:
-        # Default: forward and turn
-        movement_type = "forward_turn"
+    plan = compile_plan(command_string)
+    if not plan:
+        return "Error: Could not find a move or turn in the command."
     
-    # Extract distance
-    distance_match = re.search(distance_pattern, user_input.lower())
-    distance = float(distance_match.group(1)) if distance_match else None
-    
-    # Extract direction
-    direction_match = re.search(direction_pattern, user_input.lower())
-    direction = direction_match.group(1) if direction_match else None
+    try:
+        encoder = robot.encoder
+        commands = [encoder.move(step.value) if step.action == "move" else encoder.turn(step.value)
+                    for step in plan]
+        if not send_commands(commands):
+            return f"The robot is reconnecting, queued: {describe_plan(plan)}."
+    except Exception as e:
+        return f"Error executing command: {str(e)}"
     
-    return distance, direction, movement_type
-
-# --- Initialize the ChatOpenAI LLM ---
-llm = ChatOpenAI(
-    openai_api_key=os.environ["OPENAI_API_KEY"],
-    model="gpt-4-turbo",
-    temperature=0
-)
-
-# Initialize the agent with the tool
-agent = initialize_agent(
-    tools=[robot_movement], 
-    llm=llm, 
-    agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-    verbose=True
-)
+    return f"Robot executed: {describe_plan(plan)}."
+
+def build_agent():
+    # --- LangChain and Robot Imports ---
+    with profile.phase("langchain imports"):
+        from langchain.agents import AgentType, initialize_agent
+        from langchain_openai import ChatOpenAI
+        from langchain.tools import tool
+
+    # --- Initialize the ChatOpenAI LLM ---
+    with profile.phase("llm client"):
+        llm = ChatOpenAI(
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            model="gpt-4-turbo",
+            temperature=0
+        )
+
+    # Initialize the agent with the tool
+    with profile.phase("agent"):
+        return initialize_agent(
+            tools=[tool(robot_movement)], 
+            llm=llm, 
+            agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
+            verbose=True
+        )
+
+agent = Warmup("agent warm-up", build_agent, profile)
 
 # Function to process user commands
 def process_robot_command(user_input):
     # Pass the entire command to the tool or the agent
     return robot_movement(user_input)
 
-# --- Set up audio receiver using ggwave and pyaudio ---
-p_audio = pyaudio.PyAudio()
-stream = p_audio.open(format=pyaudio.paFloat32, channels=1, rate=48000, input=True, frames_per_buffer=1024)
-print("Listening for audio commands... Press Ctrl+C to stop.")
-instance = ggwave.init()
+def on_audio_command(command):
+    print("Received text command: " + command)
+    # Process command using the agent
+    result = process_robot_command(command)
+    print("Agent Response: ", result)
 
 # --- Main Loop ---
 if __name__ == "__main__":
+    # Capture, ggwave decoding and command handling run on separate
+    # threads, so audio keeps being captured while a command is processed
+    with profile.phase("audio start"):
+        pipeline = AudioPipeline(on_audio_command).start()
+    print("Listening for audio commands... Press Ctrl+C to stop.")
+    robot.start()
+    agent.start()
+    reported = False
     try:
         while True:
-            data = stream.read(1024, exception_on_overflow=False)
-            res = ggwave.decode(instance, data)
-            if res is not None:
-                try:
-                    command = res.decode("utf-8")
-                    print("Received text command: " + command)
-                    # Process command using the agent
-                    result = process_robot_command(command)
-                    print("Agent Response: ", result)
-                except Exception as e:
-                    print("Error processing command:", e)
+            time.sleep(1)
+            if not reported and agent.wait(0):
+                reported = True
+                print(profile.report())
     except KeyboardInterrupt:
         pass
     finally:
-        ggwave.free(instance)
-        stream.stop_stream()
-        stream.close()
-        p_audio.terminate()
+        pipeline.stop()
+        print(pipeline.report())
+        print(robot.report())
+        robot.stop()
         print("Command processor terminated.")
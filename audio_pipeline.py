@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import queue
+import threading
+
+from metrics import LatencyHistogram, Counters
+
+# Three-stage audio command pipeline used by agent.py and llm-agent.py:
+#
+#   capture  PyAudio callback -> FrameRing (preallocated, never blocks)
+#   decode   decode thread: FrameRing -> ggwave.decode -> command queue
+#   handle   handler thread: command queue -> on_command(text)
+#
+# A slow on_command (an LLM round trip) only backs up the small command
+# queue; audio keeps flowing into the ring and through the decoder, so
+# the next transmission is not lost.
+
+RATE = 48000
+FRAMES_PER_BUFFER = 1024
+SAMPLE_BYTES = 4  # paFloat32, mono
+
+
+class FrameRing(object):
+    '''
+    Fixed ring of equal-size audio frames in one preallocated buffer.
+    put() never blocks; when the ring is full the new frame is dropped
+    and counted. high_water is the most frames ever waiting
+    '''
+    def __init__(self, slots, frame_bytes):
+        self.slots = slots
+        self.frame_bytes = frame_bytes
+        self._buf = bytearray(slots * frame_bytes)
+        self._view = memoryview(self._buf)
+        self._head = 0   # next slot to read
+        self._count = 0
+        self._cond = threading.Condition()
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, data):
+        with self._cond:
+            if self._count == self.slots:
+                self.dropped += 1
+                return False
+            slot = (self._head + self._count) % self.slots
+            start = slot * self.frame_bytes
+            n = min(len(data), self.frame_bytes)
+            self._view[start:start + n] = data[:n]
+            self._count += 1
+            if self._count > self.high_water:
+                self.high_water = self._count
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        '''
+        Oldest frame as bytes, or None after timeout seconds
+        '''
+        with self._cond:
+            if not self._count and not self._cond.wait_for(lambda: self._count, timeout):
+                return None
+            start = self._head * self.frame_bytes
+            data = bytes(self._view[start:start + self.frame_bytes])
+            self._head = (self._head + 1) % self.slots
+            self._count -= 1
+            return data
+
+
+class AudioPipeline(object):
+    '''
+    Listens for ggwave transmissions and calls on_command(text) for each
+    decoded one, from the handler thread.
+
+        pipeline = AudioPipeline(handle).start()
+        ...
+        pipeline.stop()
+        print(pipeline.report())
+    '''
+    def __init__(self, on_command, rate=RATE, frames_per_buffer=FRAMES_PER_BUFFER,
+                 ring_seconds=5.0, command_queue=8):
+        self.on_command = on_command
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        slots = max(2, int(ring_seconds * rate / frames_per_buffer))
+        self.ring = FrameRing(slots, frames_per_buffer * SAMPLE_BYTES)
+        self.commands = queue.Queue(maxsize=command_queue)
+        self.decode_latency = LatencyHistogram()
+        self.handle_latency = LatencyHistogram()
+        self.counters = Counters('frames', 'overflows', 'decoded', 'commands_dropped', 'handler_errors')
+        self._running = False
+        self._threads = []
+        self._pyaudio = None
+        self._p_audio = None
+        self._stream = None
+
+    def start(self):
+        import pyaudio
+        self._pyaudio = pyaudio
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._decode_loop, name='audio-decode', daemon=True),
+            threading.Thread(target=self._handle_loop, name='audio-handle', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._p_audio = pyaudio.PyAudio()
+        self._stream = self._p_audio.open(format=pyaudio.paFloat32, channels=1, rate=self.rate, input=True,
+                                          frames_per_buffer=self.frames_per_buffer,
+                                          stream_callback=self._capture)
+        self._stream.start_stream()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._p_audio is not None:
+            self._p_audio.terminate()
+            self._p_audio = None
+        for thread in self._threads:
+            thread.join(1.0)
+        self._threads = []
+
+    def _capture(self, in_data, frame_count, time_info, status_flags):
+        # PortAudio callback: keep it short, never block
+        pyaudio = self._pyaudio
+        if status_flags & pyaudio.paInputOverflow:
+            self.counters.inc('overflows')
+        self.counters.inc('frames')
+        self.ring.put(in_data)
+        return (None, pyaudio.paContinue if self._running else pyaudio.paComplete)
+
+    def _decode_loop(self):
+        import ggwave
+        instance = ggwave.init()
+        try:
+            while self._running:
+                data = self.ring.get(timeout=0.2)
+                if data is None:
+                    continue
+                t0 = time.perf_counter()
+                res = ggwave.decode(instance, data)
+                self.decode_latency.record(time.perf_counter() - t0)
+                if res is None:
+                    continue
+                self.counters.inc('decoded')
+                try:
+                    self.commands.put_nowait(res.decode("utf-8", errors="replace"))
+                except queue.Full:
+                    self.counters.inc('commands_dropped')
+                    print("Command queue full, dropping a decoded command")
+        finally:
+            ggwave.free(instance)
+
+    def _handle_loop(self):
+        while self._running:
+            try:
+                text = self.commands.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            t0 = time.perf_counter()
+            try:
+                self.on_command(text)
+            except Exception as e:
+                self.counters.inc('handler_errors')
+                print("Error processing command:", e)
+            self.handle_latency.record(time.perf_counter() - t0)
+
+    def stats(self):
+        stats = self.counters.snapshot()
+        stats.update({
+            'ring_slots': self.ring.slots,
+            'ring_high_water': self.ring.high_water,
+            'ring_dropped': self.ring.dropped,
+            'commands_waiting': self.commands.qsize(),
+            'decode_latency': self.decode_latency.snapshot(),
+            'handle_latency': self.handle_latency.snapshot(),
+        })
+        return stats
+
+    def report(self):
+        return "\n".join([
+            "audio: %s ring high water %d/%d, ring dropped %d" % (
+                self.counters.summary(), self.ring.high_water, self.ring.slots, self.ring.dropped),
+            "decode: " + self.decode_latency.summary(),
+            "handle: " + self.handle_latency.summary(),
+        ])
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import threading
+import collections
+
+# Background battery sampling for board.py. A low-rate thread reads the
+# ADC, so board.getBattery() and control code get the last sample from
+# memory instead of waiting for the bus behind motor writes.
+
+Sample = collections.namedtuple('Sample', ['t', 'millivolts', 'smoothed'])
+
+
+class BatteryMonitor(object):
+    '''
+    Polls read() (battery millivolts) every interval seconds.
+
+        monitor = BatteryMonitor(read).start()
+        monitor.add_threshold(6800, lambda mv: print("Low battery: %d mV" % mv))
+        monitor.latest()
+
+    smoothed is an exponential moving average with weight alpha for each
+    new sample. A sample older than max_age seconds (3 intervals by
+    default) counts as stale
+    '''
+    def __init__(self, read, interval=2.0, alpha=0.2, history=300, max_age=None):
+        self.read = read
+        self.interval = interval
+        self.alpha = alpha
+        self.max_age = 3 * interval if max_age is None else max_age
+        self.samples = 0
+        self.failures = 0
+        self._history = collections.deque(maxlen=history)
+        self._latest = None
+        self._thresholds = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='battery-monitor', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add_threshold(self, millivolts, callback, hysteresis=100, on_recover=None):
+        '''
+        Call callback(smoothed) once when the smoothed voltage drops below
+        millivolts, and on_recover(smoothed), if given, once it is back
+        above millivolts + hysteresis. Callbacks run on the monitor thread
+        '''
+        with self._lock:
+            self._thresholds.append([millivolts, hysteresis, callback, on_recover, False])
+
+    def sample(self):
+        '''
+        Take one sample now. Returns it, or None if the read failed
+        '''
+        try:
+            millivolts = self.read()
+        except Exception as e:
+            self.failures += 1
+            print("Battery read failed: %s" % e)
+            return None
+        now = time.monotonic()
+        with self._lock:
+            previous = self._latest
+            if previous is None:
+                smoothed = float(millivolts)
+            else:
+                smoothed = previous.smoothed + self.alpha * (millivolts - previous.smoothed)
+            sample = Sample(now, millivolts, smoothed)
+            self._latest = sample
+            self._history.append(sample)
+            self.samples += 1
+            fired = []
+            for threshold in self._thresholds:
+                limit, hysteresis, callback, on_recover, low = threshold
+                if not low and smoothed < limit:
+                    threshold[4] = True
+                    fired.append(callback)
+                elif low and smoothed > limit + hysteresis:
+                    threshold[4] = False
+                    if on_recover is not None:
+                        fired.append(on_recover)
+        for callback in fired:
+            try:
+                callback(smoothed)
+            except Exception as e:
+                print("Battery callback error: %s" % e)
+        return sample
+
+    def latest(self, max_age=None):
+        '''
+        The last Sample if it is at most max_age (default self.max_age)
+        seconds old, else None
+        '''
+        sample = self._latest
+        if sample is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if time.monotonic() - sample.t > max_age:
+            return None
+        return sample
+
+    @property
+    def smoothed(self):
+        sample = self._latest
+        return None if sample is None else sample.smoothed
+
+    def history(self):
+        '''
+        Samples oldest first
+        '''
+        with self._lock:
+            return list(self._history)
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.sample()
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            self._stop.wait(deadline - now)
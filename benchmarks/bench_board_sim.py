@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# coding=utf8
+# Throughput and latency of the board API against the simulated controller.
+# Runs on any machine:
+#   python3 benchmarks/bench_board_sim.py --latency 100 --byte-time 90 --fail-rate 0.01
+# Add --i2c-stats to measure with board.enableI2CStats() on and print its report.
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TARS_BOARD_BACKEND', 'sim')
+import board_backend
+import board as Board
+import mecanum
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def run(name, func, iterations):
+    samples = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        try:
+            func(i)
+        except OSError:
+            errors += 1
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    print("%-26s %9.0f ops/s  mean %8.1f us  p50 %8.1f us  p99 %8.1f us  errors %d" % (
+        name,
+        iterations / elapsed,
+        sum(samples) / len(samples) * 1e6,
+        percentile(samples, 50) * 1e6,
+        percentile(samples, 99) * 1e6,
+        errors))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark board.py against the simulated controller')
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=100, help='per transaction latency, us')
+    parser.add_argument('--byte-time', type=float, default=90, help='per byte time, us')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='probability a transaction fails')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--i2c-stats', action='store_true', help='record board.py I2C stats while running')
+    args = parser.parse_args()
+
+    sim = board_backend.SimBackend(latency=args.latency * 1e-6, byte_time=args.byte_time * 1e-6,
+                                   fail_rate=args.fail_rate, seed=args.seed)
+    Board.setBackend(sim)
+    stats = Board.enableI2CStats() if args.i2c_stats else None
+    chassis = mecanum.MecanumChassis()
+    servos = [500, 6, 1, 1500, 2, 1500, 3, 1500, 4, 1500, 5, 1500, 6, 1500]
+    n = args.iterations
+
+    print("sim bus: latency %.0f us, byte time %.0f us, fail rate %.3f, %d iterations" % (
+        args.latency, args.byte_time, args.fail_rate, n))
+    run("setMotor", lambda i: Board.setMotor(1 + i % 4, i % 100), n)
+    run("setMotors", lambda i: Board.setMotors(i % 100, -(i % 100), i % 100, -(i % 100)), n)
+    run("setPWMServosPulse (6)", lambda i: Board.setPWMServosPulse(servos), n)
+    run("getBattery", lambda i: Board.getBattery(), n)
+    run("MecanumChassis.set_velocity", lambda i: chassis.set_velocity(50, i % 360, 0), n)
+    print("transactions %d, failures %d, bytes written %d, bytes read %d" % (
+        sim.transactions, sim.failures, sim.bytes_written, sim.bytes_read))
+    if stats is not None:
+        print(stats.report())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# coding=utf8
+# Bus-servo status sweeps (position, temperature, voltage) against the
+# pty-backed simulated servo bus. Runs on any machine with a pty:
+#   python3 benchmarks/bench_bus_servo.py --servos 6 --depth 1 4 --drop-rate 0.02 --corrupt-rate 0.02
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bus_servo
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bus servo sweeps against the simulated bus')
+    parser.add_argument('-n', '--sweeps', type=int, default=200)
+    parser.add_argument('--servos', type=int, default=6)
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--reply-delay', type=float, default=500, help='servo reply delay, us')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability a reply is lost')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='probability a reply has a bad checksum')
+    parser.add_argument('--timeout', type=float, default=20, help='per request timeout, ms')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    ids = list(range(1, args.servos + 1))
+    for depth in args.depth:
+        sim = bus_servo.SimServoBus(ids, reply_delay=args.reply_delay * 1e-6,
+                                    drop_rate=args.drop_rate, corrupt_rate=args.corrupt_rate,
+                                    seed=args.seed).start()
+        bus = bus_servo.BusServoBus(sim.port(), timeout=args.timeout / 1000.0)
+        missing = 0
+        start = time.perf_counter()
+        for _ in range(args.sweeps):
+            status = bus.sweep(ids, depth=depth)
+            missing += sum(v is None for s in status.values() for v in s.values())
+        elapsed = time.perf_counter() - start
+        print("depth %d: %8.2f ms/sweep  %d reads  %d missing" % (
+            depth, elapsed / args.sweeps * 1000, len(ids) * 3 * args.sweeps, missing))
+        print("  " + bus.report().replace("\n", "\n  "))
+        sim.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# coding=utf8
+# Throughput of command_parser.compile_plan over a corpus of phrasings,
+# next to the regex chain agent.py used before (one move plus one turn).
+#   python3 benchmarks/bench_command_parser.py -n 20000
+import os
+import re
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from command_parser import compile_plan, describe_plan
+
+CORPUS = [
+    "forward 30 cm",
+    "Move the robot forward 25 centimeters and then turn left",
+    "Turn right now",
+    "Move the robot backward 25 centimeters",
+    "forward 40 cm and turn right",
+    "turn left",
+    "go forward 1.5 m then turn left then backward 10 cm",
+    "drive two meters, rotate 45 degrees right; back 20",
+    "turn around and go 50 cm",
+    "move 30 cm and turn left then move 30 cm and turn left then move 30 cm and turn left",
+    "please go ahead 80 centimetres and then spin right 180",
+    "30 cm backward then turn 30 degrees",
+    "move a meter then turn right then move half a meter",
+    "reverse 15 cm, turn left 45, forward 60 cm, turn right 45, back 15 cm",
+]
+
+# Number words inside other words ("someone", "often") are not numbers,
+# these must compile to an empty plan
+NOT_COMMANDS = [
+    "go forward until someone is done",
+    "move forward often",
+]
+CORPUS += NOT_COMMANDS
+
+def extract_robot_command_params(user_input):
+    # The parser agent.py used before command_parser
+    distance_pattern = r'(\d+(?:\.\d+)?)\s*(?:cm|centimeters?|meters?|m)'
+    direction_pattern = r'(left|right)'
+    if re.search(r'\bturn\b', user_input.lower()) and not re.search(r'\b(forward|backward|go|move)\b', user_input.lower()):
+        movement_type = "turn_only"
+    elif re.search(r'\bbackward\b', user_input.lower()):
+        movement_type = "backward"
+    elif re.search(r'\b(forward|go|move)\b', user_input.lower()) and not re.search(r'\bturn\b', user_input.lower()):
+        movement_type = "forward_only"
+    else:
+        movement_type = "forward_turn"
+    distance_match = re.search(distance_pattern, user_input.lower())
+    distance = float(distance_match.group(1)) if distance_match else None
+    direction_match = re.search(direction_pattern, user_input.lower())
+    direction = direction_match.group(1) if direction_match else None
+    return distance, direction, movement_type
+
+def bench(func, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for text in CORPUS:
+            func(text)
+    elapsed = time.perf_counter() - t0
+    return rounds * len(CORPUS) / elapsed, elapsed / (rounds * len(CORPUS))
+
+def main():
+    parser = argparse.ArgumentParser(description='Command parser throughput')
+    parser.add_argument('-n', '--rounds', type=int, default=20000)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print each phrasing and its plan')
+    args = parser.parse_args()
+    rounds = max(1, args.rounds // len(CORPUS))
+
+    if args.verbose:
+        for text in CORPUS:
+            print("%-90s -> %s" % (text, describe_plan(compile_plan(text))))
+    for text in NOT_COMMANDS:
+        if compile_plan(text):
+            print("%r should not move the robot: %s" % (text, describe_plan(compile_plan(text))))
+            return 1
+    steps = sum(len(compile_plan(text)) for text in CORPUS)
+    print("%d phrasings, %d plan steps, %d utterances per case" % (len(CORPUS), steps, rounds * len(CORPUS)))
+    rate, per = bench(compile_plan, rounds)
+    print("compile_plan                  %9.0f utterances/s  %6.1f us each" % (rate, per * 1e6))
+    rate, per = bench(extract_robot_command_params, rounds)
+    print("old extract_robot_command_params %6.0f utterances/s  %6.1f us each" % (rate, per * 1e6))
+
+if __name__ == '__main__':
+    sys.exit(main())
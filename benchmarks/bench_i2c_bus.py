@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# coding=utf8
+# Per-write I2C latency: opening SMBus for every write (the old board.py
+# behaviour) versus the shared bus handle board.py keeps open now.
+# Writes speed 0 to motor 1, so it is safe to run with the wheels on the floor.
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from smbus2 import SMBus, i2c_msg
+import board as Board
+
+I2C_BUS = 1
+I2C_ADDR = 0x7A
+MOTOR_REG = 31
+ITERATIONS = 1000
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def report(name, samples):
+    print("%-22s mean %8.1f us  p50 %8.1f us  p99 %8.1f us  max %8.1f us" % (
+        name,
+        sum(samples) / len(samples) * 1e6,
+        percentile(samples, 50) * 1e6,
+        percentile(samples, 99) * 1e6,
+        max(samples) * 1e6))
+
+def bench_open_per_write():
+    samples = []
+    for _ in range(ITERATIONS):
+        t0 = time.perf_counter()
+        with SMBus(I2C_BUS) as bus:
+            bus.i2c_rdwr(i2c_msg.write(I2C_ADDR, [MOTOR_REG, 0]))
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+def bench_shared_bus():
+    Board.setMotor(1, 0)  # open the bus outside the timed region
+    samples = []
+    for _ in range(ITERATIONS):
+        t0 = time.perf_counter()
+        Board.setMotor(1, 0)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+if __name__ == '__main__':
+    print("%d motor register writes per case" % ITERATIONS)
+    report("open per write (old)", bench_open_per_write())
+    report("shared bus (new)", bench_shared_bus())
+    Board.closeBus()
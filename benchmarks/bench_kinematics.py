@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# coding=utf8
+# Scalar MecanumChassis.set_velocity(fake=True) against the NumPy batch
+# kinematics over N random (velocity, direction, angular_rate) samples.
+#   python3 benchmarks/bench_kinematics.py -n 100000
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TARS_BOARD_BACKEND', 'sim')
+import numpy as np
+import mecanum
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Scalar against batch chassis kinematics')
+    parser.add_argument('-n', '--samples', type=int, default=100000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    velocity = rng.uniform(0, 100, args.samples)
+    direction = rng.uniform(0, 360, args.samples)
+    angular_rate = rng.uniform(-0.5, 0.5, args.samples)
+    chassis = mecanum.MecanumChassis()
+    samples = list(zip(velocity.tolist(), direction.tolist(), angular_rate.tolist()))
+
+    scalar, expected = best_of(lambda: [chassis.set_velocity(v, d, w, fake=True) for v, d, w in samples], args.repeat)
+    batch, wheels = best_of(lambda: chassis.wheel_speeds_batch(velocity, direction, angular_rate), args.repeat)
+    # Truncation can differ by one where a wheel value sits on an integer
+    mismatch = int(np.count_nonzero(np.abs(wheels - np.array(expected)) > 1))
+    forward, _ = best_of(lambda: chassis.body_velocity_batch(wheels), args.repeat)
+
+    print("%d samples, best of %d" % (args.samples, args.repeat))
+    print("scalar inverse   %9.2f ms  %8.2f us/sample" % (scalar * 1e3, scalar / args.samples * 1e6))
+    print("batch inverse    %9.2f ms  %8.2f us/sample  %.0fx" % (batch * 1e3, batch / args.samples * 1e6, scalar / batch))
+    print("batch forward    %9.2f ms  %8.2f us/sample" % (forward * 1e3, forward / args.samples * 1e6))
+    print("wheel values differing from scalar by more than 1: %d" % mismatch)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+# coding=utf8
+# Cold import time of each entry point, each measured in a fresh interpreter.
+# Modules (board, mecanum, ...) are imported directly. The scripts
+# (agent.py, llm-agent.py, tars-robot.py) connect to hardware when run, so
+# for those only their top-level imports are timed.
+#   python3 benchmarks/startup_time.py [-r REPEAT] [--detail]
+import os
+import sys
+import ast
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['board_backend', 'board', 'mecanum']
+SCRIPTS = ['tars-robot.py', 'agent.py', 'llm-agent.py']
+
+def script_imports(path):
+    '''
+    The import statements at the top level of a script, as source lines
+    '''
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    lines = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.unparse(node))
+    return lines
+
+def time_code(code, repeat):
+    '''
+    Best wall time over repeat fresh interpreters, minus an empty interpreter
+    '''
+    def run(src):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', src], cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - t0
+        return elapsed, proc
+    baseline = min(run('pass')[0] for _ in range(repeat))
+    best = None
+    for _ in range(repeat):
+        elapsed, proc = run(code)
+        if proc.returncode != 0:
+            error = proc.stderr.decode(errors='replace').strip().splitlines()
+            return None, error[-1] if error else 'failed'
+        best = elapsed if best is None else min(best, elapsed)
+    return max(0.0, best - baseline), None
+
+def top_imports(code, count=8):
+    '''
+    The slowest imports by cumulative time, from -X importtime
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in proc.stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative), name.strip()))
+    rows.sort(reverse=True)
+    return rows[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold import time of each entry point')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--detail', action='store_true', help='list the slowest imports of each entry point')
+    args = parser.parse_args()
+
+    env = os.environ.get('TARS_BOARD_BACKEND', 'hardware')
+    print("best of %d runs, backend %s, python %s" % (args.repeat, env, sys.version.split()[0]))
+    entries = [(name, 'import %s' % name) for name in MODULES]
+    for script in SCRIPTS:
+        entries.append((script + ' imports', '\n'.join(script_imports(os.path.join(ROOT, script)))))
+
+    for name, code in entries:
+        elapsed, error = time_code(code, args.repeat)
+        if error:
+            print("%-24s   failed: %s" % (name, error))
+            continue
+        print("%-24s %8.1f ms" % (name, elapsed * 1000))
+        if args.detail:
+            for cumulative, module in top_imports(code):
+                print("    %-32s %8.1f ms" % (module, cumulative / 1000.0))
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@
 import os
 import sys
 import time
+import atexit
+import threading
 sys.path.append('/home/pi/TurboPi/')
-import RPi.GPIO as GPIO
-from smbus2 import SMBus, i2c_msg
-from rpi_ws281x import PixelStrip
-from rpi_ws281x import Color as PixelColor
+import board_backend
+import battery
+import bus_servo
+import i2c_stats
+import flight_recorder
 
 #raspberrypisdk
 
@@ -22,11 +25,20 @@ __SERVO_ADDR_CMD  = 40
 __motor_speed = [0, 0, 0, 0]
 __servo_angle = [0, 0, 0, 0, 0, 0]
 __servo_pulse = [0, 0, 0, 0, 0, 0]
-__i2c = 1
 __i2c_addr = 0x7A
 
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BOARD)
+# The backend owns the I2C bus, GPIO and the RGB strip. It is the real
+# hardware unless TARS_BOARD_BACKEND=sim is set, see board_backend.py.
+# The bus is opened on first use and kept open so that every register
+# write does not pay for an open/ioctl/close of /dev/i2c-1.
+__backend = board_backend.create()
+__bus_lock = threading.RLock()
+
+def PixelColor(red, green, blue, white=0):
+    '''
+    Same packing as rpi_ws281x.Color
+    '''
+    return (white << 24) | (red << 16) | (green << 8) | blue
 
 __RGB_COUNT = 2
 __RGB_PIN = 12
@@ -35,37 +47,224 @@ __RGB_DMA = 10
 __RGB_BRIGHTNESS = 120
 __RGB_CHANNEL = 0
 __RGB_INVERT = False
-RGB = PixelStrip(__RGB_COUNT, __RGB_PIN, __RGB_FREQ_HZ, __RGB_DMA, __RGB_INVERT, __RGB_BRIGHTNESS, __RGB_CHANNEL)
-RGB.begin()
-for i in range(RGB.numPixels()):
-    RGB.setPixelColor(i, PixelColor(0,0,0))
-    RGB.show()
+__BUZZER_PIN = 31
 
-def setMotor(index, speed):
-    if index < 1 or index > 4:
-        raise AttributeError("Invalid motor num: %d"%index)
+# Hardware is set up on first use, so importing this module (or mecanum)
+# is cheap and touches nothing
+__initialized = False
+__rgb = None
+
+def init():
+    '''
+    Set up GPIO and silence the buzzer. Called by the first function that
+    touches the hardware, calling it again does nothing
+    '''
+    global __initialized
+    with __bus_lock:
+        if not __initialized:
+            __initialized = True
+            __backend.gpio_setup()
+            __backend.gpio_output(__BUZZER_PIN, 0)
+
+def getRGB():
+    '''
+    The RGB PixelStrip, created, started and cleared on first use.
+    Also available as board.RGB
+    '''
+    global __rgb
+    if __rgb is None:
+        with __bus_lock:
+            if __rgb is None:
+                init()
+                rgb = __backend.pixel_strip(__RGB_COUNT, __RGB_PIN, __RGB_FREQ_HZ, __RGB_DMA, __RGB_INVERT, __RGB_BRIGHTNESS, __RGB_CHANNEL)
+                rgb.begin()
+                for i in range(rgb.numPixels()):
+                    rgb.setPixelColor(i, PixelColor(0,0,0))
+                rgb.show()
+                __rgb = rgb
+    return __rgb
+
+def __getattr__(name):
+    if name == 'RGB':
+        return getRGB()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def getBackend():
+    return __backend
+
+def setBackend(backend):
+    '''
+    Switch to another backend, e.g. board_backend.SimBackend(latency=0).
+    The current one is closed first
+    '''
+    global __backend, __initialized, __rgb, __bus_servo
+    with __bus_lock:
+        __backend.close()
+        __backend = backend
+        __initialized = False
+        __rgb = None
+        # The bus-servo port belongs to the old backend too
+        if __bus_servo is not None:
+            try:
+                __bus_servo.port.close()
+            except Exception:
+                pass
+            __bus_servo = None
+
+def openBus():
+    '''
+    Open the shared I2C bus if it is not open yet
+    '''
+    with __bus_lock:
+        __backend.open()
+        return __backend
+
+def closeBus():
+    '''
+    Close the shared I2C bus. The next transaction reopens it
+    '''
+    with __bus_lock:
+        __backend.close()
+
+atexit.register(closeBus)
+
+# Transaction statistics, see enableI2CStats(). None when disabled, and
+# then the transaction helpers below skip all measuring
+__i2c_stats = None
+
+def enableI2CStats(dump_interval=None, dump_path=None, dump_format='text'):
+    '''
+    Start recording every bus transaction, see i2c_stats.I2CStats
+    :param dump_interval: seconds between dumps of the stats, None for none
+    :param dump_path: file the dumps are appended to, None for stderr
+    :param dump_format: 'text' or 'json' (one snapshot per line)
+    :return: the I2CStats
+    '''
+    global __i2c_stats
+    with __bus_lock:
+        if __i2c_stats is None:
+            __i2c_stats = i2c_stats.I2CStats()
+        if dump_interval:
+            __i2c_stats.start_dump(dump_interval, dump_path, dump_format)
+        return __i2c_stats
+
+def disableI2CStats():
+    global __i2c_stats
+    with __bus_lock:
+        stats = __i2c_stats
+        __i2c_stats = None
+    if stats is not None:
+        stats.stop_dump()
+    return stats
+
+def getI2CStats():
+    '''
+    :return: the stats as a dict (see I2CStats.snapshot), None when disabled
+    '''
+    stats = __i2c_stats
+    return None if stats is None else stats.snapshot()
+
+def __i2cMeasured(stats, kind, register, nbytes, transaction, args):
+    # The board function that called __i2cWrite/__i2cRead
+    function = sys._getframe(2).f_code.co_name
+    t0 = time.perf_counter()
+    retried = False
+    try:
+        try:
+            result = transaction(__i2c_addr, *args)
+        except Exception:
+            retried = True
+            __backend.close()
+            result = transaction(__i2c_addr, *args)
+    except Exception:
+        stats.record(kind, function, register, nbytes, time.perf_counter() - t0, retried, True)
+        raise
+    stats.record(kind, function, register, nbytes, time.perf_counter() - t0, retried)
+    return result
+
+def __i2cWrite(*bufs):
+    '''
+    Write one or more buffers to the controller in one transaction on the
+    shared bus. On failure the bus is closed, reopened and the transaction
+    retried once
+    '''
+    with __bus_lock:
+        if not __initialized:
+            init()
+        stats = __i2c_stats
+        if stats is not None:
+            # Recorded under the first register written; a read reports
+            # the register the last write pointed at
+            register = bufs[0][0] if bufs and len(bufs[0]) else None
+            stats.pointer = register
+            __i2cMeasured(stats, 'write', register, sum(len(buf) for buf in bufs), __backend.i2c_write, bufs)
+            return
+        try:
+            __backend.i2c_write(__i2c_addr, *bufs)
+        except Exception:
+            __backend.close()
+            __backend.i2c_write(__i2c_addr, *bufs)
+
+def __i2cRead(length):
+    '''
+    Read length bytes from the controller, retried once like __i2cWrite
+    '''
+    with __bus_lock:
+        if not __initialized:
+            init()
+        stats = __i2c_stats
+        if stats is not None:
+            return __i2cMeasured(stats, 'read', stats.pointer, length, __backend.i2c_read, (length,))
+        try:
+            return __backend.i2c_read(__i2c_addr, length)
+        except Exception:
+            __backend.close()
+            return __backend.i2c_read(__i2c_addr, length)
+
+def __motorSpeed(index, speed):
+    '''
+    Apply the wiring sign and the -100~100 clamp for motor index (1~4)
+    '''
     if index == 2 or index == 4:
         speed = speed
     else:
         speed = -speed
-    index = index - 1
     speed = 100 if speed > 100 else speed
     speed = -100 if speed < -100 else speed
+    return speed
+
+def setMotor(index, speed):
+    if index < 1 or index > 4:
+        raise AttributeError("Invalid motor num: %d"%index)
+    speed = __motorSpeed(index, speed)
+    index = index - 1
     reg = __MOTOR_ADDR + index
     
-    with SMBus(__i2c) as bus:
-        try:
-            msg = i2c_msg.write(__i2c_addr, [reg, speed.to_bytes(1, 'little', signed=True)[0]])
-            bus.i2c_rdwr(msg)
-            __motor_speed[index] = speed
-            
-        except:
-            msg = i2c_msg.write(__i2c_addr, [reg, speed.to_bytes(1, 'little', signed=True)[0]])
-            bus.i2c_rdwr(msg)
-            __motor_speed[index] = speed
+    __i2cWrite([reg, speed.to_bytes(1, 'little', signed=True)[0]])
+    __motor_speed[index] = speed
+    recorder = flight_recorder.current
+    if recorder is not None:
+        recorder.motor(index + 1, speed)
            
     return __motor_speed[index]
 
+def setMotors(v1, v2, v3, v4):
+    '''
+    Set all four motors in one combined I2C transaction so the wheels
+    change speed together
+    :param v1~v4: speed of motor 1~4, same sign and clamp rules as setMotor
+    :return: the four speeds written
+    '''
+    speeds = [__motorSpeed(i + 1, v) for i, v in enumerate((v1, v2, v3, v4))]
+    __i2cWrite(*[[__MOTOR_ADDR + i, s.to_bytes(1, 'little', signed=True)[0]]
+                 for i, s in enumerate(speeds)])
+    __motor_speed[:] = speeds
+    recorder = flight_recorder.current
+    if recorder is not None:
+        recorder.motors(speeds)
+
+    return list(__motor_speed)
+
      
 def getMotor(index):
     if index < 1 or index > 4:
@@ -73,25 +272,16 @@ def getMotor(index):
     index = index - 1
     return __motor_speed[index]
 
-def setPWMServoAngle(index, angle):
+def setPWMServoAngle(servo_id, angle):
     if servo_id < 1 or servo_id > 6:
         raise AttributeError("Invalid Servo ID: %d"%servo_id)
     index = servo_id - 1
     angle = 180 if angle > 180 else angle
     angle = 0 if angle < 0 else angle
     reg = __SERVO_ADDR + index
-    with SMBus(__i2c) as bus:
-        try:
-            msg = i2c_msg.write(__i2c_addr, [reg, angle])
-            bus.i2c_rdwr(msg)
-            __servo_angle[index] = angle
-            __servo_pulse[index] = int(((200 * angle) / 9) + 500)
-
-        except:
-            msg = i2c_msg.write(__i2c_addr, [reg, angle])
-            bus.i2c_rdwr(msg)
-            __servo_angle[index] = angle
-            __servo_pulse[index] = int(((200 * angle) / 9) + 500)
+    __i2cWrite([reg, angle])
+    __servo_angle[index] = angle
+    __servo_pulse[index] = int(((100 * angle) / 9) + 500)
 
     return __servo_angle[index]
 
@@ -105,18 +295,9 @@ def setPWMServoPulse(servo_id, pulse = 1500, use_time = 1000):
     use_time = 30000 if use_time > 30000 else use_time
     buf = [__SERVO_ADDR_CMD, 1] + list(use_time.to_bytes(2, 'little')) + [servo_id,] + list(pulse.to_bytes(2, 'little'))
     
-    with SMBus(__i2c) as bus:
-        try:
-            msg = i2c_msg.write(__i2c_addr, buf)
-            bus.i2c_rdwr(msg)
-            __servo_pulse[index] = pulse
-            __servo_angle[index] = int((pulse - 500) * 0.09)
-        except BaseException as e:
-            print(e)
-            msg = i2c_msg.write(__i2c_addr, buf)
-            bus.i2c_rdwr(msg)
-            __servo_pulse[index] = pulse
-            __servo_angle[index] = int((pulse - 500) * 0.09)
+    __i2cWrite(buf)
+    __servo_pulse[index] = pulse
+    __servo_angle[index] = int((pulse - 500) * 0.09)
 
     return __servo_pulse[index]
 
@@ -139,13 +320,7 @@ def setPWMServosPulse(args):
         __servo_pulse[s-1] = p
         __servo_angle[s-1] = int((p - 500) * 0.09)
      
-    with SMBus(__i2c) as bus:
-        try:
-            msg = i2c_msg.write(__i2c_addr, buf)
-            bus.i2c_rdwr(msg)
-        except:
-            msg = i2c_msg.write(__i2c_addr, buf)
-            bus.i2c_rdwr(msg)
+    __i2cWrite(buf)
 
 
 def getPWMServoAngle(servo_id):
@@ -160,28 +335,92 @@ def getPWMServoPulse(servo_id):
     index = servo_id - 1
     return __servo_pulse[index]
     
-def getBattery():
+def __readBattery():
     ret = 0
-    with SMBus(__i2c) as bus:
-        try:
-            msg = i2c_msg.write(__i2c_addr, [__ADC_BAT_ADDR,])
-            bus.i2c_rdwr(msg)
-            read = i2c_msg.read(__i2c_addr, 2)
-            bus.i2c_rdwr(read)
-            ret = int.from_bytes(bytes(list(read)), 'little')
-            
-        except:
-            msg = i2c_msg.write(__i2c_addr, [__ADC_BAT_ADDR,])
-            bus.i2c_rdwr(msg)
-            read = i2c_msg.read(__i2c_addr, 2)
-            bus.i2c_rdwr(read)
-            ret = int.from_bytes(bytes(list(read)), 'little')
+    with __bus_lock:
+        __i2cWrite([__ADC_BAT_ADDR,])
+        ret = int.from_bytes(__i2cRead(2), 'little')
            
     return ret
 
+# Battery voltage is sampled in the background once startBatteryMonitor()
+# has been called; getBattery() then answers from memory
+__battery_monitor = None
+
+def getBattery(max_age=None):
+    '''
+    Battery voltage in mV. With the monitor running this is its smoothed
+    voltage as of the last sample, unless that is older than max_age
+    seconds (the monitor's default staleness bound if None); then, or
+    without the monitor, the ADC is read on the bus
+    '''
+    monitor = __battery_monitor
+    if monitor is not None:
+        sample = monitor.latest(max_age)
+        if sample is not None:
+            return int(round(sample.smoothed))
+    return __readBattery()
+
+def startBatteryMonitor(interval=2.0, alpha=0.2, history=300, max_age=None):
+    '''
+    Start sampling the battery every interval seconds, see battery.BatteryMonitor
+    :return: the monitor, for add_threshold(), smoothed and history()
+    '''
+    global __battery_monitor
+    with __bus_lock:
+        if __battery_monitor is None:
+            __battery_monitor = battery.BatteryMonitor(__readBattery, interval, alpha, history, max_age)
+            __battery_monitor.start()
+        return __battery_monitor
+
+def getBatteryMonitor():
+    return __battery_monitor
+
+def stopBatteryMonitor():
+    global __battery_monitor
+    monitor = __battery_monitor
+    __battery_monitor = None
+    if monitor is not None:
+        monitor.stop()
+
 def setBuzzer(new_state):
-    GPIO.setup(31, GPIO.OUT)
-    GPIO.output(31, new_state)
+    init()
+    __backend.gpio_output(__BUZZER_PIN, new_state)
+
+# Serial bus servos, see bus_servo.py. The port is opened on first use.
+# The TurboPi drives the half-duplex line with two GPIO pins
+__BUS_SERVO_PORT = '/dev/ttyAMA0'
+__BUS_SERVO_BAUDRATE = 115200
+__BUS_SERVO_RX_PIN = 7
+__BUS_SERVO_TX_PIN = 13
+__bus_servo = None
+
+def __busServoDirection(transmit):
+    __backend.gpio_output(__BUS_SERVO_TX_PIN, 1 if transmit else 0)
+    __backend.gpio_output(__BUS_SERVO_RX_PIN, 0 if transmit else 1)
+
+def getBusServoBus():
+    '''
+    The shared bus_servo.BusServoBus, for its timeout and retries,
+    sweep() and report()
+    '''
+    global __bus_servo
+    if __bus_servo is None:
+        with __bus_lock:
+            if __bus_servo is None:
+                init()
+                port = __backend.serial_port(__BUS_SERVO_PORT, __BUS_SERVO_BAUDRATE, 0.002)
+                __bus_servo = bus_servo.BusServoBus(port, direction=__busServoDirection)
+    return __bus_servo
+
+def __busServoRead(id, cmd):
+    '''
+    Reply to read command cmd, or None if the servo never answered
+    '''
+    try:
+        return getBusServoBus().read(id, cmd)
+    except bus_servo.BusServoTimeout:
+        return None
 
 def setBusServoID(oldid, newid):
     """
@@ -189,22 +428,14 @@ def setBusServoID(oldid, newid):
     :param oldid: 
     :param newid: 
     """
-    serial_serro_wirte_cmd(oldid, LOBOT_SERVO_ID_WRITE, newid)
+    getBusServoBus().write(oldid, bus_servo.LOBOT_SERVO_ID_WRITE, newid)
 
 def getBusServoID(id=None):
     """
-    :param id: 
-    :return: 
+    :param id: None to ask the only servo on the bus
+    :return: the id, None if there was no reply
     """
-    
-    while True:
-        if id is None: 
-            serial_servo_read_cmd(0xfe, LOBOT_SERVO_ID_READ)
-        else:
-            serial_servo_read_cmd(id, LOBOT_SERVO_ID_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_ID_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(bus_servo.BROADCAST_ID if id is None else id, bus_servo.LOBOT_SERVO_ID_READ)
 
 def setBusServoPulse(id, pulse, use_time):
     """
@@ -217,43 +448,34 @@ def setBusServoPulse(id, pulse, use_time):
     pulse = 1000 if pulse > 1000 else pulse
     use_time = 0 if use_time < 0 else use_time
     use_time = 30000 if use_time > 30000 else use_time
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_MOVE_TIME_WRITE, pulse, use_time)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_MOVE_TIME_WRITE, pulse, use_time)
 
 def stopBusServo(id=None):
     '''
-    :param id:
+    :param id: None for all servos
     :return:
     '''
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_MOVE_STOP)
+    getBusServoBus().write(bus_servo.BROADCAST_ID if id is None else id, bus_servo.LOBOT_SERVO_MOVE_STOP)
 
 def setBusServoDeviation(id, d=0):
     """
     :param id: 
     :param d:  
     """
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_ANGLE_OFFSET_ADJUST, d)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_ANGLE_OFFSET_ADJUST, d)
 
 def saveBusServoDeviation(id):
     """
     :param id: 
     """
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_ANGLE_OFFSET_WRITE)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_ANGLE_OFFSET_WRITE)
 
-time_out = 50
 def getBusServoDeviation(id):
     '''
     :param id: 
     :return:
     '''
-    count = 0
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_ANGLE_OFFSET_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_ANGLE_OFFSET_READ)
-        count += 1
-        if msg is not None:
-            return msg
-        if count > time_out:
-            return None
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_ANGLE_OFFSET_READ)
 
 def setBusServoAngleLimit(id, low, high):
     '''
@@ -262,20 +484,14 @@ def setBusServoAngleLimit(id, low, high):
     :param high:
     :return:
     '''
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_ANGLE_LIMIT_WRITE, low, high)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_ANGLE_LIMIT_WRITE, low, high)
 
 def getBusServoAngleLimit(id):
     '''
     :param id:
-    :return:  0：   1： 
+    :return: (low, high)
     '''
-    
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_ANGLE_LIMIT_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_ANGLE_LIMIT_READ)
-        if msg is not None:
-            count = 0
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_ANGLE_LIMIT_READ)
 
 def setBusServoVinLimit(id, low, high):
     '''
@@ -284,18 +500,14 @@ def setBusServoVinLimit(id, low, high):
     :param high:
     :return:
     '''
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_VIN_LIMIT_WRITE, low, high)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_VIN_LIMIT_WRITE, low, high)
 
 def getBusServoVinLimit(id):
     '''
     :param id:
-    :return: 0：   1： 
+    :return: (low, high)
     '''
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_VIN_LIMIT_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_VIN_LIMIT_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_VIN_LIMIT_READ)
 
 def setBusServoMaxTemp(id, m_temp):
     '''
@@ -303,69 +515,53 @@ def setBusServoMaxTemp(id, m_temp):
     :param m_temp:
     :return:
     '''
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_TEMP_MAX_LIMIT_WRITE, m_temp)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_TEMP_MAX_LIMIT_WRITE, m_temp)
 
 def getBusServoTempLimit(id):
     '''
     :param id:
     :return:
     '''
-    
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_TEMP_MAX_LIMIT_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_TEMP_MAX_LIMIT_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_TEMP_MAX_LIMIT_READ)
 
 def getBusServoPulse(id):
     '''
     :param id:
     :return:
     '''
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_POS_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_POS_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_POS_READ)
 
 def getBusServoTemp(id):
     '''
     :param id:
     :return:
     '''
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_TEMP_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_TEMP_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_TEMP_READ)
 
 def getBusServoVin(id):
     '''
     :param id:
     :return:
     '''
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_VIN_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_VIN_READ)
-        if msg is not None:
-            return msg
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_VIN_READ)
+
+def getBusServosStatus(ids):
+    '''
+    Position, temperature and voltage of every servo in ids in one sweep
+    :return: {id: {'pulse': ..., 'temp': ..., 'vin': ...}}, None for no reply
+    '''
+    return getBusServoBus().sweep(ids)
 
 def restBusServoPulse(oldid):
-    serial_servo_set_deviation(oldid, 0)   
+    setBusServoDeviation(oldid, 0)
     time.sleep(0.1)
-    serial_serro_wirte_cmd(oldid, LOBOT_SERVO_MOVE_TIME_WRITE, 500, 100)  
+    getBusServoBus().write(oldid, bus_servo.LOBOT_SERVO_MOVE_TIME_WRITE, 500, 100)
 
 def unloadBusServo(id):
-    serial_serro_wirte_cmd(id, LOBOT_SERVO_LOAD_OR_UNLOAD_WRITE, 0)
+    getBusServoBus().write(id, bus_servo.LOBOT_SERVO_LOAD_OR_UNLOAD_WRITE, 0)
 
 def getBusServoLoadStatus(id):
-    while True:
-        serial_servo_read_cmd(id, LOBOT_SERVO_LOAD_OR_UNLOAD_READ)
-        msg = serial_servo_get_rmsg(LOBOT_SERVO_LOAD_OR_UNLOAD_READ)
-        if msg is not None:
-            return msg
-
-setBuzzer(0)
+    return __busServoRead(id, bus_servo.LOBOT_SERVO_LOAD_OR_UNLOAD_READ)
 
 # setMotor(1, 60)
 # setMotor(2, 60)
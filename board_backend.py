@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# coding=utf8
+import os
+import time
+import errno
+import random
+import threading
+
+# Backends that board.py drives. A backend owns the I2C bus, the GPIO pins
+# and the RGB strip; board.py keeps the register layout and the public API.
+#
+#   HardwareBackend  the TurboPi expansion board on a Raspberry Pi
+#   SimBackend       an in-memory controller for running off-robot
+#
+# A backend provides:
+#   open() / close()
+#   i2c_write(addr, *bufs)   one transaction, one write segment per buf
+#   i2c_read(addr, length)   one read transaction, returns bytes
+#   gpio_setup() / gpio_output(pin, state)
+#   pixel_strip(count, pin, freq_hz, dma, invert, brightness, channel)
+#   serial_port(device, baudrate, timeout)   pyserial-compatible port for bus servos
+
+class HardwareBackend(object):
+    name = 'hardware'
+
+    def __init__(self, bus=1):
+        self.bus_num = bus
+        self._bus = None
+        self._GPIO = None
+
+    def open(self):
+        if self._bus is None:
+            from smbus2 import SMBus
+            self._bus = SMBus(self.bus_num)
+        return self._bus
+
+    def close(self):
+        if self._bus is not None:
+            try:
+                self._bus.close()
+            except:
+                pass
+            self._bus = None
+
+    def i2c_write(self, addr, *bufs):
+        from smbus2 import i2c_msg
+        self.open().i2c_rdwr(*[i2c_msg.write(addr, buf) for buf in bufs])
+
+    def i2c_read(self, addr, length):
+        from smbus2 import i2c_msg
+        read = i2c_msg.read(addr, length)
+        self.open().i2c_rdwr(read)
+        return bytes(list(read))
+
+    def _gpio(self):
+        if self._GPIO is None:
+            import RPi.GPIO as GPIO
+            self._GPIO = GPIO
+        return self._GPIO
+
+    def gpio_setup(self):
+        GPIO = self._gpio()
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BOARD)
+
+    def gpio_output(self, pin, state):
+        GPIO = self._gpio()
+        GPIO.setup(pin, GPIO.OUT)
+        GPIO.output(pin, state)
+
+    def pixel_strip(self, count, pin, freq_hz, dma, invert, brightness, channel):
+        from rpi_ws281x import PixelStrip
+        return PixelStrip(count, pin, freq_hz, dma, invert, brightness, channel)
+
+    def serial_port(self, device, baudrate, timeout):
+        import serial
+        return serial.Serial(device, baudrate, timeout=timeout)
+
+
+class SimPixelStrip(object):
+    '''
+    Stand-in for rpi_ws281x.PixelStrip. show() latches the pixel buffer and
+    is counted so callers can see how many frames they push
+    '''
+    # WS2812 at 800 kHz: 24 bits per pixel at 1.25 us plus a 50 us reset
+    BIT_TIME = 1.25e-6
+    RESET_TIME = 50e-6
+
+    def __init__(self, count, pin=12, freq_hz=800000, dma=10, invert=False, brightness=255, channel=0):
+        self._pixels = [0] * count
+        self.frame = [0] * count
+        self.brightness = brightness
+        self.show_count = 0
+        self.model_timing = False
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self._pixels)
+
+    def setPixelColor(self, n, color):
+        self._pixels[n] = color
+
+    def setPixelColorRGB(self, n, red, green, blue, white=0):
+        self._pixels[n] = (white << 24) | (red << 16) | (green << 8) | blue
+
+    def getPixelColor(self, n):
+        return self._pixels[n]
+
+    def getPixels(self):
+        return list(self._pixels)
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def getBrightness(self):
+        return self.brightness
+
+    def show(self):
+        if self.model_timing:
+            _wait(len(self._pixels) * 24 * self.BIT_TIME + self.RESET_TIME)
+        self.frame = list(self._pixels)
+        self.show_count += 1
+
+
+class SimBackend(object):
+    '''
+    In-memory model of the STM32 controller at 0x7A.
+
+    Register map (same as board.py):
+        0      battery ADC, 2 bytes little endian, millivolts
+        21~26  PWM servo angle
+        31~34  motor speed, signed byte, -100~100
+        40     PWM servo command: count, time(2), then id, pulse(2) per servo
+
+    A write transaction starts with a register number and following bytes
+    go to consecutive registers. A write of only a register number sets the
+    read pointer for the next read transaction.
+
+    Timing: every transaction takes latency + bytes * byte_time seconds,
+    spent on the calling thread. The defaults are close to a 100 kHz bus.
+    Failures: each transaction fails with probability fail_rate, and
+    fail_next(n) makes the next n transactions fail. A failed transaction
+    raises OSError(EIO) like smbus2 does and leaves the registers untouched.
+    '''
+    name = 'sim'
+
+    ADDR = 0x7A
+    ADC_BAT_ADDR = 0
+    SERVO_ADDR = 21
+    MOTOR_ADDR = 31
+    SERVO_ADDR_CMD = 40
+
+    def __init__(self, latency=100e-6, byte_time=90e-6, fail_rate=0.0, seed=None,
+                 battery_mv=7600, load_sag_mv=400):
+        self.latency = latency
+        self.byte_time = byte_time
+        self.fail_rate = fail_rate
+        self.battery_mv = battery_mv
+        self.load_sag_mv = load_sag_mv
+        self._random = random.Random(seed)
+        self._fail_next = 0
+        self._lock = threading.Lock()
+        self._pointer = 0
+        self.registers = bytearray(256)
+        self.motor_updated_at = [0.0] * 4
+        self.servo_pulse = [1500] * 6
+        self.servo_time = 0
+        self.gpio = {}
+        self.servo_bus = None
+        self.is_open = False
+        self.transactions = 0
+        self.failures = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def fail_next(self, count=1):
+        self._fail_next += count
+
+    @property
+    def motor_speed(self):
+        return [int.from_bytes(self.registers[self.MOTOR_ADDR + i:self.MOTOR_ADDR + i + 1], 'little', signed=True)
+                for i in range(4)]
+
+    def battery(self):
+        '''
+        Pack voltage in mV, sagging linearly with the average motor load
+        '''
+        load = sum(abs(s) for s in self.motor_speed) / 400.0
+        return int(self.battery_mv - self.load_sag_mv * load)
+
+    def open(self):
+        self.is_open = True
+        return self
+
+    def close(self):
+        self.is_open = False
+
+    def _transaction(self, addr, nbytes):
+        self.is_open = True
+        _wait(self.latency + nbytes * self.byte_time)
+        self.transactions += 1
+        if addr != self.ADDR:
+            self.failures += 1
+            raise OSError(errno.ENXIO, 'No device at address 0x%02X' % addr)
+        if self._fail_next > 0 or (self.fail_rate and self._random.random() < self.fail_rate):
+            self._fail_next = max(0, self._fail_next - 1)
+            self.failures += 1
+            raise OSError(errno.EIO, 'Simulated I2C failure')
+
+    def i2c_write(self, addr, *bufs):
+        with self._lock:
+            self._transaction(addr, sum(len(buf) + 1 for buf in bufs))
+            now = time.monotonic()
+            for buf in bufs:
+                self._write(bytes(bytearray(buf)), now)
+                self.bytes_written += len(buf)
+
+    def i2c_read(self, addr, length):
+        with self._lock:
+            self._transaction(addr, length + 1)
+            if self._pointer == self.ADC_BAT_ADDR:
+                self.registers[0:2] = self.battery().to_bytes(2, 'little')
+            data = bytes(self.registers[self._pointer:self._pointer + length])
+            self.bytes_read += length
+            return data
+
+    def _write(self, buf, now):
+        if not buf:
+            return
+        reg, data = buf[0], buf[1:]
+        self._pointer = reg
+        if reg == self.SERVO_ADDR_CMD and data:
+            count, use_time = data[0], int.from_bytes(data[1:3], 'little')
+            for i in range(count):
+                entry = data[3 + i * 3:6 + i * 3]
+                if len(entry) == 3 and 1 <= entry[0] <= 6:
+                    self.servo_pulse[entry[0] - 1] = int.from_bytes(entry[1:3], 'little')
+            self.servo_time = use_time
+            return
+        for i, value in enumerate(data):
+            r = reg + i
+            self.registers[r] = value
+            if self.MOTOR_ADDR <= r < self.MOTOR_ADDR + 4:
+                self.motor_updated_at[r - self.MOTOR_ADDR] = now
+            elif self.SERVO_ADDR <= r < self.SERVO_ADDR + 6:
+                self.servo_pulse[r - self.SERVO_ADDR] = int(((100 * value) / 9) + 500)
+
+    def gpio_setup(self):
+        pass
+
+    def gpio_output(self, pin, state):
+        self.gpio[pin] = state
+
+    def pixel_strip(self, count, pin, freq_hz, dma, invert, brightness, channel):
+        return SimPixelStrip(count, pin, freq_hz, dma, invert, brightness, channel)
+
+    def serial_port(self, device, baudrate, timeout):
+        '''
+        A port on a simulated bus with servos 1~6, see bus_servo.SimServoBus
+        '''
+        if self.servo_bus is None:
+            import bus_servo
+            self.servo_bus = bus_servo.SimServoBus(ids=range(1, 7)).start()
+        return self.servo_bus.port(timeout)
+
+
+def _wait(seconds):
+    '''
+    Wait with better than scheduler resolution: sleep most of it, spin the rest
+    '''
+    if seconds <= 0:
+        return
+    deadline = time.perf_counter() + seconds
+    if seconds > 0.002:
+        time.sleep(seconds - 0.001)
+    while time.perf_counter() < deadline:
+        pass
+
+def create(name=None):
+    '''
+    Build a backend by name, 'hardware' or 'sim'. The default comes from
+    the TARS_BOARD_BACKEND environment variable, then 'hardware'
+    '''
+    name = name or os.environ.get('TARS_BOARD_BACKEND', 'hardware')
+    if name == 'hardware':
+        return HardwareBackend()
+    if name == 'sim':
+        return SimBackend()
+    raise ValueError("Unknown board backend: %s" % name)
@@ -0,0 +1,586 @@
+#!/usr/bin/python3
+# coding=utf8
+import os
+import time
+import select
+import struct
+import heapq
+import random
+import itertools
+import threading
+
+from metrics import LatencyHistogram, Counters
+
+# LOBOT serial bus-servo protocol, used by the bus-servo functions in
+# board.py. Every frame is
+#
+#   0x55 0x55 id length cmd params... checksum
+#
+# with length = len(params) + 3 and checksum = ~(id + length + cmd +
+# sum(params)) & 0xFF. A servo answers a read command with a frame
+# carrying the same id and cmd. Multi-byte values are little endian.
+
+HEADER = b'\x55\x55'
+BROADCAST_ID = 0xFE
+MAX_LENGTH = 10  # longest length byte of any command, with room to spare
+
+LOBOT_SERVO_MOVE_TIME_WRITE = 1
+LOBOT_SERVO_MOVE_TIME_READ = 2
+LOBOT_SERVO_MOVE_TIME_WAIT_WRITE = 7
+LOBOT_SERVO_MOVE_TIME_WAIT_READ = 8
+LOBOT_SERVO_MOVE_START = 11
+LOBOT_SERVO_MOVE_STOP = 12
+LOBOT_SERVO_ID_WRITE = 13
+LOBOT_SERVO_ID_READ = 14
+LOBOT_SERVO_ANGLE_OFFSET_ADJUST = 17
+LOBOT_SERVO_ANGLE_OFFSET_WRITE = 18
+LOBOT_SERVO_ANGLE_OFFSET_READ = 19
+LOBOT_SERVO_ANGLE_LIMIT_WRITE = 20
+LOBOT_SERVO_ANGLE_LIMIT_READ = 21
+LOBOT_SERVO_VIN_LIMIT_WRITE = 22
+LOBOT_SERVO_VIN_LIMIT_READ = 23
+LOBOT_SERVO_TEMP_MAX_LIMIT_WRITE = 24
+LOBOT_SERVO_TEMP_MAX_LIMIT_READ = 25
+LOBOT_SERVO_TEMP_READ = 26
+LOBOT_SERVO_VIN_READ = 27
+LOBOT_SERVO_POS_READ = 28
+LOBOT_SERVO_OR_MOTOR_MODE_WRITE = 29
+LOBOT_SERVO_OR_MOTOR_MODE_READ = 30
+LOBOT_SERVO_LOAD_OR_UNLOAD_WRITE = 31
+LOBOT_SERVO_LOAD_OR_UNLOAD_READ = 32
+LOBOT_SERVO_LED_CTRL_WRITE = 33
+LOBOT_SERVO_LED_CTRL_READ = 34
+LOBOT_SERVO_LED_ERROR_WRITE = 35
+LOBOT_SERVO_LED_ERROR_READ = 36
+
+# Parameter layout per command, struct format without the byte order
+WRITE_FORMATS = {
+    LOBOT_SERVO_MOVE_TIME_WRITE: 'HH',        # position 0~1000, time ms
+    LOBOT_SERVO_MOVE_TIME_WAIT_WRITE: 'HH',
+    LOBOT_SERVO_MOVE_START: '',
+    LOBOT_SERVO_MOVE_STOP: '',
+    LOBOT_SERVO_ID_WRITE: 'B',
+    LOBOT_SERVO_ANGLE_OFFSET_ADJUST: 'b',     # -125~125
+    LOBOT_SERVO_ANGLE_OFFSET_WRITE: '',
+    LOBOT_SERVO_ANGLE_LIMIT_WRITE: 'HH',      # low, high
+    LOBOT_SERVO_VIN_LIMIT_WRITE: 'HH',        # low, high, mV
+    LOBOT_SERVO_TEMP_MAX_LIMIT_WRITE: 'B',    # degrees C
+    LOBOT_SERVO_OR_MOTOR_MODE_WRITE: 'BBh',   # mode, 0, speed
+    LOBOT_SERVO_LOAD_OR_UNLOAD_WRITE: 'B',
+    LOBOT_SERVO_LED_CTRL_WRITE: 'B',
+    LOBOT_SERVO_LED_ERROR_WRITE: 'B',
+}
+READ_FORMATS = {
+    LOBOT_SERVO_MOVE_TIME_READ: 'HH',
+    LOBOT_SERVO_MOVE_TIME_WAIT_READ: 'HH',
+    LOBOT_SERVO_ID_READ: 'B',
+    LOBOT_SERVO_ANGLE_OFFSET_READ: 'b',
+    LOBOT_SERVO_ANGLE_LIMIT_READ: 'HH',
+    LOBOT_SERVO_VIN_LIMIT_READ: 'HH',
+    LOBOT_SERVO_TEMP_MAX_LIMIT_READ: 'B',
+    LOBOT_SERVO_TEMP_READ: 'B',
+    LOBOT_SERVO_VIN_READ: 'H',
+    LOBOT_SERVO_POS_READ: 'h',
+    LOBOT_SERVO_OR_MOTOR_MODE_READ: 'BBh',
+    LOBOT_SERVO_LOAD_OR_UNLOAD_READ: 'B',
+    LOBOT_SERVO_LED_CTRL_READ: 'B',
+    LOBOT_SERVO_LED_ERROR_READ: 'B',
+}
+
+# What sweep() polls by default, and the names it reports them under
+SWEEP_READS = {'pulse': LOBOT_SERVO_POS_READ, 'temp': LOBOT_SERVO_TEMP_READ, 'vin': LOBOT_SERVO_VIN_READ}
+
+DEFAULT_DEPTH = 4  # reads on the wire at once on a full-duplex bus
+
+
+class BusServoError(IOError):
+    pass
+
+
+class BusServoTimeout(BusServoError):
+    pass
+
+
+def checksum(body):
+    '''
+    body: id, length, cmd and params
+    '''
+    return ~sum(body) & 0xFF
+
+def encode_frame(servo_id, cmd, params=b''):
+    body = bytes([servo_id, len(params) + 3, cmd]) + bytes(params)
+    return HEADER + body + bytes([checksum(body)])
+
+def encode_command(servo_id, cmd, *values):
+    '''
+    Frame for cmd with values packed as in WRITE_FORMATS (or READ_FORMATS
+    for the read commands, which take no values)
+    '''
+    fmt = WRITE_FORMATS.get(cmd, '')
+    return encode_frame(servo_id, cmd, struct.pack('<' + fmt, *values) if fmt else b'')
+
+def decode_reply(cmd, params):
+    '''
+    Values of a reply to read command cmd: one value, or a tuple for the
+    commands that return two or more
+    '''
+    fmt = '<' + READ_FORMATS[cmd]
+    if len(params) != struct.calcsize(fmt):
+        raise BusServoError("Reply to command %d has %d bytes of data" % (cmd, len(params)))
+    values = struct.unpack(fmt, params)
+    return values[0] if len(values) == 1 else values
+
+
+class FrameParser(object):
+    '''
+    Incremental frame parser. feed() returns the (id, cmd, params) of
+    every complete frame; bytes that cannot start a valid frame are
+    skipped up to the next header. After each feed(), corrupt holds the
+    (id, cmd) of the frames it dropped for a bad checksum
+    '''
+    def __init__(self):
+        self._buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+        self.corrupt = []
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        frames = []
+        self.corrupt = []
+        while True:
+            start = buf.find(HEADER)
+            if start < 0:
+                # Keep a trailing 0x55, it may be half a header
+                del buf[:max(0, len(buf) - 1)]
+                break
+            if start:
+                del buf[:start]
+            if len(buf) < 4:
+                break
+            length = buf[3]
+            if length < 3 or length > MAX_LENGTH:
+                # Most likely a 0x55 in the data was taken for the header
+                self.errors += 1
+                del buf[:1]
+                continue
+            end = length + 3
+            if len(buf) < end:
+                break
+            body = bytes(buf[2:end - 1])
+            if checksum(body) != buf[end - 1]:
+                self.errors += 1
+                self.corrupt.append((body[0], body[2]))
+                del buf[:1]
+                continue
+            del buf[:end]
+            self.frames += 1
+            frames.append((body[0], body[2], body[3:]))
+        return frames
+
+
+def _match(servo_id, cmd, inflight):
+    '''
+    The request in inflight a reply from servo_id to cmd answers, or None
+    '''
+    key = (servo_id, cmd)
+    if key not in inflight and (BROADCAST_ID, cmd) in inflight:
+        # The one servo on the bus answers with its own id
+        key = (BROADCAST_ID, cmd)
+    return key if key in inflight else None
+
+def _next_request(todo, inflight):
+    '''
+    Take the next request off the end of todo whose servo has none in
+    flight, a servo answers one request at a time. None if there is none
+    '''
+    busy = {servo_id for servo_id, _ in inflight}
+    if BROADCAST_ID in busy:
+        return None
+    for i in range(len(todo) - 1, -1, -1):
+        servo_id = todo[i][0]
+        if servo_id not in busy and (servo_id != BROADCAST_ID or not busy):
+            return todo.pop(i)
+    return None
+
+
+class BusServoBus(object):
+    '''
+    LOBOT bus servos on a pyserial-compatible port (write(), read(size),
+    in_waiting and a short read timeout, e.g.
+    serial.Serial('/dev/ttyAMA0', 115200, timeout=0.002)).
+
+    Reads wait at most timeout seconds for the reply and are retried
+    retries times, as are replies with a bad checksum or that do not
+    decode. direction(transmit), if given, switches a half-duplex line
+    driver around each write.
+
+    depth is how many reads may be on the wire at once, never two to the
+    same servo. It defaults to 1 with direction, as on a half-duplex bus
+    a request sent while a servo is replying collides with it, and to
+    DEFAULT_DEPTH on a full-duplex one.
+
+        bus = BusServoBus(port)
+        bus.write(1, LOBOT_SERVO_MOVE_TIME_WRITE, 500, 1000)
+        bus.read(1, LOBOT_SERVO_POS_READ)
+        bus.sweep([1, 2, 3])   # {1: {'pulse': 500, 'temp': 31, 'vin': 7400}, ...}
+    '''
+    def __init__(self, port, timeout=0.05, retries=2, direction=None, depth=None):
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.direction = direction
+        if depth is None:
+            depth = 1 if direction is not None else DEFAULT_DEPTH
+        self.depth = depth
+        self.latency = LatencyHistogram()
+        self.counters = Counters('writes', 'reads', 'replies', 'timeouts', 'bad_replies', 'retries', 'unmatched')
+        self._parser = FrameParser()
+        self._lock = threading.RLock()
+
+    def _send(self, frame):
+        if self.direction is not None:
+            self.direction(True)
+        self.port.write(frame)
+        if self.direction is not None:
+            # Let the last byte out before releasing the line
+            flush = getattr(self.port, 'flush', None)
+            if flush is not None:
+                flush()
+            self.direction(False)
+
+    def _receive(self):
+        waiting = getattr(self.port, 'in_waiting', 0)
+        return self.port.read(waiting or 1)
+
+    def write(self, servo_id, cmd, *values):
+        '''
+        Send a command that has no reply
+        '''
+        with self._lock:
+            self._send(encode_command(servo_id, cmd, *values))
+            self.counters.inc('writes')
+
+    def read(self, servo_id, cmd, timeout=None, retries=None):
+        '''
+        Send read command cmd to servo_id and return its decoded reply.
+        Raises BusServoTimeout once every attempt has timed out
+        '''
+        results = self.read_many([(servo_id, cmd)], timeout=timeout, retries=retries)
+        value = results[(servo_id, cmd)]
+        if value is None:
+            raise BusServoTimeout("No reply from servo %d to command %d" % (servo_id, cmd))
+        return value
+
+    def read_many(self, requests, depth=None, timeout=None, retries=None):
+        '''
+        Run read requests [(servo_id, cmd), ...] and return
+        {(servo_id, cmd): value or None if it never answered}.
+
+        Up to depth requests (self.depth by default) to different servos
+        are on the wire at once, so their servos work on them at the same
+        time, and the next one goes out as soon as a reply arrives. A
+        sweep takes no fixed delays, and with depth 1 one round trip per
+        request
+        '''
+        depth = self.depth if depth is None else depth
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        todo = list(requests)
+        todo.reverse()
+        results = dict.fromkeys(requests)
+        attempts = {}
+        inflight = {}   # (id, cmd) -> (sent_at, deadline)
+
+        def retry(key):
+            if attempts[key] <= retries:
+                self.counters.inc('retries')
+                todo.append(key)
+
+        with self._lock:
+            # Whatever is left over belongs to nobody
+            self._parser.feed(self._receive_pending())
+            while todo or inflight:
+                while len(inflight) < depth:
+                    key = _next_request(todo, inflight)
+                    if key is None:
+                        break
+                    attempts[key] = attempts.get(key, 0) + 1
+                    self._send(encode_frame(key[0], key[1]))
+                    self.counters.inc('reads')
+                    now = time.monotonic()
+                    inflight[key] = (now, now + timeout)
+                frames = self._parser.feed(self._receive())
+                for servo_id, cmd in self._parser.corrupt:
+                    # Most likely the reply to a request of ours, ask again
+                    # now instead of waiting for its timeout
+                    key = _match(servo_id, cmd, inflight)
+                    if key is not None:
+                        del inflight[key]
+                        self.counters.inc('bad_replies')
+                        retry(key)
+                for servo_id, cmd, params in frames:
+                    key = _match(servo_id, cmd, inflight)
+                    if key is None:
+                        self.counters.inc('unmatched')
+                        continue
+                    sent_at, _ = inflight.pop(key)
+                    try:
+                        results[key] = decode_reply(cmd, params)
+                    except BusServoError as e:
+                        print("Bad bus servo reply: %s" % e)
+                        self.counters.inc('bad_replies')
+                        retry(key)
+                        continue
+                    self.counters.inc('replies')
+                    self.latency.record(time.monotonic() - sent_at)
+                now = time.monotonic()
+                for key in [k for k, (_, deadline) in inflight.items() if now >= deadline]:
+                    del inflight[key]
+                    self.counters.inc('timeouts')
+                    retry(key)
+        return results
+
+    def _receive_pending(self):
+        waiting = getattr(self.port, 'in_waiting', 0)
+        return self.port.read(waiting) if waiting else b''
+
+    def sweep(self, ids, reads=SWEEP_READS, depth=None, timeout=None, retries=None):
+        '''
+        Poll every read in reads ({name: cmd}) on every servo in ids.
+        Returns {id: {name: value or None}}
+        '''
+        # Servo by servo for each read, so requests in a row go to
+        # different servos and can be on the wire together
+        requests = [(servo_id, cmd) for cmd in reads.values() for servo_id in ids]
+        results = self.read_many(requests, depth=depth, timeout=timeout, retries=retries)
+        return {servo_id: {name: results[(servo_id, cmd)] for name, cmd in reads.items()}
+                for servo_id in ids}
+
+    def report(self):
+        return "bus servo: %s\n  reply latency: %s" % (self.counters.summary(), self.latency.summary())
+
+
+class PtyPort(object):
+    '''
+    The part of pyserial's Serial that BusServoBus uses, over a file
+    descriptor. For the pty of SimServoBus when pyserial is not installed
+    '''
+    def __init__(self, path, timeout=0.002):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        self.timeout = timeout
+        try:
+            import tty
+            tty.setraw(self.fd)
+        except Exception:
+            pass
+
+    @property
+    def in_waiting(self):
+        import fcntl
+        import termios
+        buf = fcntl.ioctl(self.fd, termios.FIONREAD, b'\0\0\0\0')
+        return struct.unpack('i', buf)[0]
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        return len(data)
+
+    def read(self, size=1):
+        data = b''
+        deadline = time.monotonic() + (self.timeout or 0)
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if not select.select([self.fd], [], [], max(0.0, remaining))[0]:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data
+
+    def flush(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SimServo(object):
+    def __init__(self, servo_id):
+        self.id = servo_id
+        self.position = 500
+        self.target = 500
+        self.move_start = 0.0
+        self.move_time = 0.0
+        self.offset = 0
+        self.saved_offset = 0
+        self.angle_limit = (0, 1000)
+        self.vin_limit = (4500, 12000)
+        self.temp_max = 85
+        self.temp = 30
+        self.vin = 7400
+        self.loaded = 1
+        self.led = 0
+        self.busy_until = 0.0
+
+    def pos(self, now):
+        if self.move_time <= 0 or now >= self.move_start + self.move_time:
+            return self.target
+        f = (now - self.move_start) / self.move_time
+        return int(round(self.position + (self.target - self.position) * f))
+
+
+class SimServoBus(object):
+    '''
+    Simulated servos behind a pseudo terminal. Open port_name like a
+    serial port (or use port()) and talk LOBOT to it.
+
+        sim = SimServoBus(ids=[1, 2, 3]).start()
+        bus = BusServoBus(sim.port())
+
+    reply_delay is how long a servo takes to answer, drop_rate and
+    corrupt_rate the chance that a reply is lost or has a bad checksum.
+    Like real servos, each one works on its own requests in turn while
+    the others work on theirs
+    '''
+    def __init__(self, ids=(1,), reply_delay=0.0005, drop_rate=0.0, corrupt_rate=0.0, seed=None):
+        self.servos = {i: SimServo(i) for i in ids}
+        self.reply_delay = reply_delay
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.requests = 0
+        self.replies = 0
+        self._random = random.Random(seed)
+        self._parser = FrameParser()
+        self._outbox = []  # heap of (due, n, frame)
+        self._order = itertools.count()
+        self._master, self._slave = os.openpty()
+        try:
+            import tty
+            tty.setraw(self._master)
+            tty.setraw(self._slave)
+        except Exception:
+            pass
+        self.port_name = os.ttyname(self._slave)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='sim-servo-bus', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def port(self, timeout=0.002):
+        '''
+        An open pyserial port on the pty, or a PtyPort without pyserial
+        '''
+        try:
+            import serial
+        except ImportError:
+            return PtyPort(self.port_name, timeout)
+        return serial.Serial(self.port_name, 115200, timeout=timeout)
+
+    def _run(self):
+        while self._running:
+            wait = 0.05
+            if self._outbox:
+                wait = min(wait, max(0.0, self._outbox[0][0] - time.monotonic()))
+            if select.select([self._master], [], [], wait)[0]:
+                try:
+                    data = os.read(self._master, 256)
+                except OSError:
+                    break
+                for servo_id, cmd, params in self._parser.feed(data):
+                    self.requests += 1
+                    self._handle(servo_id, cmd, params)
+            now = time.monotonic()
+            while self._outbox and self._outbox[0][0] <= now:
+                _, _, frame = heapq.heappop(self._outbox)
+                try:
+                    os.write(self._master, frame)
+                except OSError:
+                    return
+                self.replies += 1
+
+    def _reply(self, servo, cmd, *values):
+        # Answered reply_delay after the servo is done with the one before
+        due = max(time.monotonic(), servo.busy_until) + self.reply_delay
+        servo.busy_until = due
+        if self._random.random() < self.drop_rate:
+            return
+        frame = bytearray(encode_frame(servo.id, cmd, struct.pack('<' + READ_FORMATS[cmd], *values)))
+        if self._random.random() < self.corrupt_rate:
+            frame[-1] ^= 0xFF
+        heapq.heappush(self._outbox, (due, next(self._order), bytes(frame)))
+
+    def _handle(self, servo_id, cmd, params):
+        now = time.monotonic()
+        if servo_id == BROADCAST_ID:
+            targets = list(self.servos.values())
+            if cmd in READ_FORMATS:
+                # Only meaningful with one servo on the bus, like ID_READ
+                targets = targets[:1]
+        else:
+            targets = [self.servos[servo_id]] if servo_id in self.servos else []
+        fmt = WRITE_FORMATS.get(cmd)
+        values = struct.unpack('<' + fmt, params) if fmt and len(params) == struct.calcsize('<' + fmt) else ()
+        for servo in targets:
+            if cmd == LOBOT_SERVO_MOVE_TIME_WRITE and values:
+                servo.position = servo.pos(now)
+                servo.target = max(servo.angle_limit[0], min(servo.angle_limit[1], values[0]))
+                servo.move_start, servo.move_time = now, values[1] / 1000.0
+            elif cmd == LOBOT_SERVO_MOVE_STOP:
+                servo.position = servo.target = servo.pos(now)
+                servo.move_time = 0.0
+            elif cmd == LOBOT_SERVO_ID_WRITE and values:
+                del self.servos[servo.id]
+                servo.id = values[0]
+                self.servos[servo.id] = servo
+            elif cmd == LOBOT_SERVO_ANGLE_OFFSET_ADJUST and values:
+                servo.offset = values[0]
+            elif cmd == LOBOT_SERVO_ANGLE_OFFSET_WRITE:
+                servo.saved_offset = servo.offset
+            elif cmd == LOBOT_SERVO_ANGLE_LIMIT_WRITE and values:
+                servo.angle_limit = values
+            elif cmd == LOBOT_SERVO_VIN_LIMIT_WRITE and values:
+                servo.vin_limit = values
+            elif cmd == LOBOT_SERVO_TEMP_MAX_LIMIT_WRITE and values:
+                servo.temp_max = values[0]
+            elif cmd == LOBOT_SERVO_LOAD_OR_UNLOAD_WRITE and values:
+                servo.loaded = values[0]
+            elif cmd == LOBOT_SERVO_LED_CTRL_WRITE and values:
+                servo.led = values[0]
+            elif cmd == LOBOT_SERVO_POS_READ:
+                self._reply(servo, cmd, servo.pos(now) + servo.offset)
+            elif cmd == LOBOT_SERVO_TEMP_READ:
+                self._reply(servo, cmd, servo.temp)
+            elif cmd == LOBOT_SERVO_VIN_READ:
+                self._reply(servo, cmd, servo.vin)
+            elif cmd == LOBOT_SERVO_ID_READ:
+                self._reply(servo, cmd, servo.id)
+            elif cmd == LOBOT_SERVO_ANGLE_OFFSET_READ:
+                self._reply(servo, cmd, servo.offset)
+            elif cmd == LOBOT_SERVO_ANGLE_LIMIT_READ:
+                self._reply(servo, cmd, *servo.angle_limit)
+            elif cmd == LOBOT_SERVO_VIN_LIMIT_READ:
+                self._reply(servo, cmd, *servo.vin_limit)
+            elif cmd == LOBOT_SERVO_TEMP_MAX_LIMIT_READ:
+                self._reply(servo, cmd, servo.temp_max)
+            elif cmd == LOBOT_SERVO_LOAD_OR_UNLOAD_READ:
+                self._reply(servo, cmd, servo.loaded)
+            elif cmd == LOBOT_SERVO_LED_CTRL_READ:
+                self._reply(servo, cmd, servo.led)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# coding=utf8
+import sys
+sys.path.append('/home/pi/TurboPi/')
+import time
+import argparse
+import board as Board
+import mecanum
+from speed_model import SpeedModel, DEFAULT_TABLE, move_axis, turn_axis
+
+# Fills the speed table used by tars-robot.py and llm-agent.py. For each
+# direction and speed the robot drives for a fixed time and you enter how
+# far it went; for each turn rate it spins and you enter the angle. The
+# battery voltage is read right before each move, like the robot does
+# when it plans one. Samples are merged into the existing table, so run
+# it again at a few charge levels to cover the voltage range.
+
+DIRECTIONS = {'forward': 90, 'backward': 270, 'right': 0, 'left': 180}
+
+
+def ask(prompt):
+    while True:
+        answer = input(prompt).strip()
+        if not answer:
+            return None
+        try:
+            return float(answer)
+        except ValueError:
+            print("Enter a number, or nothing to skip")
+
+
+def timed(chassis, velocity, direction, angular_rate, duration):
+    millivolts = Board.getBattery()
+    chassis.set_velocity(velocity, direction, angular_rate)
+    time.sleep(duration)
+    chassis.set_velocity(0, 0, 0)
+    time.sleep(0.5)
+    return millivolts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the chassis speed table.")
+    parser.add_argument('--speeds', type=float, nargs='+', default=[30, 50, 80])
+    parser.add_argument('--directions', nargs='+', default=['forward', 'backward'], choices=sorted(DIRECTIONS))
+    parser.add_argument('--turn-rates', type=float, nargs='*', default=[0.5])
+    parser.add_argument('--duration', type=float, default=2.0, help="seconds per move")
+    parser.add_argument('--table', default=DEFAULT_TABLE)
+    args = parser.parse_args()
+
+    model = SpeedModel.load(args.table)
+    chassis = mecanum.MecanumChassis()
+    try:
+        for name in args.directions:
+            direction = DIRECTIONS[name]
+            for speed in args.speeds:
+                input("Place the robot for a %s move at speed %g and press Enter" % (name, speed))
+                millivolts = timed(chassis, speed, direction, 0, args.duration)
+                distance = ask("Distance moved in cm (Enter to skip): ")
+                if distance:
+                    rate = distance / args.duration
+                    model.add_sample(move_axis(direction), millivolts, speed, rate)
+                    print("%s speed %g at %d mV: %.1f cm/s" % (name, speed, millivolts, rate))
+        for rate in args.turn_rates:
+            for angular_rate in (-rate, rate):
+                side = "counter-clockwise" if angular_rate < 0 else "clockwise"
+                input("Mark the robot's heading for a %s turn at %g and press Enter" % (side, rate))
+                millivolts = timed(chassis, 0, 0, angular_rate, args.duration)
+                degrees = ask("Degrees turned (Enter to skip): ")
+                if degrees:
+                    dps = degrees / args.duration
+                    model.add_sample(turn_axis(angular_rate), millivolts, rate, dps)
+                    print("%s turn %g at %d mV: %.1f deg/s" % (side, rate, millivolts, dps))
+    except KeyboardInterrupt:
+        print()
+    finally:
+        chassis.set_velocity(0, 0, 0)
+    model.save(args.table)
+    print("Saved %s" % args.table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# coding=utf8
+import re
+import time
+import threading
+import collections
+
+_SPACES = re.compile(r'\s+')
+_EDGE_PUNCTUATION = re.compile(r'^[\s"\'.,!?;:]+|[\s"\'.,!?;:]+$')
+
+def normalize_utterance(text):
+    '''
+    Cache key for a spoken command: lower case, single spaces, no
+    surrounding punctuation or quotes
+    '''
+    text = _EDGE_PUNCTUATION.sub('', text.lower())
+    return _SPACES.sub(' ', text)
+
+
+class LRUTTLCache(object):
+    '''
+    Bounded cache: at most maxsize entries, least recently used evicted
+    first, and entries older than ttl seconds treated as missing.
+    Thread safe. None cannot be stored, get() returns it for a miss
+    '''
+    def __init__(self, maxsize=256, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                del self._data[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses,
+                'expired': self.expired, 'evicted': self.evicted}
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+# coding=utf8
+import re
+import collections
+
+# Compiles a spoken movement command into an ordered motion plan in one
+# pass over the text:
+#
+#   "forward 30 cm then turn left then backward 10 cm"
+#       -> [Step('move', 30.0), Step('turn', 90.0), Step('move', -10.0)]
+#
+# move values are centimeters (negative is backward), turn values are
+# degrees (positive is left), matching protocol.OP_MOVE and OP_TURN.
+
+Step = collections.namedtuple('Step', ['action', 'value'])
+
+DEFAULT_TURN = 90.0
+
+_NUMBER_WORDS = {
+    'a': 1, 'an': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'fifteen': 15,
+    'twenty': 20, 'thirty': 30, 'forty': 40, 'fifty': 50, 'sixty': 60,
+    'seventy': 70, 'eighty': 80, 'ninety': 90, 'hundred': 100, 'half': 0.5,
+}
+_LENGTH_UNITS = {'mm': 0.1, 'millimeter': 0.1, 'millimeters': 0.1, 'millimetre': 0.1, 'millimetres': 0.1,
+                 'cm': 1.0, 'centimeter': 1.0, 'centimeters': 1.0, 'centimetre': 1.0, 'centimetres': 1.0,
+                 'm': 100.0, 'meter': 100.0, 'meters': 100.0, 'metre': 100.0, 'metres': 100.0}
+
+_TOKENS = re.compile(r'''
+    (?P<number>(?:\d+(?:\.\d+)?|\.\d+)(?!(?!(?:%(lengths)s)\b|deg)[a-z])|\b(?:%(words)s)\b)\s*
+        (?:(?P<length>%(lengths)s)\b|(?P<angle>degrees?|deg\b|°))?
+  | \b(?P<forward>forward|forwards|ahead|straight)\b
+  | \b(?P<backward>backward|backwards|back|reverse)\b
+  | \b(?P<verb>move|go|drive|walk|roll)\b
+  | \b(?P<turn>turn|rotate|spin)\b
+  | \b(?P<side>left|right)\b
+  | \b(?P<around>around)\b
+  | (?P<sequence>\b(?:then|and|after\s+that|next|finally)\b|[,;.])
+''' % {
+    'words': '|'.join(sorted(_NUMBER_WORDS, key=len, reverse=True)),
+    'lengths': '|'.join(sorted(_LENGTH_UNITS, key=len, reverse=True)),
+}, re.VERBOSE)
+
+
+def _number(text):
+    return _NUMBER_WORDS[text] if text in _NUMBER_WORDS else float(text)
+
+def compile_plan(text, default_turn=DEFAULT_TURN):
+    '''
+    Parse text into a list of Steps. Words the grammar does not know are
+    skipped. Distances only count in a move clause, or when a direction
+    word follows right after them ("30 cm backward"), which then sets
+    their sign. A distance without a unit in a move clause is in
+    centimeters, a bare number before a turn's side or directly after it
+    is taken as degrees and "turn around" is 180 degrees
+    '''
+    lowered = text.lower()
+    plan = []
+    sign = 1.0           # direction for the next distance
+    moving = False       # in a clause with a move verb or direction word
+    explicit = False     # sign came from a direction word in this clause
+    last_move = None     # index of the last move, while a trailing direction may still apply
+    turning = False      # saw a turn verb, waiting for its side or angle
+    angle = None         # angle given before the side, "turn 45 degrees left"
+    last_turn = None     # index of the last turn, while a trailing angle may still apply
+    turn_end = 0         # where the side word of that turn ended
+    held = None          # distance outside a move clause, a move only if a direction follows
+    scale = 1.0          # "half a meter"
+
+    def add_move(centimeters):
+        plan.append(Step('move', sign * centimeters))
+        return None if explicit else len(plan) - 1
+
+    def add_turn(degrees):
+        plan.append(Step('turn', degrees))
+
+    for m in _TOKENS.finditer(lowered):
+        kind = m.lastgroup
+        pending, held = held, None
+        word = m.group('number')
+        if word is not None:
+            unit = m.group('length')
+            if unit is None and word in ('a', 'an'):
+                continue
+            if unit is None and word == 'half':
+                scale = 0.5
+                continue
+            value = float(_number(word)) * scale
+            scale = 1.0
+            if unit:
+                if moving:
+                    last_move = add_move(value * _LENGTH_UNITS[unit])
+                else:
+                    # "the robot is 2 m away" is not a move, "2 m forward" is
+                    held = value * _LENGTH_UNITS[unit]
+                last_turn = None
+            elif last_turn is not None:
+                if not lowered[turn_end:m.start()].strip():
+                    # "turn left 45", not "go to the left side at 5"
+                    previous = plan[last_turn].value
+                    plan[last_turn] = Step('turn', value if previous >= 0 else -value)
+                last_turn = None
+            elif m.group('angle') or turning:
+                angle = value
+            elif moving:
+                last_move = add_move(value)
+            continue
+        if kind in ('forward', 'backward'):
+            sign = 1.0 if kind == 'forward' else -1.0
+            moving = True
+            if last_move is not None:
+                # "move 30 cm backward"
+                plan[last_move] = Step('move', sign * abs(plan[last_move].value))
+                last_move = None
+            elif pending is not None:
+                # "30 cm backward"
+                plan.append(Step('move', sign * pending))
+            else:
+                explicit = True
+        elif kind == 'verb':
+            sign, moving, explicit, last_move, last_turn = 1.0, True, False, None, None
+        elif kind == 'turn':
+            turning, last_move = True, None
+        elif kind == 'side':
+            # "left" without "turn" is still a turn, the chassis does not strafe here
+            degrees = angle if angle is not None else default_turn
+            add_turn(degrees if m.group('side') == 'left' else -degrees)
+            last_turn = len(plan) - 1 if angle is None else None
+            turn_end = m.end()
+            turning, angle, last_move = False, None, None
+        elif kind == 'around':
+            add_turn(180.0)
+            turning, angle, last_move = False, None, None
+        elif kind == 'sequence':
+            if turning and angle is not None:
+                # "turn 45 degrees" without a side turns left
+                add_turn(angle)
+            sign, moving, explicit, last_move = 1.0, False, False, None
+            turning, angle, last_turn = False, None, None
+    if turning and angle is not None:
+        add_turn(angle)
+    return plan
+
+def describe_plan(plan):
+    parts = []
+    for step in plan:
+        if step.action == 'move':
+            parts.append("%s %g cm" % ("forward" if step.value >= 0 else "backward", abs(step.value)))
+        else:
+            parts.append("turn %s %g degrees" % ("left" if step.value >= 0 else "right", abs(step.value)))
+    return ", then ".join(parts)
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# coding=utf8
+import os
+import mmap
+import time
+import struct
+import threading
+import collections
+
+# Flight recorder: what the robot was told and what it did, kept in a
+# memory-mapped ring file of fixed-size binary records. Recording one is
+# a struct pack into the mapping under a lock, no syscall and no
+# formatting, so it can stay on during normal runs. When the ring is full
+# the oldest records are overwritten. The pages belong to the file, so
+# the recording survives the process crashing.
+#
+#   flight_recorder.start('flight.rec')   # hooks in board.py, mecanum.py
+#   ...                                    # and tars-robot.py record into it
+#   flight_recorder.stop()
+#
+#   header, records = flight_recorder.read_recording('flight.rec')
+#
+# File, little endian: a HEADER_SIZE byte header
+#   magic 4s, version H, record size H, capacity I, written Q,
+#   started (wall clock) d, started (monotonic) d
+# then capacity records of
+#   seq I, t d (monotonic), kind B, a B, b H, f0 f f1 f f2 f f3 f
+# written is the number of records ever written; record i is in slot
+# i % capacity and is only counted once it is complete.
+#
+# What a, b and f0~f3 hold per kind:
+#   REC_FRAME     received frame: a type, b payload length, f0 flags
+#   REC_COMMAND   parsed command: a op, b seq, f0 value
+#   REC_VELOCITY  MecanumChassis.set_velocity: f0 velocity, f1 direction, f2 angular rate
+#   REC_MOTOR     board.setMotor: a motor (1~4), f0 speed written
+#   REC_MOTORS    board.setMotors: f0~f3 speeds written
+
+MAGIC = b'TRFR'
+VERSION = 1
+HEADER_SIZE = 64
+DEFAULT_CAPACITY = 65536  # 2 MB
+
+REC_FRAME = 1
+REC_COMMAND = 2
+REC_VELOCITY = 3
+REC_MOTOR = 4
+REC_MOTORS = 5
+
+KIND_NAMES = {REC_FRAME: 'frame', REC_COMMAND: 'command', REC_VELOCITY: 'velocity',
+              REC_MOTOR: 'motor', REC_MOTORS: 'motors'}
+
+_HEADER = struct.Struct('<4sHHIQdd')
+_WRITTEN = struct.Struct('<Q')
+_WRITTEN_OFFSET = 12
+_RECORD = struct.Struct('<IdBBHffff')
+
+Record = collections.namedtuple('Record', ['seq', 't', 'kind', 'a', 'b', 'f0', 'f1', 'f2', 'f3'])
+Header = collections.namedtuple('Header', ['version', 'record_size', 'capacity', 'written',
+                                           'started', 'started_monotonic'])
+
+
+class FlightRecorder(object):
+    '''
+    Records into a new ring file at path with room for capacity records.
+    An existing file is overwritten. All methods are thread safe
+    '''
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.written = 0
+        self._lock = threading.Lock()
+        size = HEADER_SIZE + capacity * _RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self._map, 0, MAGIC, VERSION, _RECORD.size, capacity, 0,
+                          time.time(), time.monotonic())
+
+    def record(self, kind, a=0, b=0, f0=0.0, f1=0.0, f2=0.0, f3=0.0):
+        with self._lock:
+            if self._map is None:
+                return
+            seq = self.written
+            _RECORD.pack_into(self._map, HEADER_SIZE + (seq % self.capacity) * _RECORD.size,
+                              seq & 0xFFFFFFFF, time.monotonic(), kind, a, b, f0, f1, f2, f3)
+            self.written = seq + 1
+            _WRITTEN.pack_into(self._map, _WRITTEN_OFFSET, self.written)
+
+    def frame(self, frame):
+        '''
+        A protocol.Frame as received
+        '''
+        self.record(REC_FRAME, frame.type, len(frame.payload), frame.flags)
+
+    def command(self, cmd):
+        self.record(REC_COMMAND, cmd.op, cmd.seq, cmd.value)
+
+    def velocity(self, velocity, direction, angular_rate):
+        self.record(REC_VELOCITY, 0, 0, velocity, direction, angular_rate)
+
+    def motor(self, index, speed):
+        self.record(REC_MOTOR, index, 0, speed)
+
+    def motors(self, speeds):
+        self.record(REC_MOTORS, 0, 0, *speeds)
+
+    @property
+    def dropped(self):
+        '''
+        Records overwritten because the ring was full
+        '''
+        return max(0, self.written - self.capacity)
+
+    def flush(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+
+
+def read_recording(path):
+    '''
+    :return: (Header, [Record]) with the records that are still in the
+             ring, oldest first
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        raise ValueError("%s: too short for a flight recording" % path)
+    magic, version, record_size, capacity, written, started, started_monotonic = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("%s: not a flight recording" % path)
+    if version != VERSION or record_size != _RECORD.size:
+        raise ValueError("%s: unsupported recording version %d" % (path, version))
+    if len(data) < HEADER_SIZE + capacity * record_size:
+        raise ValueError("%s: truncated recording" % path)
+    header = Header(version, record_size, capacity, written, started, started_monotonic)
+    records = []
+    for seq in range(max(0, written - capacity), written):
+        records.append(Record(*_RECORD.unpack_from(data, HEADER_SIZE + (seq % capacity) * record_size)))
+    return header, records
+
+
+def describe(record):
+    '''
+    One line of text for a Record
+    '''
+    kind = record.kind
+    if kind == REC_FRAME:
+        detail = "type %d flags 0x%02x length %d" % (record.a, int(record.f0), record.b)
+    elif kind == REC_COMMAND:
+        detail = "op %d seq %d value %g" % (record.a, record.b, record.f0)
+    elif kind == REC_VELOCITY:
+        detail = "velocity %g direction %g angular rate %g" % (record.f0, record.f1, record.f2)
+    elif kind == REC_MOTOR:
+        detail = "motor %d speed %d" % (record.a, record.f0)
+    elif kind == REC_MOTORS:
+        detail = "speeds %d %d %d %d" % (record.f0, record.f1, record.f2, record.f3)
+    else:
+        detail = "a %d b %d" % (record.a, record.b)
+    return "%-8s %s" % (KIND_NAMES.get(kind, str(kind)), detail)
+
+
+# The recorder the hooks write to, None when not recording. Hooks read it
+# once per call and skip recording when it is None
+current = None
+
+def start(path, capacity=DEFAULT_CAPACITY):
+    '''
+    Start recording to path, replacing any recording in progress
+    :return: the FlightRecorder
+    '''
+    global current
+    recorder = FlightRecorder(path, capacity)
+    previous, current = current, recorder
+    if previous is not None:
+        previous.close()
+    return recorder
+
+def stop():
+    global current
+    recorder, current = current, None
+    if recorder is not None:
+        recorder.close()
+    return recorder
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# coding=utf8
+import sys
+import json
+import time
+import threading
+
+from metrics import LatencyHistogram, Counters
+
+# Bus transaction statistics for board.py, see board.enableI2CStats().
+# Every transaction is recorded under the register it addressed and the
+# board function that issued it. board.py only calls in here while stats
+# are enabled; disabled, the cost is one global lookup per transaction.
+
+REGISTER_NAMES = {0: 'battery', 40: 'servo_cmd'}
+REGISTER_NAMES.update({21 + i: 'servo%d' % (i + 1) for i in range(6)})
+REGISTER_NAMES.update({31 + i: 'motor%d' % (i + 1) for i in range(4)})
+
+
+def register_name(register):
+    if register is None:
+        return '-'
+    return '%d:%s' % (register, REGISTER_NAMES.get(register, '?'))
+
+
+class I2CStats(object):
+    '''
+    Latency histograms per register and per function, plus counters for
+    transactions, retries, failures and bytes moved. A transaction that
+    succeeds on its retry counts one retry; one that fails twice counts a
+    retry and a failure
+    '''
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = Counters('transactions', 'writes', 'reads', 'retries', 'failures',
+                                 'bytes_written', 'bytes_read')
+        self.by_register = {}
+        self.by_function = {}
+        self.pointer = None   # register of the last write, what a read returns
+        self._lock = threading.Lock()
+        self._dump_stop = None
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = table.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def record(self, kind, function, register, nbytes, seconds, retried=False, failed=False):
+        '''
+        kind: 'write' or 'read'
+        '''
+        counters = self.counters
+        counters.inc('transactions')
+        counters.inc(kind + 's')
+        if retried:
+            counters.inc('retries')
+        if failed:
+            counters.inc('failures')
+        else:
+            counters.inc('bytes_written' if kind == 'write' else 'bytes_read', nbytes)
+        self._histogram(self.by_register, register).record(seconds)
+        self._histogram(self.by_function, function).record(seconds)
+
+    def snapshot(self):
+        '''
+        Everything as plain dicts, ready for json.dumps
+        '''
+        with self._lock:
+            registers = dict(self.by_register)
+            functions = dict(self.by_function)
+        return {
+            'uptime': time.monotonic() - self.started,
+            'counters': self.counters.snapshot(),
+            'registers': {register_name(r): h.snapshot()
+                          for r, h in sorted(registers.items(), key=lambda item: -1 if item[0] is None else item[0])},
+            'functions': {f: h.snapshot() for f, h in sorted(functions.items())},
+        }
+
+    def report(self):
+        with self._lock:
+            registers = dict(self.by_register)
+            functions = dict(self.by_function)
+        lines = ["i2c: %s" % self.counters.summary()]
+        for r, h in sorted(registers.items(), key=lambda item: -1 if item[0] is None else item[0]):
+            lines.append("  reg %-14s %s" % (register_name(r), h.summary()))
+        for f, h in sorted(functions.items()):
+            lines.append("  %-18s %s" % (f, h.summary()))
+        return "\n".join(lines)
+
+    def start_dump(self, interval, path=None, fmt='text'):
+        '''
+        Every interval seconds write report() (fmt 'text') or one JSON
+        snapshot per line (fmt 'json') to path, appending, or to stderr
+        '''
+        if fmt not in ('text', 'json'):
+            raise ValueError("Unknown dump format: %s" % fmt)
+        self.stop_dump()
+        stop = threading.Event()
+        self._dump_stop = stop
+
+        def dump():
+            while not stop.wait(interval):
+                text = json.dumps(self.snapshot()) if fmt == 'json' else self.report()
+                try:
+                    if path is None:
+                        print(text, file=sys.stderr)
+                    else:
+                        with open(path, 'a') as f:
+                            f.write(text + "\n")
+                except Exception as e:
+                    print("I2C stats dump failed: %s" % e)
+
+        threading.Thread(target=dump, name='i2c-stats-dump', daemon=True).start()
+
+    def stop_dump(self):
+        if self._dump_stop is not None:
+            self._dump_stop.set()
+            self._dump_stop = None
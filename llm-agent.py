@@ -2,96 +2,173 @@ import os
 import getpass
 import sys
 import time
-import signal
-import re
 
-# --- Audio Imports ---
-import ggwave
-import pyaudio
+from startup import StartupProfile, Warmup
 
-# --- LangChain and Robot Imports ---
-from langchain_openai import ChatOpenAI
-from langchain.agents import initialize_agent
-from langchain.tools import Tool
-import HiwonderSDK.mecanum as mecanum
+# Startup is profiled by phase. Audio listening and the local fast path
+# are up first; LangChain and the LLM client warm up in the background
+profile = StartupProfile()
 
-# Append custom module path if needed
-sys.path.append('/home/pi/TurboPi/')
+with profile.phase("imports"):
+    import signal
+    import re
+    import asyncio
+    import threading
+    import contextvars
+
+    # --- Audio Imports ---
+    from audio_pipeline import AudioPipeline
+
+    # --- Robot Imports ---
+    import mecanum
+
+    # Append custom module path if needed
+    sys.path.append('/home/pi/TurboPi/')
+    from command_cache import LRUTTLCache, normalize_utterance
+    from metrics import LatencyHistogram, Counters
+    from llm_dispatch import AsyncDispatcher
+    from speed_model import SpeedModel
+    from rgb_renderer import RGBRenderer
+    from motion import (MotionExecutor, Segment, stop_segment, blend_segments, stop_go_duration,
+                        wheel_limit, SETTLE_TIME)
 
 # --- Set OpenAI API Key ---
 if not os.environ.get("OPENAI_API_KEY"):
     os.environ["OPENAI_API_KEY"] = getpass.getpass("Enter your OpenAI API key: ")
 
-# --- Initialize the ChatOpenAI LLM ---
-llm = ChatOpenAI(
-    openai_api_key=os.environ["OPENAI_API_KEY"],
-    model="gpt-4-turbo",
-    temperature=0
-)
+# --- Initialize the ChatOpenAI LLM (in the background) ---
+def build_llm():
+    with profile.phase("langchain imports"):
+        from langchain_openai import ChatOpenAI
+    with profile.phase("llm client"):
+        return ChatOpenAI(
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            model="gpt-4-turbo",
+            temperature=0
+        )
+
+llm = Warmup("llm warm-up", build_llm, profile)
+LLM_WAIT = 60.0  # Seconds a command waits for the LLM to finish warming up
 
 # --- Initialize the chassis ---
-chassis = mecanum.MecanumChassis()
+with profile.phase("chassis"):
+    chassis = mecanum.MecanumChassis()
 start = True
 
 # --- Constants ---
 SPEED = 50              # Speed (0-100)
 FORWARD_DIRECTION = 90  # Forward direction in degrees (90 is forward)
-MAX_SPEED_CMPS = 50     # Maximum speed in cm/s at 100% power
+MAX_SPEED_CMPS = 50     # Uncalibrated speed in cm/s at 100% power
+TURN_RATE = 0.5         # Angular rate used for turns
+TURN_DEGREES = 90       # A "turn left" or "turn right"
+DEDUPE_WINDOW = 3.0     # Seconds an identical decoded command is treated as a repeat
+REQUEST_TIMEOUT = 45.0  # Seconds before a command is given up on
+
+BLEND_SEGMENTS = True   # Turn straight out of the move instead of stopping to settle
+
+# Commands are handled concurrently, the chassis runs one move at a time
+motion_lock = threading.Lock()
 
 # --- Signal Handler for Graceful Exit ---
 def stop_handler(signum, frame):
     global start
     start = False
     print("Stopping robot...")
+    motion_executor.cancel()
     chassis.set_velocity(0, 0, 0)
 
 signal.signal(signal.SIGINT, stop_handler)
 
+# Status LEDs: listening, thinking while the LLM works, moving
+leds = RGBRenderer()
+
+def print_segment(event, motion):
+    if event == "start":
+        leds.set_effect("moving")
+    elif event in ("done", "cancelled"):
+        leds.set_effect("listening")
+    elif event == "segment" and motion.segments[motion.segment].label:
+        print(motion.segments[motion.segment].label)
+
+motion_executor = MotionExecutor(chassis, listener=print_segment).start()
+mission = {"actual": 0.0, "stop_go": 0.0}  # Seconds, for the time saved by blending
+
+# Measured speeds per direction, speed and battery voltage, see
+# calibrate_speed.py. Uncalibrated, a 90 degree turn takes 1.5 seconds
+speed_model = SpeedModel.load(max_speed_cmps=MAX_SPEED_CMPS, turn_dps_per_rate=TURN_DEGREES / 1.5 / TURN_RATE)
+
 # --- Movement Helper Functions ---
-def get_move_duration(distance: int, speed: int = SPEED) -> float:
-    """Calculate movement duration based on distance and speed."""
-    actual_speed = (speed / 100) * MAX_SPEED_CMPS  # in cm/s
-    return distance / actual_speed
+def get_move_duration(distance: int, speed: int = SPEED, direction: int = FORWARD_DIRECTION) -> float:
+    """Calculate movement duration from the calibrated speed at the current battery voltage."""
+    return speed_model.move_duration(distance, speed, direction)
 
-def execute_robot_command(distance: int, turn_direction: str = None) -> str:
+def execute_robot_command(distance: int, turn_direction: str = None, token=None) -> str:
     """
     Execute a robot movement command.
     
     Args:
         distance: Distance to move forward (in cm).
         turn_direction: "left", "right", or None.
+        token: the request's CancelToken. Once it is cancelled, a command
+            still waiting for the chassis is dropped and a running one stopped.
     
     Returns:
         A description of the executed action.
     """
+    if not isinstance(distance, int) or distance <= 0:
+        return "Invalid distance value. Please provide a positive number."
+    if turn_direction and turn_direction.lower() not in ["left", "right"]:
+        return "Invalid turn direction. Use 'left' or 'right'."
+    # Wait for the chassis, but not past the request being given up on
+    while not motion_lock.acquire(timeout=0.1):
+        if token is not None and token.cancelled:
+            return "Cancelled before it started."
+    try:
+        if token is not None and token.cancelled:
+            return "Cancelled before it started."
+        return _execute_robot_command(distance, turn_direction, token)
+    finally:
+        motion_lock.release()
+
+def _execute_robot_command(distance: int, turn_direction: str = None, token=None) -> str:
     try:
-        if not isinstance(distance, int) or distance <= 0:
-            return "Invalid distance value. Please provide a positive number."
-        if turn_direction and turn_direction.lower() not in ["left", "right"]:
-            return "Invalid turn direction. Use 'left' or 'right'."
-        
         duration = get_move_duration(distance)
-        print(f"Moving forward {distance} cm for {duration:.2f} seconds.")
-        chassis.set_velocity(SPEED, FORWARD_DIRECTION, 0)
-        time.sleep(duration)
-        
-        # Stop briefly before turning
-        chassis.set_velocity(0, 0, 0)
-        time.sleep(0.5)
+        segments = [
+            Segment(SPEED, FORWARD_DIRECTION, 0, duration, f"Moving forward {distance} cm for {duration:.2f} seconds."),
+            # Stop briefly before turning
+            stop_segment(SETTLE_TIME),
+        ]
         
         result = f"Moved forward {distance} cm"
         if turn_direction:
             turn_direction = turn_direction.lower()
-            angular_rate = 0.5 if turn_direction == "left" else -0.5
-            print(f"Turning {turn_direction} for 1.5 seconds.")
-            chassis.set_velocity(0, 0, angular_rate)
-            time.sleep(1.5)
-            chassis.set_velocity(0, 0, 0)
-            time.sleep(0.5)
+            angular_rate = TURN_RATE if turn_direction == "left" else -TURN_RATE
+            turn_duration = speed_model.turn_duration(TURN_DEGREES, angular_rate)
+            segments.append(Segment(0, 0, angular_rate, turn_duration, f"Turning {turn_direction} for {turn_duration:.2f} seconds."))
+            segments.append(stop_segment(SETTLE_TIME))
             result += f" and turned {turn_direction}"
         
+        stop_go = stop_go_duration(segments)
+        if BLEND_SEGMENTS:
+            segments = blend_segments(segments, scale=wheel_limit(chassis))
+        motion = motion_executor.submit(segments)
+        # Only this command's motion is queued, motion_lock is held
+        if token is not None:
+            token.add_callback(motion_executor.cancel)
+        try:
+            motion_executor.wait_idle()
+        finally:
+            if token is not None:
+                token.remove_callback(motion_executor.cancel)
+        if motion.state != "done":
+            return result + " (interrupted)."
+        actual = motion.finished_at - motion.started_at
+        mission["actual"] += actual
+        mission["stop_go"] += stop_go
+        print(f"Move took {actual:.2f} s, stop-go {stop_go:.2f} s, saved {mission['stop_go'] - mission['actual']:.2f} s so far")
         return result + "."
     except Exception as e:
+        motion_executor.cancel()
         chassis.set_velocity(0, 0, 0)
         return f"Error executing command: {str(e)}"
 
@@ -112,6 +189,20 @@ def parse_movement_command(command_str: str) -> dict:
     return {"distance": distance, "turn_direction": turn_direction}
 
 # --- Extraction Function Using ChatOpenAI Directly ---
+def extraction_prompt(user_input: str) -> str:
+    return (
+        f"Extract the movement command from the following input: \"{user_input}\"\n\n"
+        "If the input contains a command to move the robot, respond with a structured command in the format:\n"
+        "\"move [distance] cm\" or \"move [distance] cm and turn [left/right]\".\n\n"
+        "If no valid movement command is found, respond with \"No valid movement command found.\""
+    )
+
+def parse_extraction(response) -> str:
+    extracted = response.content.strip()
+    if "No valid movement command found" in extracted:
+        return ""
+    return extracted
+
 def extract_movement_command(user_input: str) -> str:
     """
     Extract a structured movement command from natural language input 
@@ -123,17 +214,113 @@ def extract_movement_command(user_input: str) -> str:
     Returns:
         A structured command like "move 30 cm and turn left", or an empty string if none is found.
     """
-    prompt = (
-        f"Extract the movement command from the following input: \"{user_input}\"\n\n"
-        "If the input contains a command to move the robot, respond with a structured command in the format:\n"
-        "\"move [distance] cm\" or \"move [distance] cm and turn [left/right]\".\n\n"
-        "If no valid movement command is found, respond with \"No valid movement command found.\""
-    )
-    response = llm.invoke([("system", prompt)])
-    extracted = response.content.strip()
-    if "No valid movement command found" in extracted:
-        return ""
-    return extracted
+    response = llm.get(timeout=LLM_WAIT).invoke([("system", extraction_prompt(user_input))])
+    return parse_extraction(response)
+
+async def aextract_movement_command(user_input: str) -> str:
+    """Async version of extract_movement_command, using the model's ainvoke."""
+    client = await asyncio.get_running_loop().run_in_executor(None, llm.get, LLM_WAIT)
+    response = await client.ainvoke([("system", extraction_prompt(user_input))])
+    return parse_extraction(response)
+
+# --- Local Fast Path and Extraction Cache ---
+# Well-formed commands like "move 30 cm and turn left" are parsed locally
+# and never reach the LLM. Anything else goes through the agent. Every
+# structured command the tool extracted for an utterance, in order, is
+# cached by normalized utterance and replayed on a hit; an utterance
+# without any is not cached, so it reaches the LLM again next time. The
+# tool keeps its own cache of single extractions by tool input.
+FAST_PATH_PATTERN = re.compile(
+    r'(?:(?:move|go|drive)\s+)?(?:forward\s+)?(\d+)\s*(?:cm|centimeters?)'
+    r'(?:,?\s+(?:and\s+)?(?:then\s+)?turn\s+(left|right))?'
+)
+CACHE_SIZE = 256
+CACHE_TTL = 3600  # Seconds
+
+command_cache = LRUTTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+extraction_cache = LRUTTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+path_counters = Counters("fast", "cache", "llm", "errors")
+path_latency = {path: LatencyHistogram() for path in ("fast", "cache", "llm")}
+# The structured commands the tool extracted while the agent handled the
+# current utterance, in call order. A list per request, so concurrent
+# requests and LangChain's context copies all see the right one
+extraction = contextvars.ContextVar("extraction", default=None)
+# The CancelToken of the request being handled, for the tool functions
+cancel_token = contextvars.ContextVar("cancel_token", default=None)
+
+def fast_path_command(user_input: str) -> dict:
+    """
+    Parse a well-formed command without the LLM.
+    
+    Returns:
+        Dictionary with keys 'distance' and 'turn_direction', or None.
+    """
+    match = FAST_PATH_PATTERN.fullmatch(normalize_utterance(user_input))
+    if not match:
+        return None
+    return {"distance": int(match.group(1)), "turn_direction": match.group(2)}
+
+def execute_extracted_commands(extracted_commands, token=None) -> str:
+    """Execute the structured commands of one utterance in order, stopping when token is cancelled."""
+    responses = []
+    for extracted_command in extracted_commands:
+        if token is not None and token.cancelled:
+            break
+        responses.append(execute_extracted_command(extracted_command, token))
+    return "\n".join(responses)
+
+def execute_extracted_command(extracted_command: str, token=None) -> str:
+    """Parse and execute a structured command, e.g. "move 30 cm and turn left"."""
+    if not extracted_command:
+        return "No valid movement command detected."
+    params = parse_movement_command(extracted_command)
+    if params["distance"] is None:
+        return "Extracted command is missing a valid distance."
+    return execute_robot_command(distance=params["distance"], turn_direction=params["turn_direction"], token=token)
+
+async def handle_command(command: str, token=None) -> str:
+    """
+    Run one decoded command through the fast path, the cache or the agent.
+    Moves run on worker threads, the agent and LLM calls are awaited.
+    token is the dispatcher's CancelToken for the request.
+    """
+    loop = asyncio.get_running_loop()
+    cancel_token.set(token)
+    key = normalize_utterance(command)
+    start_time = time.perf_counter()
+    params = fast_path_command(key)
+    if params is not None:
+        path = "fast"
+        response = await loop.run_in_executor(None, lambda: execute_robot_command(**params, token=token))
+    else:
+        extracted = command_cache.get(key)
+        if extracted is not None:
+            path = "cache"
+            response = await loop.run_in_executor(None, execute_extracted_commands, extracted, token)
+        else:
+            path = "llm"
+            found = []
+            extraction.set(found)
+            leds.set_effect("thinking")
+            try:
+                executor = await loop.run_in_executor(None, agent.get, LLM_WAIT)
+                response = await executor.arun(command)
+            finally:
+                leds.set_effect("listening")
+            commands = tuple(command for command in found if command)
+            if commands:
+                command_cache.put(key, commands)
+    path_counters.inc(path)
+    path_latency[path].record(time.perf_counter() - start_time)
+    return response
+
+def command_stats() -> str:
+    """Hit/miss counters and per-path latency, one line each."""
+    lines = [f"paths: {path_counters.summary()}", f"cache: {command_cache.stats()}",
+             f"tool cache: {extraction_cache.stats()}"]
+    for path, histogram in path_latency.items():
+        lines.append(f"{path:>5}: {histogram.summary()}")
+    return "\n".join(lines)
 
 # --- Define the Tool Function ---
 def robot_movement_tool_function(user_input: str) -> str:
@@ -146,59 +333,104 @@ def robot_movement_tool_function(user_input: str) -> str:
     Returns:
         Result of executing the movement command.
     """
-    extracted_command = extract_movement_command(user_input)
-    if not extracted_command:
-        return "No valid movement command detected."
-    params = parse_movement_command(extracted_command)
-    if params["distance"] is None:
-        return "Extracted command is missing a valid distance."
-    return execute_robot_command(distance=params["distance"], turn_direction=params["turn_direction"])
-
-# --- Create a Tool for robot movement ---
-robot_movement_tool = Tool(
-    name="RobotMovement",
-    func=robot_movement_tool_function,
-    description=(
-        "Executes robot movement commands. Input should be a natural language "
-        "instruction that includes a distance (in cm) and an optional turn direction (left or right)."
+    key = normalize_utterance(user_input)
+    extracted_command = extraction_cache.get(key)
+    if extracted_command is None:
+        extracted_command = extract_movement_command(user_input)
+        if extracted_command:
+            extraction_cache.put(key, extracted_command)
+    found = extraction.get()
+    if found is not None:
+        found.append(extracted_command)
+    return execute_extracted_command(extracted_command, cancel_token.get())
+
+async def robot_movement_tool_coroutine(user_input: str) -> str:
+    """Async version of robot_movement_tool_function, used by agent.arun."""
+    key = normalize_utterance(user_input)
+    extracted_command = extraction_cache.get(key)
+    if extracted_command is None:
+        extracted_command = await aextract_movement_command(user_input)
+        if extracted_command:
+            extraction_cache.put(key, extracted_command)
+    found = extraction.get()
+    if found is not None:
+        found.append(extracted_command)
+    return await asyncio.get_running_loop().run_in_executor(None, execute_extracted_command, extracted_command,
+                                                            cancel_token.get())
+
+def build_agent():
+    with profile.phase("langchain imports"):
+        from langchain.agents import initialize_agent
+        from langchain.tools import Tool
+
+    # --- Create a Tool for robot movement ---
+    robot_movement_tool = Tool(
+        name="RobotMovement",
+        func=robot_movement_tool_function,
+        coroutine=robot_movement_tool_coroutine,
+        description=(
+            "Executes robot movement commands. Input should be a natural language "
+            "instruction that includes a distance (in cm) and an optional turn direction (left or right)."
+        )
     )
-)
 
-# --- Initialize the Agent using initialize_agent ---
-agent = initialize_agent(
-    tools=[robot_movement_tool],
-    llm=llm,
-    agent="zero-shot-react-description",
-    verbose=True
-)
+    # --- Initialize the Agent using initialize_agent ---
+    with profile.phase("agent"):
+        return initialize_agent(
+            tools=[robot_movement_tool],
+            llm=llm.get(),
+            agent="zero-shot-react-description",
+            verbose=True
+        )
+
+agent = Warmup("agent warm-up", build_agent, profile)
+
+# Repeated or echoed decodes of the same command share one response
+dispatcher = AsyncDispatcher(handle_command, dedupe_window=DEDUPE_WINDOW, timeout=REQUEST_TIMEOUT)
+
+def report_response(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        path_counters.inc("errors")
+        print("Error processing command:", error)
+    else:
+        print("Agent Response:", future.result())
 
-# --- Set up audio receiver using ggwave and pyaudio ---
-p_audio = pyaudio.PyAudio()
-stream = p_audio.open(format=pyaudio.paFloat32, channels=1, rate=48000, input=True, frames_per_buffer=1024)
-print("Listening for audio commands... Press Ctrl+C to stop.")
-instance = ggwave.init()
+def on_audio_command(command):
+    print("Received text command: " + command)
+    # Process command locally if possible, otherwise using the agent.
+    # Never blocks, the response is printed when it is ready
+    dispatcher.submit(command).add_done_callback(report_response)
 
 # --- Main Loop ---
 if __name__ == "__main__":
+    # Capture, ggwave decoding and command handling run on separate
+    # threads, so audio keeps being captured while the LLM is busy
+    with profile.phase("audio start"):
+        dispatcher.start()
+        leds.start().set_effect("listening")
+        pipeline = AudioPipeline(on_audio_command).start()
+    print("Listening for audio commands... Press Ctrl+C to stop.")
+    llm.start()
+    agent.start()
+    reported = False
     try:
         while start:
-            data = stream.read(1024, exception_on_overflow=False)
-            res = ggwave.decode(instance, data)
-            if res is not None:
-                try:
-                    command = res.decode("utf-8")
-                    print("Received text command: " + command)
-                    # Process command using the agent
-                    response = agent.run(command)
-                    print("Agent Response:", response)
-                except Exception as e:
-                    print("Error processing command:", e)
+            time.sleep(0.2)
+            if not reported and agent.wait(0):
+                reported = True
+                print(profile.report())
     except KeyboardInterrupt:
         pass
     finally:
-        ggwave.free(instance)
-        stream.stop_stream()
-        stream.close()
-        p_audio.terminate()
+        pipeline.stop()
+        dispatcher.stop()
+        motion_executor.stop()
+        leds.stop()
         chassis.set_velocity(0, 0, 0)
+        print(pipeline.report())
+        print(dispatcher.report())
+        print(command_stats())
         print("Command processor terminated.")
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import asyncio
+import threading
+
+from command_cache import normalize_utterance
+from metrics import LatencyHistogram, Counters
+
+# Asyncio dispatch of decoded commands for llm-agent.py. ggwave often
+# decodes a repeated or echoed transmission more than once; copies that
+# arrive while the first is still being handled share its result
+# (coalesced), and copies that arrive within dedupe_window seconds of it
+# finishing get its result without running again (deduped). Every request
+# is bounded by timeout, so a slow API never backs up the listener.
+#
+# Giving up on a coroutine does not stop work it handed to a thread, so
+# every request carries a CancelToken. The dispatcher cancels it on
+# timeout or cancel(), and worker code checks it before it moves the
+# robot and cancels the move when it fires.
+
+DEDUPE_WINDOW = 3.0     # Seconds
+REQUEST_TIMEOUT = 45.0  # Seconds
+
+
+class CancelToken(object):
+    '''
+    Cancelled by cancel() or once deadline (monotonic seconds) passes.
+    Callbacks added with add_callback() run once, on cancel()
+    '''
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print("Cancel callback error: %s" % e)
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None):
+        '''
+        True once cancel() was called
+        '''
+        return self._event.wait(timeout)
+
+
+class AsyncDispatcher(object):
+    '''
+    Runs handler(text, token) coroutines on an event loop thread, token
+    being the request's CancelToken.
+
+        dispatcher = AsyncDispatcher(handle).start()
+        future = dispatcher.submit("move 30 cm")   # concurrent.futures.Future
+        ...
+        dispatcher.stop()
+
+    submit() never blocks. Requests are keyed by key(text), normalized
+    utterance by default. At most max_concurrent handlers run at once
+    '''
+    def __init__(self, handler, key=normalize_utterance, dedupe_window=DEDUPE_WINDOW,
+                 timeout=REQUEST_TIMEOUT, max_concurrent=4):
+        self.handler = handler
+        self.key = key
+        self.dedupe_window = dedupe_window
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.latency = LatencyHistogram()
+        self.counters = Counters('submitted', 'coalesced', 'deduped', 'completed',
+                                 'timeouts', 'errors', 'cancelled')
+        self._recent = {}   # key -> [finished_at or None, task], touched on the loop thread only
+        self._in_flight = 0  # written on the loop thread only, read from any
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), name='llm-dispatch', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self, timeout=2.0):
+        '''
+        Cancel whatever is in flight and stop the loop, waiting at most
+        timeout seconds. Moves already handed to worker threads are
+        stopped through their CancelTokens
+        '''
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, text):
+        return asyncio.run_coroutine_threadsafe(self._dispatch(text), self._loop)
+
+    def cancel(self):
+        '''
+        Cancel every request in flight
+        '''
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel_all)
+
+    def in_flight(self):
+        '''
+        Requests being handled, safe to call from any thread
+        '''
+        return self._in_flight
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        ready.set()
+        try:
+            self._loop.run_forever()
+            pending = asyncio.all_tasks(self._loop)
+            if pending:
+                self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            self._loop.close()
+
+    def _shutdown(self):
+        self._cancel_all()
+        self._loop.stop()
+
+    def _cancel_all(self):
+        for _, task in list(self._recent.values()):
+            task.cancel()
+
+    async def _dispatch(self, text):
+        key = self.key(text)
+        now = time.monotonic()
+        self.counters.inc('submitted')
+        self._prune(now)
+        recent = self._recent.get(key)
+        if recent is not None:
+            finished_at, task = recent
+            if not task.done():
+                self.counters.inc('coalesced')
+                return await asyncio.shield(task)
+            # finished_at is set by a done callback that may not have run yet
+            if finished_at is None or now - finished_at <= self.dedupe_window:
+                self.counters.inc('deduped')
+                return await task
+        task = self._loop.create_task(self._handle(text))
+        entry = [None, task]
+        self._recent[key] = entry
+        self._in_flight += 1
+
+        def finished(_):
+            # The dedupe window runs from when the request finished, so a
+            # long move is not run again by a copy decoded right after it
+            entry[0] = time.monotonic()
+            self._in_flight -= 1
+        task.add_done_callback(finished)
+        # A caller giving up on its future must not cancel the shared task
+        return await asyncio.shield(task)
+
+    def _prune(self, now):
+        for key in [k for k, (t, task) in self._recent.items()
+                    if task.done() and t is not None and now - t > self.dedupe_window]:
+            del self._recent[key]
+
+    async def _handle(self, text):
+        t0 = time.perf_counter()
+        token = CancelToken(time.monotonic() + self.timeout)
+        try:
+            result = await asyncio.wait_for(self._limited(text, token), self.timeout)
+        except asyncio.TimeoutError:
+            token.cancel()
+            self.counters.inc('timeouts')
+            raise TimeoutError("no response within %.1f s" % self.timeout)
+        except asyncio.CancelledError:
+            token.cancel()
+            self.counters.inc('cancelled')
+            raise
+        except Exception:
+            self.counters.inc('errors')
+            raise
+        finally:
+            self.latency.record(time.perf_counter() - t0)
+        self.counters.inc('completed')
+        return result
+
+    async def _limited(self, text, token):
+        async with self._semaphore:
+            return await self.handler(text, token)
+
+    def report(self):
+        return "dispatch: %s\n  latency: %s" % (self.counters.summary(), self.latency.summary())
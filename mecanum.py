@@ -5,7 +5,263 @@ sys.path.append('/home/pi/TurboPi/')
 import math
 import time
 import threading
+import collections
 import board as Board
+import flight_recorder
+
+Pose = collections.namedtuple('Pose', ['t', 'x', 'y', 'theta'])
+
+class Odometry:
+    """
+    Dead-reckoning pose from the commanded wheel values.
+
+    The pose is (x, y, theta) in mm and radians, in the frame the robot
+    started in: y is forward, x is to the right and theta is the heading,
+    positive counter-clockwise (so the opposite sign of angular_rate).
+    Wheel values are held between updates; update() integrates the
+    previous ones over the elapsed time and then takes the new ones, so
+    it only needs calling when the wheels change. Each update is O(1).
+    """
+
+    def __init__(self, a=67, b=59, wheel_diameter=65, max_wheel_speed=15.4, history=512):
+        """
+        :param max_wheel_speed: wheel speed at motor value 100, rad/s. The
+                                default is about 50 cm/s over a 65 mm wheel
+        :param history: number of poses kept by history()
+        """
+        self.a = a
+        self.b = b
+        self.wheel_diameter = wheel_diameter
+        self.max_wheel_speed = max_wheel_speed
+        self._history = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, x=0.0, y=0.0, theta=0.0):
+        with self._lock:
+            self._t = time.monotonic()
+            self._x = float(x)
+            self._y = float(y)
+            self._theta = float(theta)
+            self._body = (0.0, 0.0, 0.0)
+            self._history.clear()
+            self._history.append(Pose(self._t, self._x, self._y, self._theta))
+
+    def body_velocity(self, wheels):
+        """
+        Forward kinematics of set_velocity's wheel equations
+        :param wheels: (v1, v2, v3, v4) motor values
+        :return: (vx, vy) in mm/s and the counter-clockwise turn rate in rad/s
+        """
+        v1, v2, v3, v4 = wheels
+        scale = self.max_wheel_speed * self.wheel_diameter / 200.0  # mm/s per motor value
+        vx = (v1 - v2 - v3 + v4) * scale / 4
+        vy = (v1 + v2 + v3 + v4) * scale / 4
+        omega = -(v1 - v2 + v3 - v4) * scale / (4 * (self.a + self.b))
+        return vx, vy, omega
+
+    def _advance(self, now):
+        dt = now - self._t
+        if dt <= 0:
+            return
+        vx, vy, omega = self._body
+        if vx or vy or omega:
+            # Exact for constant wheel speeds: the chord of the arc, along
+            # the mean heading
+            half = omega * dt / 2
+            chord = math.sin(half) / half if half else 1.0
+            heading = self._theta + half
+            c, s = math.cos(heading), math.sin(heading)
+            self._x += (vx * c - vy * s) * dt * chord
+            self._y += (vx * s + vy * c) * dt * chord
+            self._theta = math.atan2(math.sin(self._theta + 2 * half), math.cos(self._theta + 2 * half))
+        self._t = now
+
+    def update(self, wheels, now=None):
+        """
+        Integrate up to now, then drive on with wheels
+        """
+        body = self.body_velocity(wheels)
+        with self._lock:
+            self._advance(time.monotonic() if now is None else now)
+            self._body = body
+            self._history.append(Pose(self._t, self._x, self._y, self._theta))
+
+    def pose(self, now=None):
+        """
+        :return: Pose at now (default: the current time)
+        """
+        with self._lock:
+            self._advance(time.monotonic() if now is None else now)
+            return Pose(self._t, self._x, self._y, self._theta)
+
+    def velocity(self):
+        """
+        :return: (vx, vy, omega) currently being integrated, see body_velocity
+        """
+        with self._lock:
+            return self._body
+
+    def history(self):
+        """
+        :return: list of Poses at the most recent updates, oldest first
+        """
+        with self._lock:
+            return list(self._history)
+
+
+class ControlLoop:
+    """
+    Fixed-rate wheel setpoint slewing, see MecanumChassis.start_control_loop.
+
+    Each tick moves every wheel value toward its target, limited by
+    max_accel (value change per second) and, if set, max_jerk (change of
+    that rate per second). A wheel is only written when its integer value
+    changes. Ticks are scheduled on monotonic deadlines; a tick that starts
+    more than one period late is counted as an overrun and the schedule
+    restarts from now instead of bursting to catch up.
+    """
+
+    def __init__(self, rate=100, max_accel=400, max_jerk=None, odometry=None):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.max_accel = max_accel
+        self.max_jerk = max_jerk
+        self.odometry = odometry
+        self._target = [0.0, 0.0, 0.0, 0.0]
+        self._value = [0.0, 0.0, 0.0, 0.0]
+        self._slope = [0.0, 0.0, 0.0, 0.0]
+        self._written = [0, 0, 0, 0]
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.writes = 0
+        self.overruns = 0
+        self._jitter_sum = 0.0
+        self._jitter_sq = 0.0
+        self.jitter_max = 0.0
+        self.work_max = 0.0
+
+    def stats(self):
+        """
+        :return: dict with ticks, writes, overruns, jitter mean/std/max and
+                 the longest tick, times in seconds
+        """
+        n = self.ticks or 1
+        mean = self._jitter_sum / n
+        std = math.sqrt(max(0.0, self._jitter_sq / n - mean * mean))
+        return {
+            'rate': self.rate,
+            'ticks': self.ticks,
+            'writes': self.writes,
+            'overruns': self.overruns,
+            'jitter_mean': mean,
+            'jitter_std': std,
+            'jitter_max': self.jitter_max,
+            'work_max': self.work_max,
+        }
+
+    @property
+    def target(self):
+        return list(self._target)
+
+    def set_target(self, wheels):
+        with self._lock:
+            self._target = [float(v) for v in wheels]
+
+    def reset(self, wheels=(0, 0, 0, 0)):
+        """
+        Jump straight to wheels, without ramping
+        """
+        with self._lock:
+            self._target = [float(v) for v in wheels]
+            self._value = list(self._target)
+            self._slope = [0.0, 0.0, 0.0, 0.0]
+            self._written = [int(v) for v in wheels]
+
+    def start(self):
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='chassis-control', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _slew(self, i, dt):
+        err = self._target[i] - self._value[i]
+        if err == 0 and self._slope[i] == 0:
+            return
+        direction = 1.0 if err > 0 else -1.0
+        wanted = self.max_accel
+        if self.max_jerk:
+            # Slow down early enough to arrive with zero slope
+            wanted = min(wanted, math.sqrt(2 * self.max_jerk * abs(err)))
+            step = self.max_jerk * dt
+            slope = self._slope[i] + max(-step, min(step, direction * wanted - self._slope[i]))
+        else:
+            slope = direction * wanted
+        move = slope * dt
+        if abs(move) >= abs(err) and move * err >= 0:
+            self._value[i] = self._target[i]
+            self._slope[i] = 0.0
+        else:
+            self._value[i] += move
+            self._slope[i] = slope
+
+    def tick(self, dt):
+        """
+        Advance one tick of dt seconds and write the wheels that changed.
+        The write happens under the lock, so reset() waits for a tick in
+        flight and a stop written after it is never overwritten by it
+        """
+        with self._lock:
+            for i in range(4):
+                self._slew(i, dt)
+            wheels = [int(v) for v in self._value]
+            changed = [i for i in range(4) if wheels[i] != self._written[i]]
+            self._written = wheels
+            if changed and self.odometry is not None:
+                self.odometry.update(wheels)
+            if len(changed) == 1:
+                Board.setMotor(changed[0] + 1, wheels[changed[0]])
+                self.writes += 1
+            elif changed:
+                Board.setMotors(*wheels)
+                self.writes += 1
+
+    def _run(self):
+        deadline = time.monotonic()
+        while self._running:
+            now = time.monotonic()
+            if deadline > now:
+                time.sleep(deadline - now)
+                now = time.monotonic()
+            jitter = now - deadline
+            self.ticks += 1
+            self._jitter_sum += jitter
+            self._jitter_sq += jitter * jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+            try:
+                self.tick(self.period)
+            except Exception as e:
+                print("Control loop error: %s" % e)
+            done = time.monotonic()
+            self.work_max = max(self.work_max, done - now)
+            deadline += self.period
+            if done > deadline + self.period:
+                self.overruns += 1
+                deadline = done
+
 
 class MecanumChassis:
     # A = 67  # mm
@@ -19,15 +275,66 @@ class MecanumChassis:
         self.velocity = 0
         self.direction = 0
         self.angular_rate = 0
+        self.control_loop = None
+        self.odometry = Odometry(a, b, wheel_diameter)
+
+    def start_control_loop(self, rate=100, max_accel=400, max_jerk=None):
+        """
+        From now on set_velocity only sets a target and a background thread
+        ramps the wheels toward it
+        :param rate: loop rate, Hz, 50~200 is sensible on the Pi
+        :param max_accel: max change of a wheel value (-100~100) per second
+        :param max_jerk: max change of that rate per second, None for no limit
+        :return: the ControlLoop, see ControlLoop.stats()
+        """
+        if self.control_loop is None:
+            self.control_loop = ControlLoop(rate, max_accel, max_jerk, self.odometry)
+            self.control_loop.reset(self._wheels(self.velocity, self.direction, self.angular_rate))
+            self.control_loop.start()
+        return self.control_loop
+
+    def stop_control_loop(self):
+        """
+        Stop the loop and write the current target directly
+        """
+        loop = self.control_loop
+        if loop is not None:
+            self.control_loop = None
+            loop.stop()
+            wheels = [int(v) for v in loop.target]
+            Board.setMotors(*wheels)
+            self.odometry.update(wheels)
+
+    def pose(self):
+        """
+        Dead-reckoned pose since start or the last odometry.reset()
+        :return: Pose(t, x, y, theta), mm and radians, theta counter-clockwise
+        """
+        return self.odometry.pose()
 
     def reset_motors(self):
-        for i in range(1, 5):
-            Board.setMotor(i, 0)
-            
+        # Stopping is never ramped. reset() returns once a tick in flight
+        # has written, so the zeros below are the last write
+        if self.control_loop is not None:
+            self.control_loop.reset()
+        Board.setMotors(0, 0, 0, 0)
+        self.odometry.update((0, 0, 0, 0))
+
         self.velocity = 0
         self.direction = 0
         self.angular_rate = 0
 
+    def _wheels(self, velocity, direction, angular_rate):
+        rad_per_deg = math.pi / 180
+        vx = velocity * math.cos(direction * rad_per_deg)
+        vy = velocity * math.sin(direction * rad_per_deg)
+        vp = -angular_rate * (self.a + self.b)
+        v1 = int(vy + vx - vp) 
+        v2 = int(vy - vx + vp)
+        v3 = int(vy - vx - vp)
+        v4 = int(vy + vx + vp)
+        return v1, v2, v3, v4
+
     def set_velocity(self, velocity, direction, angular_rate, fake=False):
         """
         Use polar coordinates to control moving
@@ -37,23 +344,20 @@ class MecanumChassis:
         :param velocity: mm/s
         :param direction: Moving direction 0~360deg, 180deg<--- ↑ ---> 0deg
         :param angular_rate:  The speed at which the chassis rotates
-        :param fake:
-        :return:
+        :param fake: only compute the wheel speeds, do not drive the motors
+        :return: (v1, v2, v3, v4) when fake
         """
-        rad_per_deg = math.pi / 180
-        vx = velocity * math.cos(direction * rad_per_deg)
-        vy = velocity * math.sin(direction * rad_per_deg)
-        vp = -angular_rate * (self.a + self.b)
-        v1 = int(vy + vx - vp) 
-        v2 = int(vy - vx + vp)
-        v3 = int(vy - vx - vp)
-        v4 = int(vy + vx + vp)
+        v1, v2, v3, v4 = self._wheels(velocity, direction, angular_rate)
         if fake:
-            return
-        Board.setMotor(1, v1)
-        Board.setMotor(2, v2)
-        Board.setMotor(3, v3)
-        Board.setMotor(4, v4)
+            return v1, v2, v3, v4
+        recorder = flight_recorder.current
+        if recorder is not None:
+            recorder.velocity(velocity, direction, angular_rate)
+        if self.control_loop is not None:
+            self.control_loop.set_target((v1, v2, v3, v4))
+        else:
+            Board.setMotors(v1, v2, v3, v4)
+            self.odometry.update((v1, v2, v3, v4))
         self.velocity = velocity
         self.direction = direction
         self.angular_rate = angular_rate
@@ -78,3 +382,81 @@ class MecanumChassis:
         else:
             return self.set_velocity(velocity, direction, 0)
 
+    # Batch kinematics for planning and previews. NumPy is only imported
+    # when one of these is called, the robot itself does not need it.
+    #
+    # With vp = -angular_rate * (a + b) as in set_velocity:
+    #   v1 =  vx + vy + (a + b) * angular_rate
+    #   v2 = -vx + vy - (a + b) * angular_rate
+    #   v3 = -vx + vy + (a + b) * angular_rate
+    #   v4 =  vx + vy - (a + b) * angular_rate
+
+    def inverse_kinematics_matrix(self):
+        """
+        :return: 4x3 matrix mapping (vx, vy, angular_rate) to (v1, v2, v3, v4)
+        """
+        import numpy as np
+        key = (self.a, self.b)
+        if getattr(self, '_ik_key', None) != key:
+            k = self.a + self.b
+            self._ik = np.array([[1.0, 1.0, k],
+                                 [-1.0, 1.0, -k],
+                                 [-1.0, 1.0, k],
+                                 [1.0, 1.0, -k]])
+            self._fk = np.linalg.pinv(self._ik)
+            self._ik_key = key
+        return self._ik
+
+    def forward_kinematics_matrix(self):
+        """
+        :return: 3x4 least-squares inverse of inverse_kinematics_matrix
+        """
+        self.inverse_kinematics_matrix()
+        return self._fk
+
+    def wheel_speeds_batch(self, velocity, direction, angular_rate, rad_per_s=False):
+        """
+        Vectorized set_velocity(..., fake=True)
+        :param velocity: N velocities, mm/s
+        :param direction: N directions, deg
+        :param angular_rate: N angular rates
+        :param rad_per_s: return float wheel speeds in rad/s (velocity over
+                          wheel radius) instead of the truncated motor values
+        :return: Nx4 array of (v1, v2, v3, v4), int unless rad_per_s
+        """
+        import numpy as np
+        velocity, direction, angular_rate = np.broadcast_arrays(
+            np.asarray(velocity, dtype=float),
+            np.asarray(direction, dtype=float),
+            np.asarray(angular_rate, dtype=float))
+        rad = np.radians(direction)
+        body = np.stack([velocity * np.cos(rad), velocity * np.sin(rad), angular_rate], axis=-1)
+        wheels = body.reshape(-1, 3) @ self.inverse_kinematics_matrix().T
+        if rad_per_s:
+            return wheels / (self.wheel_diameter / 2.0)
+        return np.trunc(wheels).astype(int)
+
+    def body_velocity_batch(self, wheels, rad_per_s=False):
+        """
+        Forward kinematics, the inverse of wheel_speeds_batch
+        :param wheels: Nx4 array of (v1, v2, v3, v4)
+        :param rad_per_s: wheels are in rad/s rather than motor values
+        :return: Nx3 array of (vx, vy, angular_rate)
+        """
+        import numpy as np
+        wheels = np.asarray(wheels, dtype=float).reshape(-1, 4)
+        if rad_per_s:
+            wheels = wheels * (self.wheel_diameter / 2.0)
+        return wheels @ self.forward_kinematics_matrix().T
+
+    def translation_batch(self, velocity_x, velocity_y):
+        """
+        Vectorized translation(..., fake=True)
+        :return: (velocity, direction) arrays, direction in 0~360deg
+        """
+        import numpy as np
+        velocity_x = np.asarray(velocity_x, dtype=float)
+        velocity_y = np.asarray(velocity_y, dtype=float)
+        velocity = np.hypot(velocity_x, velocity_y)
+        direction = np.degrees(np.arctan2(velocity_y, velocity_x)) % 360
+        return velocity, direction
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# coding=utf8
+import bisect
+import threading
+
+# Latency histograms and counters shared by the robot and controller code.
+# Times are in seconds.
+
+# 1-2-5 steps from 10 us to 100 s
+DEFAULT_BOUNDS = [m * 10.0 ** e for e in range(-5, 2) for m in (1, 2, 5)] + [100.0]
+
+
+class LatencyHistogram(object):
+    '''
+    Fixed-bucket histogram. record() is O(log buckets) under a lock.
+    Percentiles are the upper bound of the bucket they fall in, clamped
+    to the largest sample seen
+    '''
+    def __init__(self, bounds=None):
+        self.bounds = list(bounds or DEFAULT_BOUNDS)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.buckets = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+
+    def record(self, seconds):
+        with self._lock:
+            self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = self.count * p / 100.0
+            seen = 0
+            for i, n in enumerate(self.buckets):
+                seen += n
+                if n and seen >= rank:
+                    bound = self.bounds[i] if i < len(self.bounds) else self.max
+                    return min(bound, self.max)
+            return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min or 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max or 0.0,
+        }
+
+    def summary(self):
+        s = self.snapshot()
+        return "n=%d mean=%s p50=%s p90=%s p99=%s max=%s" % (
+            s['count'], format_seconds(s['mean']), format_seconds(s['p50']),
+            format_seconds(s['p90']), format_seconds(s['p99']), format_seconds(s['max']))
+
+
+class Counters(object):
+    '''
+    Named integer counters, safe to bump from several threads
+    '''
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + n
+
+    def __getitem__(self, name):
+        return self._values.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def summary(self):
+        return " ".join("%s=%d" % item for item in sorted(self.snapshot().items()))
+
+
+def format_seconds(seconds):
+    if seconds < 1e-3:
+        return "%.0fus" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1e3)
+    return "%.2fs" % seconds
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+# coding=utf8
+import math
+import time
+import queue
+import threading
+import collections
+
+# A motion is a list of segments. Each segment holds one chassis velocity
+# (see MecanumChassis.set_velocity) for duration seconds.
+Segment = collections.namedtuple('Segment', ['velocity', 'direction', 'angular_rate', 'duration', 'label'])
+Segment.__new__.__defaults__ = ('',)
+
+APPEND = 'append'    # run after everything already queued
+REPLACE = 'replace'  # drop the queue and preempt the running motion
+
+SETTLE_TIME = 0.5     # the stop-and-settle pause stop-go plans put after every move
+BLEND_OVERLAP = 0.3   # seconds consecutive moves may overlap when blended
+# A blend scaled down by k takes overlap / k seconds to cover the same
+# ground, so below 0.5 it would take longer than not overlapping at all
+MIN_BLEND_SCALE = 0.5
+
+def stop_segment(duration, label=''):
+    return Segment(0, 0, 0, duration, label)
+
+def is_stop(segment):
+    return not segment.velocity and not segment.angular_rate
+
+def stop_go_duration(segments, settle=SETTLE_TIME):
+    '''
+    How long segments take run stop-go: every moving segment followed by a
+    settle pause, plus any longer pauses
+    '''
+    total = 0.0
+    for segment in segments:
+        if not is_stop(segment):
+            total += segment.duration + settle
+        elif segment.duration > settle:
+            total += segment.duration
+    return total
+
+def _combine(a, b):
+    # Sum of two chassis velocities, body frame
+    ax = a.velocity * math.cos(math.radians(a.direction))
+    ay = a.velocity * math.sin(math.radians(a.direction))
+    bx = b.velocity * math.cos(math.radians(b.direction))
+    by = b.velocity * math.sin(math.radians(b.direction))
+    vx, vy = ax + bx, ay + by
+    velocity = math.hypot(vx, vy)
+    direction = math.degrees(math.atan2(vy, vx)) % 360 if velocity else 0
+    return velocity, direction, a.angular_rate + b.angular_rate
+
+def blend_segments(segments, overlap=BLEND_OVERLAP, settle=SETTLE_TIME, scale=None):
+    '''
+    Turn a stop-go plan into a continuous one. Stops of at most settle
+    seconds are dropped; longer ones are kept as pauses. Consecutive
+    moves overlap by up to overlap seconds (at most half of either),
+    driving the sum of both velocities, e.g. still translating while the
+    turn starts. Distances and angles are unchanged and only the corner
+    is rounded.
+
+    scale(velocity, direction, angular_rate) gives the factor, at most 1,
+    a combined velocity has to be scaled by to be driven, see
+    wheel_limit. A scaled blend is stretched to overlap / factor seconds
+    so both moves still cover their ground. Junctions that would need a
+    factor below MIN_BLEND_SCALE go from one move to the next without
+    overlapping
+    '''
+    items = [s for s in segments if not is_stop(s) or s.duration > settle]
+    overlaps = []
+    for a, b in zip(items, items[1:]):
+        t, k = 0.0, 1.0
+        if overlap > 0 and not is_stop(a) and not is_stop(b):
+            k = 1.0 if scale is None else min(1.0, scale(*_combine(a, b)))
+            if k >= MIN_BLEND_SCALE:
+                t = min(overlap, a.duration / 2, b.duration / 2)
+        overlaps.append((t, k))
+    blended = []
+    for i, segment in enumerate(items):
+        before = overlaps[i - 1][0] if i else 0.0
+        after, k = overlaps[i] if i < len(overlaps) else (0.0, 1.0)
+        core = segment.duration - before - after
+        if core > 0:
+            # With a blend before it, the label was already shown there
+            blended.append(segment._replace(duration=core, label='' if before else segment.label))
+        if after:
+            following = items[i + 1]
+            velocity, direction, angular_rate = _combine(segment, following)
+            blended.append(Segment(velocity * k, direction, angular_rate * k, after / k, following.label))
+    return blended
+
+def wheel_limit(chassis, limit=100):
+    '''
+    scale() for blend_segments: the factor that brings every wheel value
+    within limit. Wheel values are linear in velocity and angular rate
+    '''
+    def scale(velocity, direction, angular_rate):
+        wheels = chassis.set_velocity(velocity, direction, angular_rate, fake=True)
+        peak = max(abs(v) for v in wheels)
+        return min(1.0, limit / peak) if peak else 1.0
+    return scale
+
+
+class Motion(object):
+    '''
+    A submitted motion and its progress. state is one of
+    queued, running, done or cancelled
+    '''
+    def __init__(self, segments, tag=None):
+        self.segments = list(segments)
+        self.tag = tag
+        self.state = 'queued'
+        self.segment = -1
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def duration(self):
+        return sum(s.duration for s in self.segments)
+
+    def __repr__(self):
+        return 'Motion(tag=%r, state=%s, segments=%d)' % (self.tag, self.state, len(self.segments))
+
+
+class MotionExecutor(object):
+    '''
+    Runs motions on its own thread so the caller never blocks on a move.
+
+    Segment end times are deadlines on the monotonic clock measured from the
+    start of the motion, so they do not drift the way chained sleeps do.
+    The waits are on a condition variable, so replace and cancel take
+    effect immediately instead of after the current sleep.
+
+    listener(event, motion) is called from the executor thread with event
+    'start', 'segment', 'done' or 'cancelled'.
+    '''
+    def __init__(self, chassis, maxsize=16, listener=None):
+        self.chassis = chassis
+        self.maxsize = maxsize
+        self.listener = listener
+        self._queue = collections.deque()
+        self._current = None
+        self._preempt = False
+        self._running = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='motion-executor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        '''
+        Cancel everything, stop the chassis and end the executor thread
+        '''
+        with self._cond:
+            self._running = False
+            dropped = self._drop_queue()
+            self._preempt = True
+            self._cond.notify_all()
+        self._cancelled(dropped)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.chassis.set_velocity(0, 0, 0)
+
+    def submit(self, segments, mode=APPEND, tag=None):
+        '''
+        Queue a motion and return its Motion. Raises queue.Full when
+        maxsize motions are already waiting
+        '''
+        motion = Motion(segments, tag)
+        dropped = []
+        with self._cond:
+            if mode == REPLACE:
+                dropped = self._drop_queue()
+                if self._current is not None:
+                    self._preempt = True
+            elif mode != APPEND:
+                raise ValueError("Unknown mode: %s" % mode)
+            if len(self._queue) >= self.maxsize:
+                raise queue.Full("Motion queue is full")
+            self._queue.append(motion)
+            self._cond.notify_all()
+        self._cancelled(dropped)
+        return motion
+
+    def cancel(self):
+        '''
+        Drop all queued motions and stop the running one
+        '''
+        with self._cond:
+            dropped = self._drop_queue()
+            if self._current is not None:
+                self._preempt = True
+            self._cond.notify_all()
+        self._cancelled(dropped)
+
+    @property
+    def current(self):
+        return self._current
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def busy(self):
+        with self._cond:
+            return self._current is not None or len(self._queue) > 0
+
+    def wait_idle(self, timeout=None):
+        '''
+        Block until nothing is running or queued. Returns False on timeout
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._current is not None or self._queue:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _drop_queue(self):
+        # Called with _cond held. The listener is told by _cancelled()
+        # after it is released, so it may call back in or block
+        dropped = list(self._queue)
+        self._queue.clear()
+        for motion in dropped:
+            motion.state = 'cancelled'
+        return dropped
+
+    def _cancelled(self, dropped):
+        for motion in dropped:
+            self._notify('cancelled', motion)
+
+    def _notify(self, event, motion):
+        if self.listener is None:
+            return
+        try:
+            self.listener(event, motion)
+        except Exception as e:
+            print("Motion listener error: %s" % e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                motion = self._queue.popleft()
+                self._current = motion
+                self._preempt = False
+            self._execute(motion)
+            with self._cond:
+                self._current = None
+                idle = not self._queue
+                self._cond.notify_all()
+            # A replacing motion takes over the chassis directly
+            if idle:
+                self.chassis.set_velocity(0, 0, 0)
+
+    def _execute(self, motion):
+        motion.state = 'running'
+        motion.started_at = time.monotonic()
+        self._notify('start', motion)
+        deadline = motion.started_at
+        for i, segment in enumerate(motion.segments):
+            with self._cond:
+                if self._preempt:
+                    break
+            self.chassis.set_velocity(segment.velocity, segment.direction, segment.angular_rate)
+            motion.segment = i
+            self._notify('segment', motion)
+            deadline += segment.duration
+            with self._cond:
+                while not self._preempt:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._preempt:
+                    break
+        else:
+            motion.state = 'done'
+            motion.finished_at = time.monotonic()
+            self._notify('done', motion)
+            return
+        motion.state = 'cancelled'
+        motion.finished_at = time.monotonic()
+        self._notify('cancelled', motion)
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# coding=utf8
+import struct
+import binascii
+import collections
+
+# Framed binary protocol between the controller (agent.py) and the robot
+# (tars-robot.py). RFCOMM is a byte stream: one recv() can return part of a
+# frame or several frames, so the receiver runs every read through a
+# FrameDecoder.
+#
+# Frame, little endian:
+#   magic    2 bytes  b'TR'
+#   version  1 byte   VERSION
+#   type     1 byte   FRAME_*
+#   flags    1 byte   FLAG_*
+#   length   2 bytes  payload length
+#   payload  length bytes
+#   crc      2 bytes  CRC-CCITT of version..payload
+#
+# FRAME_COMMANDS payload: count (1 byte), then count commands of
+#   op (1 byte) seq (2 bytes) value (float32)
+# value is the distance in cm for OP_MOVE (negative is backward) and the
+# angle in degrees for OP_TURN (positive is left). Sequence numbers are per
+# command and wrap at 65536.
+#
+# FRAME_STATUS payload, robot to controller: count (1 byte), then count
+# statuses of
+#   event (1 byte) seq (2 bytes) value (float32)
+# for the command with that seq. The robot sends STATUS_ACK when a command
+# is queued, STATUS_PROGRESS with the completed fraction as it runs and
+# one of STATUS_DONE, STATUS_CANCELLED or STATUS_REJECTED at the end.
+#
+# FRAME_HELLO payload, controller to robot, optional and sent first:
+#   priority (1 byte) name (utf-8, rest of the payload)
+# The robot serves several controllers at once. Commands from a higher
+# priority controller preempt the moves of a lower one, and a lower one
+# is rejected while a higher one is in control. Controllers that never
+# say hello get PRIORITY_DEFAULT.
+#
+# FRAME_PING, controller to robot, empty payload: keepalive. The robot
+# sends it straight back, so the controller knows the link is alive.
+
+MAGIC = b'TR'
+VERSION = 1
+
+FRAME_COMMANDS = 1
+FRAME_STATUS = 2
+FRAME_HELLO = 3
+FRAME_PING = 4
+
+FLAG_REPLACE = 0x01  # drop queued and running moves before these commands
+
+OP_MOVE = 1
+OP_TURN = 2
+OP_STOP = 3
+OP_END = 4
+
+STATUS_ACK = 1
+STATUS_PROGRESS = 2
+STATUS_DONE = 3
+STATUS_CANCELLED = 4
+STATUS_REJECTED = 5
+
+PRIORITY_VOICE = 10
+PRIORITY_OPERATOR = 100
+PRIORITY_DEFAULT = PRIORITY_VOICE
+
+# Statuses after which the robot says nothing more about a command
+FINAL_STATUSES = (STATUS_DONE, STATUS_CANCELLED, STATUS_REJECTED)
+
+MAX_PAYLOAD = 4096
+
+_HEADER = struct.Struct('<2sBBBH')
+_RECORD = struct.Struct('<BHf')
+_CRC = struct.Struct('<H')
+
+Command = collections.namedtuple('Command', ['op', 'seq', 'value'])
+Status = collections.namedtuple('Status', ['event', 'seq', 'value'])
+Frame = collections.namedtuple('Frame', ['type', 'flags', 'payload'])
+Hello = collections.namedtuple('Hello', ['priority', 'name'])
+
+OP_NAMES = {OP_MOVE: 'move', OP_TURN: 'turn', OP_STOP: 'stop', OP_END: 'end'}
+STATUS_NAMES = {STATUS_ACK: 'ack', STATUS_PROGRESS: 'progress', STATUS_DONE: 'done',
+                STATUS_CANCELLED: 'cancelled', STATUS_REJECTED: 'rejected'}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(frame_type, payload=b'', flags=0):
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("Payload too long: %d" % len(payload))
+    body = _HEADER.pack(MAGIC, VERSION, frame_type, flags, len(payload))[2:] + payload
+    return MAGIC + body + _CRC.pack(binascii.crc_hqx(body, 0xFFFF))
+
+def _encode_records(records):
+    if len(records) > 255:
+        raise ProtocolError("Too many records in one frame: %d" % len(records))
+    return bytes([len(records)]) + b''.join(_RECORD.pack(*r) for r in records)
+
+def _decode_records(payload, cls):
+    if not payload:
+        raise ProtocolError("Empty payload")
+    count = payload[0]
+    if len(payload) != 1 + count * _RECORD.size:
+        raise ProtocolError("Payload length %d does not match count %d" % (len(payload), count))
+    return [cls(*_RECORD.unpack_from(payload, 1 + i * _RECORD.size)) for i in range(count)]
+
+def encode_commands(commands, flags=0):
+    return encode_frame(FRAME_COMMANDS, _encode_records(commands), flags)
+
+def decode_commands(payload):
+    return _decode_records(payload, Command)
+
+def encode_status(statuses):
+    return encode_frame(FRAME_STATUS, _encode_records(statuses))
+
+def decode_status(payload):
+    return _decode_records(payload, Status)
+
+def encode_hello(priority, name=''):
+    if not 0 <= priority <= 255:
+        raise ProtocolError("Priority out of range: %d" % priority)
+    return encode_frame(FRAME_HELLO, bytes([priority]) + name.encode('utf-8'))
+
+def encode_ping():
+    return encode_frame(FRAME_PING)
+
+def decode_hello(payload):
+    if not payload:
+        raise ProtocolError("Empty payload")
+    return Hello(payload[0], payload[1:].decode('utf-8', 'replace'))
+
+
+class CommandEncoder(object):
+    '''
+    Builds command frames and numbers the commands.
+
+        encoder = CommandEncoder()
+        sock.send(encoder.encode([encoder.move(30), encoder.turn(90)]))
+    '''
+    def __init__(self, first_seq=0):
+        self._seq = first_seq & 0xFFFF
+
+    def next_seq(self):
+        seq = self._seq
+        self._seq = (self._seq + 1) & 0xFFFF
+        return seq
+
+    def command(self, op, value=0.0):
+        return Command(op, self.next_seq(), float(value))
+
+    def move(self, distance_cm):
+        return self.command(OP_MOVE, distance_cm)
+
+    def turn(self, angle_deg):
+        return self.command(OP_TURN, angle_deg)
+
+    def stop(self):
+        return self.command(OP_STOP)
+
+    def end(self):
+        return self.command(OP_END)
+
+    def encode(self, commands, replace=False):
+        return encode_commands(commands, FLAG_REPLACE if replace else 0)
+
+
+class FrameDecoder(object):
+    '''
+    Streaming decoder. feed() takes whatever recv() returned and gives back
+    the complete frames found so far; partial frames stay buffered. On a bad
+    magic, version, length or CRC it skips ahead to the next magic, counting
+    the bytes it dropped in self.dropped.
+    '''
+    def __init__(self):
+        self._buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def feed(self, data):
+        self._buf += data
+        frames = []
+        while True:
+            frame = self._next()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _resync(self):
+        start = self._buf.find(MAGIC, 1)
+        if start < 0:
+            # Keep a trailing first magic byte, it may start the next frame
+            start = len(self._buf) - 1 if self._buf.endswith(MAGIC[:1]) else len(self._buf)
+        self.errors += 1
+        self.dropped += start
+        del self._buf[:start]
+
+    def _next(self):
+        while True:
+            if len(self._buf) < _HEADER.size:
+                if self._buf and not MAGIC.startswith(bytes(self._buf[:2])):
+                    self._resync()
+                    continue
+                return None
+            magic, version, frame_type, flags, length = _HEADER.unpack_from(self._buf)
+            if magic != MAGIC or version != VERSION or length > MAX_PAYLOAD:
+                self._resync()
+                continue
+            end = _HEADER.size + length + _CRC.size
+            if len(self._buf) < end:
+                return None
+            body = bytes(self._buf[2:_HEADER.size + length])
+            crc, = _CRC.unpack_from(self._buf, _HEADER.size + length)
+            if crc != binascii.crc_hqx(body, 0xFFFF):
+                self._resync()
+                continue
+            payload = bytes(self._buf[_HEADER.size:_HEADER.size + length])
+            del self._buf[:end]
+            self.frames += 1
+            return Frame(frame_type, flags, payload)
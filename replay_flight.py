@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# coding=utf8
+import os
+import sys
+import time
+import argparse
+import tempfile
+import collections
+sys.path.append('/home/pi/TurboPi/')
+# Replays against the simulated controller unless told otherwise; set
+# TARS_BOARD_BACKEND=hardware to drive the robot
+os.environ.setdefault('TARS_BOARD_BACKEND', 'sim')
+import board as Board
+import mecanum
+import flight_recorder
+from flight_recorder import REC_VELOCITY, REC_MOTOR, REC_MOTORS, KIND_NAMES
+from metrics import LatencyHistogram
+
+# Re-drives a flight recording (see flight_recorder.py) through the
+# chassis code: every recorded set_velocity call is made again at its
+# recorded time, scaled by --speed (0 for as fast as possible), while a
+# second recording captures what the replay wrote to the motors.
+#
+#   python3 replay_flight.py flight.rec              # summary and replay
+#   python3 replay_flight.py flight.rec --speed 10   # ten times faster
+#   python3 replay_flight.py flight.rec --dump       # print the records
+#
+# Afterwards it compares the motor writes of both runs and reports:
+#  - schedule error: how far each replayed call was from its scaled time
+#  - write latency: from a set_velocity call to its first motor write,
+#    recorded and replayed, the number to watch for regressions
+# The exit status is 1 when a replayed call wrote different motor speeds
+# than the recorded one did. Only writes following a set_velocity call
+# are compared, and a recording made with the control loop running
+# needs --control-loop to match.
+
+
+def responses(records):
+    '''
+    For each set_velocity call, the first motor write after it: a list
+    of (seconds from the call to the write, (v1, v2, v3, v4)). Motor
+    writes nobody asked for through set_velocity are not counted
+    '''
+    speeds = [0, 0, 0, 0]
+    called = None
+    found = []
+    for record in records:
+        if record.kind == REC_VELOCITY:
+            called = record.t
+            continue
+        if record.kind == REC_MOTORS:
+            speeds = [int(record.f0), int(record.f1), int(record.f2), int(record.f3)]
+        elif record.kind == REC_MOTOR and 1 <= record.a <= 4:
+            speeds[record.a - 1] = int(record.f0)
+        else:
+            continue
+        if called is not None:
+            found.append((record.t - called, tuple(speeds)))
+            called = None
+    return found
+
+
+def latency(found):
+    histogram = LatencyHistogram()
+    for seconds, _ in found:
+        histogram.record(seconds)
+    return histogram
+
+
+def summarize(header, records):
+    kinds = collections.Counter(r.kind for r in records)
+    span = records[-1].t - records[0].t if records else 0.0
+    print("%d records over %.2f s, started %s%s" % (
+        len(records), span, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header.started)),
+        ", %d overwritten" % (header.written - len(records)) if header.written > len(records) else ""))
+    for kind, count in sorted(kinds.items()):
+        print("  %-8s %d" % (KIND_NAMES.get(kind, str(kind)), count))
+
+
+def replay(records, speed, chassis):
+    '''
+    Call chassis.set_velocity for every velocity record on the recorded
+    schedule divided by speed
+    :return: LatencyHistogram of how late each call was
+    '''
+    calls = [r for r in records if r.kind == REC_VELOCITY]
+    schedule = LatencyHistogram()
+    if not calls:
+        return schedule
+    first = calls[0].t
+    start = time.monotonic()
+    for record in calls:
+        if speed > 0:
+            due = start + (record.t - first) / speed
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+            schedule.record(max(0.0, time.monotonic() - due))
+        chassis.set_velocity(record.f0, record.f1, record.f2)
+    return schedule
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a flight recording through the chassis.")
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="time scale, 2 replays twice as fast, 0 without waiting")
+    parser.add_argument('--dump', action='store_true', help="print the records and exit")
+    parser.add_argument('--output', help="keep the replay's own recording in this file")
+    parser.add_argument('--control-loop', action='store_true',
+                        help="ramp the wheels with MecanumChassis.start_control_loop()")
+    args = parser.parse_args()
+
+    header, records = flight_recorder.read_recording(args.recording)
+    if args.dump:
+        first = records[0].t if records else 0.0
+        for record in records:
+            print("%10.4f %s" % (record.t - first, flight_recorder.describe(record)))
+        return 0
+    summarize(header, records)
+
+    output = args.output
+    if not output:
+        fd, output = tempfile.mkstemp(suffix='.rec')
+        os.close(fd)
+    chassis = mecanum.MecanumChassis()
+    if args.control_loop:
+        chassis.start_control_loop()
+    flight_recorder.start(output, capacity=max(1024, 2 * len(records)))
+    try:
+        schedule = replay(records, args.speed, chassis)
+    finally:
+        chassis.stop_control_loop()
+        chassis.reset_motors()
+        flight_recorder.stop()
+    _, replayed = flight_recorder.read_recording(output)
+    if not args.output:
+        os.remove(output)
+
+    print("replayed on the %s backend at speed %g" % (type(Board.getBackend()).__name__, args.speed))
+    if args.speed > 0:
+        print("schedule error   %s" % schedule.summary())
+    expected = responses(records)
+    actual = responses(replayed)
+    print("write latency    recorded %s" % latency(expected).summary())
+    print("                 replayed %s" % latency(actual).summary())
+
+    for i, ((_, want), (_, got)) in enumerate(zip(expected, actual)):
+        if want != got:
+            print("motor writes differ at call %d: recorded %s, replayed %s" % (i, want, got))
+            return 1
+    if len(expected) != len(actual):
+        print("motor writes differ: %d recorded, %d replayed" % (len(expected), len(actual)))
+        return 1
+    print("motor writes match for %d calls" % len(expected))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
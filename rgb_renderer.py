@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+# coding=utf8
+import sys
+sys.path.append('/home/pi/TurboPi/')
+import math
+import time
+import threading
+import board as Board
+
+# Status LEDs. One renderer thread owns the PixelStrip; callers only
+# change a back buffer or pick an effect, which is a few assignments
+# under a lock and never waits for the strip. Each frame the renderer
+# draws the effect (if any) into the back buffer and, only when that
+# differs from what the strip shows, copies it over and calls show()
+# once. Frames are capped at fps.
+#
+#   leds = RGBRenderer().start()
+#   leds.set_effect('thinking')
+#   leds.set_alert('low_battery')   # drawn instead of the effect until cleared
+
+
+def _scale(color, level):
+    r, g, b = color
+    return (int(r * level), int(g * level), int(b * level))
+
+def listening(t, count):
+    '''
+    Slow blue breathing
+    '''
+    level = 0.25 + 0.75 * (0.5 - 0.5 * math.cos(2 * math.pi * t / 3.0))
+    return [_scale((0, 80, 255), level)] * count
+
+def thinking(t, count):
+    '''
+    Purple light chasing across the pixels
+    '''
+    lit = int(t * 6) % count
+    return [(160, 0, 255) if i == lit else (20, 0, 40) for i in range(count)]
+
+def moving(t, count):
+    '''
+    Steady green
+    '''
+    return [(0, 200, 0)] * count
+
+def low_battery(t, count):
+    '''
+    Red blink, once a second
+    '''
+    return [(255, 0, 0) if t % 1.0 < 0.5 else (0, 0, 0)] * count
+
+EFFECTS = {
+    'listening': listening,
+    'thinking': thinking,
+    'moving': moving,
+    'low_battery': low_battery,
+}
+
+
+class RGBRenderer(object):
+    '''
+    Frame-rate-capped renderer for a PixelStrip (board.getRGB() by default).
+
+    An effect is a function effect(t, count) -> [(r, g, b)] * count, with
+    t the seconds since it was set, or the name of one in EFFECTS. An
+    alert is an effect drawn instead of the current one until it is
+    cleared. set_pixel() and fill() draw directly and clear the effect.
+    '''
+    def __init__(self, strip=None, fps=30):
+        self.strip = strip
+        self.fps = fps
+        self.period = 1.0 / fps
+        self.frames = 0
+        self.shows = 0
+        self.skipped = 0
+        self._count = None
+        self._back = None
+        self._front = None
+        self._effect = None
+        self._effect_at = 0.0
+        self._alert = None
+        self._alert_at = 0.0
+        self._dirty = True
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            if self.strip is None:
+                self.strip = Board.getRGB()
+            self._count = self.strip.numPixels()
+            self._back = [(0, 0, 0)] * self._count
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='rgb-renderer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, clear=True):
+        if self._thread is None:
+            # Never started or already stopped, nothing to clear
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        if clear:
+            for i in range(self._count):
+                self.strip.setPixelColor(i, Board.PixelColor(0, 0, 0))
+            self.strip.show()
+            self._front = None
+
+    def _lookup(self, effect):
+        return EFFECTS[effect] if isinstance(effect, str) else effect
+
+    def set_effect(self, effect):
+        '''
+        Run effect (a name in EFFECTS or a function), None for none. Setting
+        the effect that is already running does not restart it
+        '''
+        effect = self._lookup(effect)
+        with self._cond:
+            if effect is not self._effect:
+                self._effect = effect
+                self._effect_at = time.monotonic()
+                self._dirty = True
+                self._cond.notify()
+
+    def set_alert(self, effect):
+        '''
+        Draw effect instead of the current one, None to go back to it
+        '''
+        effect = self._lookup(effect)
+        with self._cond:
+            if effect is not self._alert:
+                self._alert = effect
+                self._alert_at = time.monotonic()
+                self._dirty = True
+                self._cond.notify()
+
+    def set_pixel(self, index, red, green, blue):
+        with self._cond:
+            self._effect = None
+            self._back[index] = (red, green, blue)
+            self._dirty = True
+            self._cond.notify()
+
+    def fill(self, red, green, blue):
+        with self._cond:
+            self._effect = None
+            self._back = [(red, green, blue)] * self._count
+            self._dirty = True
+            self._cond.notify()
+
+    def clear(self):
+        self.fill(0, 0, 0)
+
+    def stats(self):
+        return {'fps': self.fps, 'frames': self.frames, 'shows': self.shows, 'skipped': self.skipped}
+
+    def _render(self, now):
+        '''
+        Next frame, or None when nothing can have changed
+        '''
+        with self._cond:
+            if self._alert is not None:
+                return self._alert(now - self._alert_at, self._count)
+            if self._effect is not None:
+                return self._effect(now - self._effect_at, self._count)
+            if not self._dirty:
+                return None
+            self._dirty = False
+            return list(self._back)
+
+    def _animated(self):
+        return self._alert is not None or self._effect is not None
+
+    def _run(self):
+        next_frame = time.monotonic()
+        while True:
+            with self._cond:
+                # Sleep until the next frame, or until something changes
+                # when there is nothing animating
+                while self._running and not self._animated() and not self._dirty:
+                    self._cond.wait()
+                if not self._running:
+                    return
+            now = time.monotonic()
+            if next_frame > now:
+                time.sleep(next_frame - now)
+                now = time.monotonic()
+            next_frame = max(next_frame + self.period, now)
+            try:
+                frame = self._render(now)
+            except Exception as e:
+                print("RGB effect error: %s" % e)
+                with self._cond:
+                    self._effect = self._alert = None
+                continue
+            if frame is None:
+                continue
+            self.frames += 1
+            if frame == self._front:
+                self.skipped += 1
+                continue
+            for i, (r, g, b) in enumerate(frame):
+                if self._front is None or self._front[i] != frame[i]:
+                    self.strip.setPixelColor(i, Board.PixelColor(r, g, b))
+            self.strip.show()
+            self._front = frame
+            self.shows += 1
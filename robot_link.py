@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import queue
+import random
+import threading
+import collections
+
+import protocol
+from metrics import LatencyHistogram, Counters
+
+# Controller side of the Bluetooth link. Commands are sent in frames and
+# tracked by sequence number until the robot reports them done, cancelled
+# or rejected (see the status frames in protocol.py). At most `window`
+# commands are in flight, so the controller keeps the robot's queue busy
+# without overrunning it.
+#
+# RobotConnection keeps a RobotLink connected: it reconnects in the
+# background with exponential backoff, pings the robot to notice a dead
+# link, and holds commands sent while the link is down in a bounded
+# queue until it is back.
+
+
+def wait_for(pending, event, timeout=None):
+    '''
+    Wait until every PendingCommand in pending has event ('acked' or
+    'finished') set. Returns False on timeout
+    '''
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for p in pending:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not getattr(p, event).wait(remaining):
+            return False
+    return True
+
+
+class PendingCommand(object):
+    def __init__(self, command, sent_at):
+        self.command = command
+        self.sent_at = sent_at
+        self.acked_at = None
+        self.finished_at = None
+        self.status = None
+        self.progress = 0.0
+        self.acked = threading.Event()
+        self.finished = threading.Event()
+
+    @property
+    def seq(self):
+        return self.command.seq
+
+    def __repr__(self):
+        return 'PendingCommand(%r, status=%s)' % (self.command, protocol.STATUS_NAMES.get(self.status))
+
+
+class RobotLink(object):
+    '''
+    Pipelined command sender with send->ack and send->done latency
+    histograms. A reader thread consumes the robot's status frames and
+    calls on_close(), if given, when the link closes.
+
+        link = RobotLink(sock).start()
+        pending = link.send([link.encoder.move(30)])
+        link.wait_acked(pending, timeout=2)
+    '''
+    def __init__(self, sock, window=8, expire_after=300, encoder=None, on_close=None):
+        self.sock = sock
+        self.on_close = on_close
+        self.window = window
+        self.expire_after = expire_after
+        self.encoder = encoder or protocol.CommandEncoder()
+        self.ack_latency = LatencyHistogram()
+        self.done_latency = LatencyHistogram()
+        self.counters = Counters('sent', 'frames', 'acked', 'done', 'cancelled', 'rejected',
+                                 'expired', 'lost', 'unmatched', 'window_full')
+        self.last_received = time.monotonic()
+        self._inflight = {}
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._decoder = protocol.FrameDecoder()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._read_loop, name='robot-link-reader', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._running = False
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    @property
+    def alive(self):
+        '''
+        False once the reader thread has stopped, the link is then unusable
+        '''
+        return self._thread is not None and self._thread.is_alive()
+
+    def ping(self):
+        with self._send_lock:
+            self.sock.send(protocol.encode_ping())
+
+    def hello(self, priority, name=''):
+        '''
+        Tell the robot who we are, see FRAME_HELLO
+        '''
+        with self._send_lock:
+            self.sock.send(protocol.encode_hello(priority, name))
+
+    def in_flight(self):
+        with self._cond:
+            return len(self._inflight)
+
+    def send(self, commands, replace=False, timeout=5.0):
+        '''
+        Send commands in one frame. Waits up to timeout seconds for room in
+        the window, then raises TimeoutError. Returns a PendingCommand per
+        command
+        '''
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._expire()
+            while len(self._inflight) + len(commands) > self.window:
+                self.counters.inc('window_full')
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("%d commands already in flight" % len(self._inflight))
+                self._cond.wait(remaining)
+            now = time.monotonic()
+            pending = [PendingCommand(c, now) for c in commands]
+            for p in pending:
+                self._inflight[p.seq] = p
+        frame = self.encoder.encode(commands, replace=replace)
+        try:
+            with self._send_lock:
+                self.sock.send(frame)
+        except Exception:
+            with self._cond:
+                for p in pending:
+                    self._inflight.pop(p.seq, None)
+                self._cond.notify_all()
+            raise
+        self.counters.inc('frames')
+        self.counters.inc('sent', len(commands))
+        return pending
+
+    def wait_acked(self, pending, timeout=None):
+        return self._wait(pending, 'acked', timeout)
+
+    def wait_finished(self, pending, timeout=None):
+        return self._wait(pending, 'finished', timeout)
+
+    def _wait(self, pending, event, timeout):
+        return wait_for(pending, event, timeout)
+
+    def _expire(self):
+        # Commands the robot never finished, e.g. it restarted mid-move
+        now = time.monotonic()
+        for seq in [s for s, p in self._inflight.items() if now - p.sent_at > self.expire_after]:
+            p = self._inflight.pop(seq)
+            self.counters.inc('expired')
+            p.acked.set()
+            p.finished.set()
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                data = self.sock.recv(1024)
+            except Exception as e:
+                if self._running:
+                    print("Robot link receive error: %s" % e)
+                break
+            if not data:
+                break
+            self.last_received = time.monotonic()
+            for frame in self._decoder.feed(data):
+                if frame.type != protocol.FRAME_STATUS:
+                    continue
+                try:
+                    statuses = protocol.decode_status(frame.payload)
+                except protocol.ProtocolError as e:
+                    print("Bad status frame: %s" % e)
+                    continue
+                for status in statuses:
+                    self._on_status(status)
+        self._running = False
+        self._lose_inflight()
+        if self.on_close is not None:
+            self.on_close()
+
+    def _lose_inflight(self):
+        # The link is gone and so is any word on these commands. They
+        # finish with status None
+        with self._cond:
+            lost = list(self._inflight.values())
+            self._inflight.clear()
+            self._cond.notify_all()
+        for p in lost:
+            self.counters.inc('lost')
+            p.acked.set()
+            p.finished.set()
+
+    def _on_status(self, status):
+        now = time.monotonic()
+        with self._cond:
+            p = self._inflight.get(status.seq)
+            if p is None:
+                self.counters.inc('unmatched')
+                return
+            p.status = status.event
+            if status.event == protocol.STATUS_PROGRESS:
+                p.progress = status.value
+            # Any status means the robot has the command
+            if p.acked_at is None:
+                p.acked_at = now
+                self.ack_latency.record(now - p.sent_at)
+                self.counters.inc('acked')
+                p.acked.set()
+            if status.event in protocol.FINAL_STATUSES:
+                p.finished_at = now
+                del self._inflight[status.seq]
+                self.counters.inc(protocol.STATUS_NAMES[status.event])
+                if status.event == protocol.STATUS_DONE:
+                    self.done_latency.record(now - p.sent_at)
+                p.finished.set()
+                self._cond.notify_all()
+
+    def report(self):
+        return "\n".join([
+            "send->ack:  " + self.ack_latency.summary(),
+            "send->done: " + self.done_latency.summary(),
+            "in flight %d/%d, %s" % (self.in_flight(), self.window, self.counters.summary()),
+        ])
+
+
+class RobotConnection(object):
+    '''
+    A RobotLink that keeps itself connected.
+
+        robot = RobotConnection(connect_socket, hello=(protocol.PRIORITY_VOICE, 'voice')).start()
+        pending = robot.send([robot.encoder.move(30)])   # None: queued until reconnected
+
+    connect() returns a connected socket or raises; failed attempts are
+    retried after backoff seconds, doubling up to max_backoff, with 20%
+    jitter. hello, if given, is (priority, name) sent after every connect.
+    While connected a ping goes out every keepalive seconds, and when
+    nothing has come back for liveness seconds the link counts as dead.
+
+    send() never waits for the connection. While the link is down, or
+    frames from before are still waiting, the commands are queued and it
+    returns None. At most queue_size frames wait, beyond that send()
+    raises queue.Full; frames that waited more than max_age seconds are
+    dropped instead of being sent late. Commands in flight when the link
+    dies finish with status None.
+
+    recovery is the time from losing the link to having it back
+    '''
+    def __init__(self, connect, window=8, hello=None, backoff=0.5, max_backoff=30.0,
+                 keepalive=5.0, liveness=15.0, queue_size=16, max_age=30.0):
+        self.connect = connect
+        self.window = window
+        self.hello = hello
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.keepalive = keepalive
+        self.liveness = liveness
+        self.queue_size = queue_size
+        self.max_age = max_age
+        # Shared by every link, so sequence numbers keep counting up
+        self.encoder = protocol.CommandEncoder()
+        self.recovery = LatencyHistogram()
+        self.counters = Counters('connects', 'reconnects', 'connect_failures', 'disconnects',
+                                 'pings', 'queued', 'flushed', 'full', 'expired')
+        self.link = None          # usable for sending, None while down or flushing
+        self._current = None      # connected link, also while flushing
+        self._outbox = collections.deque()
+        self._lost_at = None
+        self._connected = threading.Event()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='robot-connection', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        with self._cond:
+            self._running = False
+            link = self._current
+            self._cond.notify_all()
+        if link is not None:
+            link.close()
+        if self._thread is not None:
+            # connect() may be blocked in the Bluetooth stack; the thread is a daemon
+            self._thread.join(timeout)
+            self._thread = None
+
+    def connected(self):
+        return self._connected.is_set()
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def queued(self):
+        with self._cond:
+            return len(self._outbox)
+
+    def send(self, commands, replace=False, timeout=5.0):
+        '''
+        Send commands in one frame like RobotLink.send, or queue them when
+        the link is down and return None
+        '''
+        with self._cond:
+            link = self.link
+            if link is None or self._outbox:
+                if len(self._outbox) >= self.queue_size:
+                    self.counters.inc('full')
+                    raise queue.Full("%d frames already waiting for the robot link" % len(self._outbox))
+                self._outbox.append((time.monotonic(), commands, replace))
+                self.counters.inc('queued')
+                return None
+        try:
+            return link.send(commands, replace=replace, timeout=timeout)
+        except TimeoutError:
+            raise
+        except Exception as e:
+            self._drop(link, "send failed: %s" % e)
+            return self.send(commands, replace, timeout)
+
+    def report(self):
+        with self._cond:
+            link = self._current
+            state = 'connected' if self.link is not None else 'down, %d frames queued' % len(self._outbox)
+        lines = [
+            "link %s, %s" % (state, self.counters.summary()),
+            "recovery:   " + self.recovery.summary(),
+        ]
+        if link is not None:
+            lines.append(link.report())
+        return "\n".join(lines)
+
+    def _sleep(self, seconds):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._running, seconds)
+
+    def _run(self):
+        delay = self.backoff
+        while self._running:
+            try:
+                sock = self.connect()
+            except Exception as e:
+                self.counters.inc('connect_failures')
+                wait = delay * random.uniform(0.8, 1.2)
+                print("Robot connect failed: %s, retrying in %.1f s" % (e, wait))
+                delay = min(delay * 2, self.max_backoff)
+                self._sleep(wait)
+                continue
+            delay = self.backoff
+            link = RobotLink(sock, window=self.window, encoder=self.encoder, on_close=self._wake)
+            link.start()
+            self._up(link)
+            try:
+                if self.hello is not None:
+                    link.hello(*self.hello)
+                self._flush(link)
+            except Exception as e:
+                self._drop(link, "setup failed: %s" % e)
+                continue
+            self._watch(link)
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _up(self, link):
+        now = time.monotonic()
+        with self._cond:
+            self._current = link
+            self.counters.inc('connects')
+            if self._lost_at is not None:
+                self.counters.inc('reconnects')
+                self.recovery.record(now - self._lost_at)
+                print("Robot link back after %.1f s" % (now - self._lost_at))
+                self._lost_at = None
+
+    def _flush(self, link):
+        # Frames queued while the link was down go out in order. Anything
+        # sent meanwhile queues behind them, until the queue is empty and
+        # the link opens for direct sends
+        while True:
+            with self._cond:
+                if not self._outbox:
+                    if self._current is link:
+                        self.link = link
+                        self._connected.set()
+                    return
+                queued_at, commands, replace = self._outbox.popleft()
+            if time.monotonic() - queued_at > self.max_age:
+                self.counters.inc('expired')
+                print("Dropping %d commands that waited %.0f s for the robot link" % (
+                    len(commands), time.monotonic() - queued_at))
+                continue
+            try:
+                link.send(commands, replace=replace, timeout=self.liveness)
+            except Exception:
+                with self._cond:
+                    self._outbox.appendleft((queued_at, commands, replace))
+                raise
+            self.counters.inc('flushed')
+
+    def _watch(self, link):
+        reason = None
+        while reason is None:
+            with self._cond:
+                if self._running and self._current is link and link.alive:
+                    self._cond.wait(self.keepalive)
+                if self._current is not link:
+                    return
+                if not self._running:
+                    break
+            if not link.alive:
+                reason = "connection closed"
+            elif time.monotonic() - link.last_received > self.liveness:
+                reason = "no answer for %.0f s" % (time.monotonic() - link.last_received)
+            else:
+                try:
+                    link.ping()
+                    self.counters.inc('pings')
+                except Exception as e:
+                    reason = "ping failed: %s" % e
+        if reason is None:
+            # Stopped
+            link.close()
+            return
+        self._drop(link, reason)
+
+    def _drop(self, link, reason):
+        with self._cond:
+            if self._current is not link:
+                return
+            self._current = None
+            self.link = None
+            self._connected.clear()
+            if self._lost_at is None:
+                self._lost_at = time.monotonic()
+            self.counters.inc('disconnects')
+            self._cond.notify_all()
+        print("Robot link lost: %s, reconnecting" % reason)
+        link.close()
@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import errno
+import socket
+import threading
+import selectors
+import itertools
+
+import protocol
+
+# Robot side of the Bluetooth link for several controllers at once, e.g.
+# the voice agent and a manual override app. One thread runs a selector
+# over the listening socket and every connected client: it accepts new
+# clients, reads whatever a client sent and hands complete frames to the
+# frame handler. A client that disconnects or breaks is dropped and the
+# others carry on; the listening socket keeps accepting.
+#
+# Client sockets are non-blocking both ways. send() hands the socket what
+# it takes right away and queues the rest, which the selector thread
+# writes out when the socket turns writable. A client that stops reading
+# is dropped once MAX_OUTBOX bytes are waiting for it, instead of
+# stalling the executor thread or the selector loop with it.
+#
+# The Arbiter decides whose commands reach the motion queue, by the
+# priority each client announces in its hello frame (see protocol.py).
+
+PREEMPT = 'preempt'  # higher priority: drop everything queued and running first
+ADMIT = 'admit'      # queue behind what is there
+
+MAX_OUTBOX = 64 * 1024  # bytes queued for a client before it is dropped
+
+
+def _would_block(e):
+    # BluetoothError is not always a BlockingIOError, it carries the errno
+    return isinstance(e, (BlockingIOError, InterruptedError)) or \
+        getattr(e, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Client(object):
+    '''
+    One connected controller. send() is safe from any thread and never
+    blocks; on_pending(client) is called when data is left queued or the
+    client broke, so the server can wait for the socket or drop it
+    '''
+    _ids = itertools.count(1)
+
+    def __init__(self, sock, address, on_pending=None):
+        self.id = next(self._ids)
+        self.sock = sock
+        self.address = address
+        self.name = str(address)
+        self.priority = protocol.PRIORITY_DEFAULT
+        self.decoder = protocol.FrameDecoder()
+        self.connected_at = time.monotonic()
+        self.connected = True
+        self.ended = False  # it sent OP_END, its moves run on after it leaves
+        self.broken = False  # send failed or MAX_OUTBOX overflowed, to be dropped
+        self._outbox = bytearray()
+        self._on_pending = on_pending
+        self._send_lock = threading.Lock()
+
+    def send(self, data):
+        with self._send_lock:
+            if not self.connected or self.broken:
+                return
+            waiting = bool(self._outbox)
+            self._outbox += data
+            if not waiting:
+                self._write()
+            if len(self._outbox) > MAX_OUTBOX:
+                self.broken = True
+            notify = self.broken or (self._outbox and not waiting)
+        if notify and self._on_pending is not None:
+            self._on_pending(self)
+
+    def flush(self):
+        '''
+        Write out what is queued, as much as the socket takes
+        :return: True while data is still waiting
+        '''
+        with self._send_lock:
+            if self.connected and not self.broken and self._outbox:
+                self._write()
+            return bool(self._outbox) and not self.broken
+
+    @property
+    def queued(self):
+        return len(self._outbox)
+
+    def _write(self):
+        try:
+            sent = self.sock.send(self._outbox)
+        except Exception as e:
+            if not _would_block(e):
+                print("Send to %s failed: %s" % (self.name, e))
+                self.broken = True
+            return
+        del self._outbox[:sent]
+
+    def close(self):
+        with self._send_lock:
+            self.connected = False
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return 'Client(%d, %s, priority=%d)' % (self.id, self.name, self.priority)
+
+
+class Arbiter(object):
+    '''
+    Tracks which client is in control of the motion queue.
+
+    admit(client, busy) with busy telling whether anything is queued or
+    running returns:
+     - PREEMPT when client outranks the one in control, which loses it
+     - ADMIT when nobody else is in control, or the one in control has
+       the same priority
+     - None when a higher priority client is in control: either its moves
+       are still running, or they finished less than hold seconds ago,
+       so the override is not undone by the next voice command
+    Call released() when the motion queue goes idle
+    '''
+    def __init__(self, hold=3.0):
+        self.hold = hold
+        self.owner = None
+        self.preempted = 0
+        self.rejected = 0
+        self._released_at = None
+        self._lock = threading.Lock()
+
+    def admit(self, client, busy):
+        now = time.monotonic()
+        with self._lock:
+            owner = self.owner
+            if not busy and self._released_at is None:
+                self._released_at = now
+            if owner is None or owner is client or client.priority == owner.priority:
+                decision = ADMIT
+            elif client.priority > owner.priority:
+                decision = PREEMPT
+                self.preempted += 1
+            elif not busy and now - self._released_at >= self.hold:
+                decision = ADMIT
+            else:
+                self.rejected += 1
+                return None
+            self.owner = client
+            self._released_at = None
+            return decision
+
+    def released(self):
+        # Called again at every idle, the last one counts
+        with self._lock:
+            self._released_at = time.monotonic()
+
+    def drop(self, client):
+        '''
+        Forget a client that went away. True if it was in control
+        '''
+        with self._lock:
+            if self.owner is not client:
+                return False
+            self.owner = None
+            self._released_at = None
+            return True
+
+
+class RobotServer(object):
+    '''
+    Selector loop over a listening RFCOMM socket and its clients.
+
+    handle_frame(client, frame) is called for every frame a client sends
+    and returns False to disconnect the client. on_disconnect(client) is
+    called once for every client that goes away. Both run on the thread
+    that calls serve(). Clients with queued output are polled for
+    writability until it is sent, see Client.send()
+    '''
+    def __init__(self, server_sock, handle_frame, on_disconnect=None, max_clients=4):
+        self.server_sock = server_sock
+        self.handle_frame = handle_frame
+        self.on_disconnect = on_disconnect
+        self.max_clients = max_clients
+        self.accepted = 0
+        self.refused = 0
+        self._clients = {}
+        self._selector = selectors.DefaultSelector()
+        # Clients that queued output or broke on another thread, picked up
+        # by the selector thread, which the wake socket gets out of select()
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    def clients(self):
+        return list(self._clients.values())
+
+    def serve(self, running=lambda: True, poll=0.5):
+        '''
+        Serve until running() returns False, checked every poll seconds
+        '''
+        self.server_sock.setblocking(False)
+        self._selector.register(self.server_sock, selectors.EVENT_READ, None)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, self)
+        try:
+            while running():
+                for key, events in self._selector.select(poll):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self:
+                        self._drain_wake()
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self._write(key.data)
+                        if events & selectors.EVENT_READ and key.data.id in self._clients:
+                            self._read(key.data)
+                self._watch_pending()
+        finally:
+            for client in self.clients():
+                self._drop(client)
+            self._selector.unregister(self._wake_r)
+            self._selector.unregister(self.server_sock)
+
+    def _accept(self):
+        try:
+            sock, address = self.server_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            print("Accept failed: %s" % e)
+            return
+        if len(self._clients) >= self.max_clients:
+            print("Refusing %s, already serving %d controllers" % (address, len(self._clients)))
+            self.refused += 1
+            sock.close()
+            return
+        sock.setblocking(False)
+        client = Client(sock, address, self._client_pending)
+        self._clients[client.id] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        self.accepted += 1
+        print("Accepted connection from %s (%d connected)" % (address, len(self._clients)))
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(1024)
+        except Exception as e:
+            if _would_block(e):
+                return
+            print("Receive from %s failed: %s" % (client.name, e))
+            data = b''
+        if not data:
+            print("%s disconnected" % client.name)
+            self._drop(client)
+            return
+        for frame in client.decoder.feed(data):
+            try:
+                keep = self.handle_frame(client, frame)
+            except protocol.ProtocolError as e:
+                print("Bad frame from %s: %s" % (client.name, e))
+                continue
+            except Exception as e:
+                print("Error handling frame from %s: %s" % (client.name, e))
+                continue
+            if keep is False:
+                self._drop(client)
+                return
+
+    def _client_pending(self, client):
+        # Any thread: the selector thread changes the registration
+        with self._pending_lock:
+            self._pending.add(client)
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # already woken, or the server is gone
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(64):
+                pass
+        except OSError:
+            pass
+
+    def _watch_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, set()
+        for client in pending:
+            if client.id not in self._clients:
+                continue
+            if client.broken:
+                self._drop_broken(client)
+            elif client.queued:
+                self._selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def _write(self, client):
+        if client.flush():
+            return
+        if client.broken:
+            self._drop_broken(client)
+        else:
+            # All sent, stop polling for writability until send() queues again
+            self._selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def _drop_broken(self, client):
+        print("Dropping %s, %d bytes unsent" % (client.name, client.queued))
+        self._drop(client)
+
+    def _drop(self, client):
+        if self._clients.pop(client.id, None) is None:
+            return
+        self._selector.unregister(client.sock)
+        client.close()
+        if self.on_disconnect is not None:
+            try:
+                self.on_disconnect(client)
+            except Exception as e:
+                print("Disconnect handler error: %s" % e)
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# coding=utf8
+import sys
+sys.path.append('/home/pi/TurboPi/')
+import time
+import bisect
+import threading
+import collections
+import board as Board
+
+# Keyframe animation of the PWM servos. An animation is a list of
+# keyframes, each giving some servo angles at a time. The animator
+# interpolates them at a fixed frame rate and sends every frame as one
+# setPWMServosPulse transaction, so all servos move together and nobody
+# has to build [time, number, id1, pulse1, ...] lists or sleep between
+# poses.
+#
+#   wave = Animation([Keyframe(0.0, {1: 90, 2: 90}),
+#                     Keyframe(0.5, {1: 45}),
+#                     Keyframe(1.0, {1: 135, 2: 60})], loop=True)
+#   animator = ServoAnimator().start()
+#   playback = animator.play(wave)
+#   ...
+#   playback.cancel()
+
+Keyframe = collections.namedtuple('Keyframe', ['t', 'angles'])
+
+
+def angle_to_pulse(angle):
+    '''
+    Same mapping as board.setPWMServoAngle, 0~180 degrees to 500~2500 us
+    '''
+    angle = 180 if angle > 180 else angle
+    angle = 0 if angle < 0 else angle
+    return int(((100 * angle) / 9) + 500)
+
+
+class Animation(object):
+    '''
+    Keyframes sorted by t (seconds). A servo holds its angle before its
+    first keyframe and after its last one, and moves linearly in between.
+    With loop, the animation restarts after its last keyframe
+    '''
+    def __init__(self, keyframes, loop=False):
+        self.keyframes = sorted(keyframes, key=lambda k: k.t)
+        self.loop = loop
+        self.duration = self.keyframes[-1].t if self.keyframes else 0.0
+        # Per servo: sorted times and angles of its own keyframes
+        self._tracks = {}
+        for keyframe in self.keyframes:
+            for servo_id, angle in keyframe.angles.items():
+                times, angles = self._tracks.setdefault(servo_id, ([], []))
+                times.append(keyframe.t)
+                angles.append(float(angle))
+
+    @property
+    def servos(self):
+        return sorted(self._tracks)
+
+    def angles_at(self, t):
+        '''
+        {servo_id: angle} at t seconds from the start
+        '''
+        if self.loop and self.duration > 0:
+            t = t % self.duration
+        angles = {}
+        for servo_id, (times, values) in self._tracks.items():
+            i = bisect.bisect_right(times, t)
+            if i == 0:
+                angles[servo_id] = values[0]
+            elif i == len(times):
+                angles[servo_id] = values[-1]
+            else:
+                t0, t1 = times[i - 1], times[i]
+                a0, a1 = values[i - 1], values[i]
+                angles[servo_id] = a0 + (a1 - a0) * (t - t0) / (t1 - t0)
+        return angles
+
+    def finished(self, t):
+        return not self.loop and t >= self.duration
+
+
+class Playback(object):
+    '''
+    One play() of an animation. state is playing, done or cancelled
+    '''
+    def __init__(self, animation, animator):
+        self.animation = animation
+        self._animator = animator
+        self.state = 'playing'
+        self.started_at = None
+        self.frames = 0
+        self.writes = 0
+        self.missed = 0
+        self._done = threading.Event()
+
+    def cancel(self):
+        self._animator.cancel(self)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _finish(self, state):
+        self.state = state
+        self._done.set()
+
+    def __repr__(self):
+        return 'Playback(state=%s, frames=%d, missed=%d)' % (self.state, self.frames, self.missed)
+
+
+class ServoAnimator(object):
+    '''
+    Plays one animation at a time at rate frames per second on its own
+    thread. play() replaces whatever is playing.
+
+    Frames are scheduled on monotonic deadlines. When a frame is more
+    than one period late the frames in between are skipped rather than
+    sent in a burst, and counted as missed. A frame whose pulses are the
+    same as the last one sent is not written. Each write asks the
+    controller to take one frame period to reach the new pulses, which
+    smooths the steps between frames
+    '''
+    def __init__(self, rate=50, write=None):
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.write = write or Board.setPWMServosPulse
+        self.frames = 0
+        self.writes = 0
+        self.missed = 0
+        self.late_max = 0.0
+        self._playback = None
+        self._last = None
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return self
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='servo-animator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._end('cancelled')
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def play(self, animation):
+        '''
+        Start animation now and return its Playback
+        '''
+        playback = Playback(animation, self)
+        with self._cond:
+            self._end('cancelled')
+            playback.started_at = time.monotonic()
+            self._playback = playback
+            self._cond.notify_all()
+        return playback
+
+    def cancel(self, playback=None):
+        '''
+        Stop the current animation (only if it is playback, when given).
+        The servos stay where the last frame put them
+        '''
+        with self._cond:
+            if playback is None or playback is self._playback:
+                self._end('cancelled')
+                self._cond.notify_all()
+
+    def _end(self, state):
+        if self._playback is not None:
+            self._playback._finish(state)
+            self._playback = None
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'frames': self.frames,
+            'writes': self.writes,
+            'missed': self.missed,
+            'late_max': self.late_max,
+        }
+
+    def _frame(self, playback, t):
+        pulses = [(servo_id, angle_to_pulse(angle))
+                  for servo_id, angle in sorted(playback.animation.angles_at(t).items())]
+        self.frames += 1
+        playback.frames += 1
+        if pulses == self._last:
+            return
+        args = [int(self.period * 1000), len(pulses)]
+        for servo_id, pulse in pulses:
+            args += [servo_id, pulse]
+        self.write(args)
+        self._last = pulses
+        self.writes += 1
+        playback.writes += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._playback is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                playback = self._playback
+                deadline = playback.started_at
+            frame = 0
+            while True:
+                with self._cond:
+                    while self._playback is playback:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if self._playback is not playback:
+                        break
+                late = time.monotonic() - deadline
+                self.late_max = max(self.late_max, late)
+                if late > self.period:
+                    skipped = int(late / self.period)
+                    frame += skipped
+                    deadline += skipped * self.period
+                    self.missed += skipped
+                    playback.missed += skipped
+                t = frame * self.period
+                try:
+                    self._frame(playback, min(t, playback.animation.duration) if not playback.animation.loop else t)
+                except Exception as e:
+                    print("Servo animation error: %s" % e)
+                if playback.animation.finished(t):
+                    with self._cond:
+                        if self._playback is playback:
+                            self._end('done')
+                    break
+                frame += 1
+                deadline += self.period
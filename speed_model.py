@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# coding=utf8
+import os
+import sys
+sys.path.append('/home/pi/TurboPi/')
+import json
+import time
+import bisect
+import threading
+
+# Calibrated chassis speeds. How far the robot gets in a second depends
+# on the direction, the speed setting and the battery voltage, so move
+# and turn durations come from a measured table instead of one constant:
+#
+#   axis      "move:<direction>" (cm/s) or "turn_cw"/"turn_ccw" (deg/s)
+#   voltage   battery millivolts when the sample was taken
+#   setting   speed 0~100 for moves, |angular_rate| for turns
+#
+# The table is filled by calibrate_speed.py. Lookups interpolate linearly
+# over the setting, then between the two calibrated voltages around the
+# current one. Axes without samples fall back to a linear model.
+
+DEFAULT_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'speed_table.json')
+
+MAX_SPEED_CMPS = 50      # Uncalibrated: cm/s at speed 100
+TURN_DPS_PER_RATE = 360  # Uncalibrated: deg/s per unit of angular_rate (90 degrees in 0.5 s at 0.5)
+
+
+def move_axis(direction):
+    return 'move:%d' % (int(round(direction)) % 360)
+
+def turn_axis(angular_rate):
+    # A positive angular rate turns clockwise, see MecanumChassis._wheels
+    return 'turn_cw' if angular_rate > 0 else 'turn_ccw'
+
+def _interpolate(points, x):
+    '''
+    points: sorted [(x, y)], implicitly starting at (0, 0). Beyond the
+    last point the rate scales proportionally
+    '''
+    xs = [p[0] for p in points]
+    i = bisect.bisect_left(xs, x)
+    if i < len(points) and xs[i] == x:
+        return points[i][1]
+    if i == len(points):
+        last_x, last_y = points[-1]
+        return last_y * x / last_x if last_x else last_y
+    x0, y0 = points[i - 1] if i else (0.0, 0.0)
+    x1, y1 = points[i]
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+class SpeedModel(object):
+    '''
+    Interpolated speed table with battery-voltage compensation.
+
+        model = SpeedModel.load()
+        duration = model.move_duration(30, speed=50, direction=90)
+
+    battery() returns millivolts, board.getBattery by default. It is read
+    at most every voltage_ttl seconds
+    '''
+    def __init__(self, table=None, battery=None, voltage_ttl=5.0,
+                 max_speed_cmps=MAX_SPEED_CMPS, turn_dps_per_rate=TURN_DPS_PER_RATE):
+        self.table = {}   # axis -> {millivolts: {setting: rate}}
+        self.battery = battery
+        self.voltage_ttl = voltage_ttl
+        self.max_speed_cmps = max_speed_cmps
+        self.turn_dps_per_rate = turn_dps_per_rate
+        self._lock = threading.Lock()
+        self._curves = {}   # axis -> sorted [(millivolts, sorted [(setting, rate)])]
+        self._voltage = None
+        self._voltage_at = 0.0
+        for axis, voltages in (table or {}).items():
+            for millivolts, samples in voltages.items():
+                for setting, rate in samples.items():
+                    self.add_sample(axis, millivolts, setting, rate)
+
+    @classmethod
+    def load(cls, path=DEFAULT_TABLE, **kwargs):
+        '''
+        Model from a table saved by save(); uncalibrated if path does not exist
+        '''
+        table = None
+        if os.path.exists(path):
+            with open(path) as f:
+                table = json.load(f)['axes']
+        return cls(table, **kwargs)
+
+    def save(self, path=DEFAULT_TABLE):
+        with self._lock:
+            axes = {axis: {str(mv): {'%g' % s: r for s, r in sorted(samples.items())}
+                           for mv, samples in sorted(voltages.items())}
+                    for axis, voltages in sorted(self.table.items())}
+        with open(path, 'w') as f:
+            json.dump({'version': 1, 'axes': axes}, f, indent=2)
+
+    def add_sample(self, axis, millivolts, setting, rate):
+        '''
+        rate: cm/s for moves, deg/s for turns, measured at setting and
+        millivolts. A sample for the same point replaces the old one
+        '''
+        setting = abs(float(setting))
+        with self._lock:
+            voltages = self.table.setdefault(axis, {})
+            voltages.setdefault(int(millivolts), {})[setting] = abs(float(rate))
+            self._curves[axis] = sorted((mv, sorted(samples.items())) for mv, samples in voltages.items())
+
+    def calibrated(self, axis):
+        return axis in self._curves
+
+    def voltage(self):
+        '''
+        Battery millivolts, cached for voltage_ttl seconds. None if it
+        cannot be read
+        '''
+        now = time.monotonic()
+        if self._voltage is None or now - self._voltage_at > self.voltage_ttl:
+            try:
+                if self.battery is None:
+                    import board as Board
+                    self.battery = Board.getBattery
+                self._voltage = self.battery()
+            except Exception as e:
+                print("Could not read the battery voltage: %s" % e)
+            self._voltage_at = now
+        return self._voltage
+
+    def rate(self, axis, setting, millivolts=None):
+        '''
+        Interpolated rate on axis at setting, None if axis is not calibrated
+        '''
+        curves = self._curves.get(axis)
+        if not curves:
+            return None
+        setting = abs(float(setting))
+        if len(curves) == 1:
+            return _interpolate(curves[0][1], setting)
+        if millivolts is None:
+            millivolts = self.voltage()
+        voltages = [c[0] for c in curves]
+        if millivolts is None:
+            # No reading, assume the middle of the calibrated range
+            millivolts = (voltages[0] + voltages[-1]) / 2.0
+        i = bisect.bisect_left(voltages, millivolts)
+        if i == 0:
+            return _interpolate(curves[0][1], setting)
+        if i == len(curves):
+            return _interpolate(curves[-1][1], setting)
+        v0, points0 = curves[i - 1]
+        v1, points1 = curves[i]
+        r0 = _interpolate(points0, setting)
+        r1 = _interpolate(points1, setting)
+        return r0 + (r1 - r0) * (millivolts - v0) / (v1 - v0)
+
+    def move_speed(self, speed, direction=90, millivolts=None):
+        '''
+        cm/s at speed (0~100) in direction (degrees, 90 is forward)
+        '''
+        rate = self.rate(move_axis(direction), speed, millivolts)
+        if rate is None:
+            rate = abs(speed) / 100.0 * self.max_speed_cmps
+        return rate
+
+    def turn_speed(self, angular_rate, millivolts=None):
+        '''
+        deg/s at angular_rate
+        '''
+        rate = self.rate(turn_axis(angular_rate), angular_rate, millivolts)
+        if rate is None:
+            rate = abs(angular_rate) * self.turn_dps_per_rate
+        return rate
+
+    def move_duration(self, distance, speed=50, direction=90, millivolts=None):
+        '''
+        Seconds to move distance cm
+        '''
+        rate = self.move_speed(speed, direction, millivolts)
+        return abs(distance) / rate if rate else 0.0
+
+    def turn_duration(self, degrees, angular_rate=0.5, millivolts=None):
+        '''
+        Seconds to turn degrees at angular_rate
+        '''
+        rate = self.turn_speed(angular_rate, millivolts)
+        return abs(degrees) / rate if rate else 0.0
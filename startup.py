@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# coding=utf8
+import time
+import threading
+import contextlib
+
+# Startup helpers for agent.py and llm-agent.py: a per-phase startup
+# profile and background warm-up of slow objects (LangChain, the LLM
+# client, the Bluetooth connection) so audio listening can start first.
+
+
+class StartupProfile(object):
+    '''
+    Records named startup phases relative to when the profile was created.
+
+        profile = StartupProfile()
+        with profile.phase("imports"):
+            import heavy_module
+        print(profile.report())
+    '''
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self._phases = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end):
+        with self._lock:
+            self._phases.append((name, threading.current_thread().name, start - self.origin, end - start))
+
+    def mark(self, name):
+        '''
+        Zero-length phase, e.g. "listening" once audio is running
+        '''
+        now = time.perf_counter()
+        self.record(name, now, now)
+
+    def phases(self):
+        with self._lock:
+            return sorted(self._phases, key=lambda p: p[2])
+
+    def report(self):
+        lines = ["Startup profile (seconds since start):"]
+        for name, thread, start, duration in self.phases():
+            lines.append("  %-24s %-14s at %7.3f  took %7.3f" % (name, thread, start, duration))
+        return "\n".join(lines)
+
+
+class Warmup(object):
+    '''
+    Builds an object on a background thread. get() waits for it and
+    re-raises whatever the factory raised
+    '''
+    def __init__(self, name, factory, profile=None):
+        self.name = name
+        self.factory = factory
+        self.profile = profile
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='warmup-' + self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            self._value = self.factory()
+        except BaseException as e:
+            self._error = e
+            print("Warm-up of %s failed: %s" % (self.name, e))
+        finally:
+            if self.profile is not None:
+                self.profile.record(self.name, start, time.perf_counter())
+            self._done.set()
+
+    def ready(self):
+        return self._done.is_set() and self._error is None
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def get(self, timeout=None):
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError("%s is still warming up" % self.name)
+        if self._error is not None:
+            raise self._error
+        return self._value
@@ -1,11 +1,21 @@
 #!/usr/bin/python3
 # coding=utf8
+import os
 import sys
 sys.path.append('/home/pi/TurboPi/')
-import time
+import queue
 import signal
-import HiwonderSDK.mecanum as mecanum
+import collections
+import mecanum
+import board as Board
 from bluetooth import  *
+import protocol
+import flight_recorder
+from robot_server import RobotServer, Arbiter, PREEMPT
+from motion import (MotionExecutor, Segment, stop_segment, blend_segments, stop_go_duration,
+                    wheel_limit, APPEND, REPLACE, SETTLE_TIME)
+from speed_model import SpeedModel
+from rgb_renderer import RGBRenderer
 
 print('''
 Demo: Process a list of movement commands.
@@ -15,9 +25,16 @@ Commands:
 Press Ctrl+C to stop.
 ''')
 
+# Controllers that can be connected at once, e.g. the voice agent and a
+# manual override app
+MAX_CLIENTS = 4
+# Seconds a lower priority controller stays locked out after the moves
+# of a higher priority one finish
+OVERRIDE_HOLD = 3.0
+
 server_sock=BluetoothSocket( RFCOMM )
 server_sock.bind(("",PORT_ANY))
-server_sock.listen(1)
+server_sock.listen(MAX_CLIENTS)
 
 port = server_sock.getsockname()[1]
 
@@ -30,124 +47,290 @@ advertise_service( server_sock, "SampleServer",
 #                   protocols = [ OBEX_UUID ] 
                     )
                    
-print("Waiting for connection on RFCOMM channel %d" % port)
+print("Waiting for connections on RFCOMM channel %d" % port)
 
-client_sock, client_info = server_sock.accept()
-print("Accepted connection from ", client_info)
+# Record received frames, commands, chassis velocities and motor writes,
+# see flight_recorder.py and replay_flight.py. Set TARS_FLIGHT_RECORDING
+# to another file, or to nothing to turn it off
+FLIGHT_RECORDING = os.environ.get("TARS_FLIGHT_RECORDING", "flight.rec")
+if FLIGHT_RECORDING:
+    flight_recorder.start(FLIGHT_RECORDING)
+    print(f"Recording to {FLIGHT_RECORDING}")
 
 # Initialize the chassis
 chassis = mecanum.MecanumChassis()
 start = True
 
+# Status LEDs: listening while idle, moving while the executor runs,
+# blinking red on low battery
+leds = RGBRenderer().start()
+leds.set_effect("listening")
+
+def on_low_battery(mv):
+    print(f"Low battery: {mv:.0f} mV")
+    leds.set_alert("low_battery")
+
+def on_battery_recovered(mv):
+    print(f"Battery back to {mv:.0f} mV")
+    leds.set_alert(None)
+
+# Battery voltage is sampled in the background, so planning a move never
+# waits for the bus behind motor writes
+LOW_BATTERY_MV = 6800
+battery_monitor = Board.startBatteryMonitor()
+battery_monitor.add_threshold(LOW_BATTERY_MV, on_low_battery, on_recover=on_battery_recovered)
+
+# Status frames back to the controller that sent the command. The server
+# loop and the executor thread both send; Client.send serializes them
+# and queues what the socket does not take, it never blocks
+def send_status(client, statuses):
+    try:
+        client.send(protocol.encode_status(statuses))
+    except Exception as e:
+        print(f"Could not send status to {client.name}: {e}")
+
+# Which controller is in control of the motion queue, see robot_server.py
+arbiter = Arbiter(hold=OVERRIDE_HOLD)
+
+# Motions are tagged with the controller and the commands they came from.
+# The move and turn commands of one frame run as one motion, each starting
+# at a labelled segment, see submit_commands
+Order = collections.namedtuple('Order', ['client', 'seqs'])
+
+# Mission time against the old stop-go plans, see BLEND_SEGMENTS
+mission = {"moves": 0, "actual": 0.0, "stop_go": 0.0}
+stop_go_times = {}  # Order -> its stop-go duration
+
+def report_mission(motion):
+    baseline = stop_go_times.pop(motion.tag, None)
+    if baseline is None:
+        return
+    actual = motion.finished_at - motion.started_at
+    mission["moves"] += 1
+    mission["actual"] += actual
+    mission["stop_go"] += baseline
+    print(f"Commands {', '.join(map(str, motion.tag.seqs))} took {actual:.2f} s, stop-go {baseline:.2f} s, "
+          f"saved {mission['stop_go'] - mission['actual']:.2f} s so far")
+
+# Moves run on the executor thread, so the receive loop below keeps
+# reading the socket while the robot is moving
+def current_command(motion):
+    # Index into the motion's seqs of the command that is running
+    return sum(1 for s in motion.segments[:motion.segment + 1] if s.label) - 1
+
+def report_motion(event, motion):
+    client, seqs = motion.tag
+    if event in ("done", "cancelled") and not executor.pending():
+        leds.set_effect("listening")
+        arbiter.released()
+    if event == "start":
+        leds.set_effect("moving")
+        send_status(client, [protocol.Status(protocol.STATUS_PROGRESS, seqs[0], 0.0)])
+    elif event == "segment":
+        label = motion.segments[motion.segment].label
+        if label:
+            print(label)
+            # The next command starts, blended in: the one before it is done
+            i = current_command(motion)
+            if i > 0:
+                send_status(client, [protocol.Status(protocol.STATUS_DONE, seqs[i - 1], 1.0),
+                                     protocol.Status(protocol.STATUS_PROGRESS, seqs[i], 0.0)])
+    elif event == "done":
+        send_status(client, [protocol.Status(protocol.STATUS_DONE, seqs[-1], 1.0)])
+        report_mission(motion)
+    elif event == "cancelled":
+        stop_go_times.pop(motion.tag, None)
+        cancelled = seqs[max(0, current_command(motion)):]
+        print(f"Cancelled: commands {', '.join(map(str, cancelled))} from {client.name}")
+        send_status(client, [protocol.Status(protocol.STATUS_CANCELLED, seq, 0.0) for seq in cancelled])
+
+executor = MotionExecutor(chassis, maxsize=16, listener=report_motion).start()
+
 # Signal handler for graceful exit
 def stop_handler(signum, frame):
     global start
     start = False
     print("Stopping robot...")
+    executor.cancel()
     chassis.set_velocity(0, 0, 0)
 
 signal.signal(signal.SIGINT, stop_handler)
 
-# List of movement commands
-# Unit is centimeter
-# Each dictionary contains:
-#  - distance: the distance to move
-#  - move: the movement direction (only "forward" in this example)
-#  - turn: the turn direction ("left" or "right")
-# commands = [
-#     {"distance": 50, "move": "forward", "turn": "left"},
-#     {"distance": 50, "move": "forward", "turn": "right"}
-# ]
-commands = []
+# Commands arrive as binary frames (see protocol.py). Each frame carries
+# one or more commands:
+#  - OP_MOVE: distance in centimeter, negative moves backward
+#  - OP_TURN: angle in degrees, positive turns left
+#  - OP_STOP: cancel the running and queued moves
+#  - OP_END:  finish the queued moves and disconnect
+# A frame with FLAG_REPLACE preempts whatever is running. A controller
+# with a higher priority (see FRAME_HELLO) preempts the moves of a lower
+# one, and the lower one's commands are rejected while it is in control.
 
 # Constants
 SPEED = 50  # Speed (0-100)
 FORWARD_DIRECTION = 90  # Forward direction in degrees (90 is forward)
 WHEEL_DIAMETER_MM = 65  # Wheel diameter in mm (from your code)
+TURN_RATE = 0.5  # Angular rate used for turns
+# Go straight from one move into the next instead of stopping and
+# settling for SETTLE_TIME after each one. The moves and turns of one
+# frame are planned as one motion and overlap where the wheels allow it
+BLEND_SEGMENTS = True
 
-def get_move_duration(distance, speed=50):
-    MAX_SPEED_CMPS = 50  # Maximum speed in centimeters per second at 100% power
-    actual_speed = (SPEED / 100) * MAX_SPEED_CMPS  # Speed in centimeters per second
-    time_for_distance = distance / actual_speed  # Time in seconds
-    return time_for_distance
-
-def execute_command(cmd):
-    # Check if this is a turn-only command
-    if "distance" not in cmd:
-        turn_direction = cmd.get("turn")
-        if turn_direction:
-            # Use a positive angular rate for left, negative for right.
-            angular_rate = -0.5 if turn_direction.lower() == "left" else 0.5
-            print(f"Turning {turn_direction} for 2 seconds.")
-            chassis.set_velocity(0, 0, angular_rate)
-            time.sleep(0.5)
-            chassis.set_velocity(0, 0, 0)
-            time.sleep(0.5)
-        return
-    
-    # Check movement direction (forward or backward)
-    move_direction = cmd.get("move", "forward")
+# Measured speeds per direction, speed and battery voltage, see
+# calibrate_speed.py. Uncalibrated it is 50 cm/s at 100% power and a
+# 90 degree turn in 0.5 seconds at TURN_RATE
+speed_model = SpeedModel.load()
+
+def get_move_duration(distance, speed=SPEED, direction=FORWARD_DIRECTION):
+    return speed_model.move_duration(distance, speed, direction)
+
+def turn_segments(angle):
+    # A negative angular rate turns left, a positive one right.
+    turn_direction = "left" if angle > 0 else "right"
+    angular_rate = -TURN_RATE if angle > 0 else TURN_RATE
+    duration = speed_model.turn_duration(angle, angular_rate)
+    return [
+        Segment(0, 0, angular_rate, duration, f"Turning {turn_direction} {abs(angle):.0f} degrees for {duration:.2f} seconds."),
+        stop_segment(SETTLE_TIME),
+    ]
+
+def plan_command(cmd):
+    """Turn a protocol command into the list of segments that executes it.
+    Its first segment is labelled, the settle pause after it is not."""
+    if cmd.op == protocol.OP_TURN:
+        return turn_segments(cmd.value) if cmd.value else []
     
-    duration = get_move_duration(cmd["distance"], speed=50)
+    distance = abs(cmd.value)
     
-    if move_direction == "backward":
-        print(f"Moving backward {cmd['distance']} for {duration:.2f} seconds.")
-        chassis.set_velocity(50, 270, 0)  # 270 degrees is backward (opposite of forward)
+    if cmd.value < 0:
+        # 270 degrees is backward (opposite of forward)
+        duration = get_move_duration(distance, SPEED, 270)
+        segments = [Segment(SPEED, 270, 0, duration, f"Moving backward {distance} for {duration:.2f} seconds.")]
     else:
-        print(f"Moving forward {cmd['distance']} for {duration:.2f} seconds.")
-        chassis.set_velocity(50, FORWARD_DIRECTION, 0)
-    
-    time.sleep(duration)
-    
-    # Stop before turning
-    chassis.set_velocity(0, 0, 0)
-    time.sleep(0.5)
+        duration = get_move_duration(distance, SPEED, FORWARD_DIRECTION)
+        segments = [Segment(SPEED, FORWARD_DIRECTION, 0, duration, f"Moving forward {distance} for {duration:.2f} seconds.")]
     
-    # Turn command (if present)
-    turn_direction = cmd.get("turn")
-    if turn_direction:
-        # Use a positive angular rate for left, negative for right.
-        angular_rate = -0.5 if turn_direction.lower() == "left" else 0.5
-        print(f"Turning {turn_direction} for 2 seconds.")
-        chassis.set_velocity(0, 0, angular_rate)
-        time.sleep(0.5)
-        chassis.set_velocity(0, 0, 0)
-        time.sleep(0.5)
+    # Stop before the next command
+    segments.append(stop_segment(SETTLE_TIME))
+    return segments
+
+def blend_plan(segments):
+    """Drop the settle pauses and overlap the moves, see motion.blend_segments."""
+    if not BLEND_SEGMENTS:
+        return segments
+    return blend_segments(segments, scale=wheel_limit(chassis))
+
+def submit_commands(client, planned, mode, acks):
+    """Submit planned, [(cmd, segments)], as one blended motion and add
+    the acks of its commands to acks. Returns the mode for the next one."""
+    if not planned:
+        return mode
+    seqs = tuple(cmd.seq for cmd, _ in planned)
+    segments = [segment for _, plan in planned for segment in plan]
+    order = Order(client, seqs)
+    stop_go_times[order] = stop_go_duration(segments)
+    try:
+        executor.submit(blend_plan(segments), mode=mode, tag=order)
+    except queue.Full:
+        print(f"Motion queue full, dropping commands {', '.join(map(str, seqs))}")
+        stop_go_times.pop(order, None)
+        acks.extend(protocol.Status(protocol.STATUS_REJECTED, seq, 0.0) for seq in seqs)
+        return mode
+    acks.extend(protocol.Status(protocol.STATUS_ACK, seq, 0.0) for seq in seqs)
+    return APPEND
+
+def handle_frame(client, frame):
+    """Queue the commands of one frame from client. Returns False on OP_END."""
+    # Keepalives are answered and not recorded
+    if frame.type == protocol.FRAME_PING:
+        client.send(protocol.encode_ping())
+        return True
+    recorder = flight_recorder.current
+    if recorder is not None:
+        recorder.frame(frame)
+    if frame.type == protocol.FRAME_HELLO:
+        hello = protocol.decode_hello(frame.payload)
+        client.priority = hello.priority
+        if hello.name:
+            client.name = hello.name
+        print(f"{client.name} connected with priority {client.priority}")
+        return True
+    if frame.type != protocol.FRAME_COMMANDS:
+        print(f"Ignoring frame type {frame.type} from {client.name}")
+        return True
+    commands = protocol.decode_commands(frame.payload)
+    decision = arbiter.admit(client, executor.busy())
+    if decision is None:
+        owner = arbiter.owner
+        print(f"Rejecting {len(commands)} commands from {client.name}, "
+              f"{owner.name if owner else 'another controller'} is in control")
+        send_status(client, [protocol.Status(protocol.STATUS_REJECTED, cmd.seq, 0.0) for cmd in commands])
+        return True
+    if decision == PREEMPT:
+        print(f"Override: {client.name} preempts the running moves")
+        mode = REPLACE
+    else:
+        mode = REPLACE if frame.flags & protocol.FLAG_REPLACE else APPEND
+    # Every command is acknowledged, all acks of a frame in one status frame.
+    # Stop and end have nothing left to run, so they are done right away.
+    # The executor may report progress before the ack goes out; the
+    # controller takes any status as the ack
+    acks = []
+    planned = []  # consecutive moves and turns, submitted as one motion
+    running = True
+    for cmd in commands:
+        print(f"Command {cmd.seq} from {client.name}: {protocol.OP_NAMES.get(cmd.op, cmd.op)} {cmd.value:g}")
+        if recorder is not None:
+            recorder.command(cmd)
+        if cmd.op in (protocol.OP_MOVE, protocol.OP_TURN):
+            segments = plan_command(cmd)
+            if segments:
+                planned.append((cmd, segments))
+            else:
+                acks.append(protocol.Status(protocol.STATUS_DONE, cmd.seq, 1.0))
+            continue
+        # Anything else comes after the moves before it
+        mode = submit_commands(client, planned, mode, acks)
+        planned = []
+        if cmd.op == protocol.OP_END:
+            acks.append(protocol.Status(protocol.STATUS_DONE, cmd.seq, 1.0))
+            client.ended = True
+            running = False
+            break
+        if cmd.op == protocol.OP_STOP:
+            executor.cancel()
+            acks.append(protocol.Status(protocol.STATUS_DONE, cmd.seq, 1.0))
+            continue
+        print(f"Unknown command op {cmd.op}")
+        acks.append(protocol.Status(protocol.STATUS_REJECTED, cmd.seq, 0.0))
+    mode = submit_commands(client, planned, mode, acks)
+    # An override made of commands with nothing to run still takes over
+    if decision == PREEMPT and mode == REPLACE:
+        executor.cancel()
+    if acks:
+        send_status(client, acks)
+    return running
+
+def on_disconnect(client):
+    # Moves of a controller that went away mid-mission are not finished,
+    # unless it said OP_END
+    if arbiter.drop(client) and not client.ended:
+        print(f"{client.name} was in control, cancelling its moves")
+        executor.cancel()
+
+server = RobotServer(server_sock, handle_frame, on_disconnect, max_clients=MAX_CLIENTS)
 
 if __name__ == '__main__':
     
-    while True:
-        data = client_sock.recv(1024)
-        if data and len(data) > 0:
-            print(f"Received: {data}")
-            if data == b"end":
-                break
-            try:
-                data = data.decode('utf-8').split("@")
-                
-                # Check if this is a turn-only command
-                if data[0] == "turn":
-                    commands = [{"turn": data[1]}]
-                # Check if this is a backward command (negative distance)
-                elif data[0].startswith("-"):
-                    distance = float(data[0])
-                    commands = [{"distance": abs(distance), "move": "backward"}]
-                else:
-                    # Forward command (with or without turn)
-                    distance = float(data[0])
-                    if data[1] == "none":
-                        # Forward-only command
-                        commands = [{"distance": distance, "move": "forward"}]
-                    else:
-                        # Forward and turn command
-                        commands = [{"distance": distance, "move": "forward", "turn": data[1]}]
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                break            
-            for command in commands:
-                if not start:
-                    break
-                execute_command(command)
+    # Serves every controller until Ctrl+C; controllers can come and go
+    server.serve(lambda: start)
     
-    chassis.set_velocity(0, 0, 0)
-    print("Command sequence completed.")
\ No newline at end of file
+    executor.stop()
+    leds.stop()
+    recorder = flight_recorder.stop()
+    if recorder is not None:
+        print(f"Recorded {recorder.written} records to {recorder.path}")
+    if mission["moves"]:
+        print(f"{mission['moves']} moves in {mission['actual']:.2f} s, "
+              f"{mission['stop_go'] - mission['actual']:.2f} s less than stop-go")
+    print("Command sequence completed.")